@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+# This file is part of ODM and distributed under the terms of the
+# MIT license. See COPYING.
+
+import argparse
+import json
+import os
+import platform
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+from odm import __version__, metadata as odm_metadata
+
+from benchmarks.fakeserver import FakeServer
+
+
+ODM = 'import sys; sys.argv[0] = "odm"; from odm.libexec.wrapper import main; main()'
+
+
+def odm(config, args, verbose=0):
+    cmd = [sys.executable, '-c', ODM, '-c', config]
+    cmd.extend(args)
+    cmd.extend(['-v'] * verbose)
+    env = dict(os.environ)
+    # The fake server doesn't do TLS
+    env['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
+    env['PYTHONPATH'] = os.pathsep.join([os.path.dirname(os.path.dirname(os.path.abspath(__file__))), env.get('PYTHONPATH', '')])
+
+    print('Running {}'.format(' '.join(args)), file=sys.stderr)
+    start = time.perf_counter()
+    result = subprocess.run(cmd, env=env)
+    elapsed = time.perf_counter() - start
+    return (result.returncode, elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time odm list download and upload against a local fake API')
+    parser.add_argument('--items', type=int, default=1000, help='Number of synthetic drive items')
+    parser.add_argument('--depth', type=int, default=8, help='Maximum folder depth')
+    parser.add_argument('--max-size', type=int, default=16 * 1024 * 1024, help='Largest synthetic file, in bytes')
+    parser.add_argument('--latency', type=float, default=0, help='Seconds added to each API request')
+    parser.add_argument('--bandwidth', type=int, default=0, help='Bytes/second per transfer (0 for unlimited)')
+    parser.add_argument('--error-rate', type=float, default=0, help='Fraction of requests that get a 429 or 503')
+    parser.add_argument('--drop-rate', type=float, default=0, help='Fraction of downloads cut off partway through')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--list-args', default='', help='Extra arguments for odm user list-items (e.g. --output-format ndjson)')
+    parser.add_argument('--download-args', default='', help='Extra arguments for odm list download')
+    parser.add_argument('--upload-args', default='', help='Extra arguments for odm list upload')
+    parser.add_argument('--skip', default='', help='Comma-separated phases to skip (download, verify, upload)')
+    parser.add_argument('--output', help='Write results to this file instead of stdout')
+    parser.add_argument('-v', '--verbose', action='count', default=0, help='Verbosity passed to odm')
+    args = parser.parse_args()
+
+    skip = args.skip.split(',')
+
+    server = FakeServer(
+        items=args.items,
+        depth=args.depth,
+        max_size=args.max_size,
+        latency=args.latency,
+        bandwidth=args.bandwidth,
+        error_rate=args.error_rate,
+        drop_rate=args.drop_rate,
+        seed=args.seed,
+    ).start()
+
+    tmpdir = tempfile.mkdtemp(prefix='odm-e2e-')
+    config = os.path.join(tmpdir, 'odm.yaml')
+    metadata = os.path.join(tmpdir, 'metadata.json')
+    filetree = os.path.join(tmpdir, 'filetree')
+    with open(config, 'w') as f:
+        yaml.safe_dump({
+            'domain': 'example.com',
+            'timeout': 60,
+            'microsoft': {
+                'client_id': 'e2e',
+                'client_secret': 'e2e',
+                'tenant': 'e2e',
+                'graph_url': server.url + 'v1.0/',
+                'login_url': server.url,
+                'max_attempts': 10,
+            },
+        }, f)
+
+    phases = []
+    try:
+        (rc, elapsed) = odm(
+            config,
+            ['user', 'source', 'list-items', '--output', metadata] + shlex.split(args.list_args),
+            verbose=args.verbose,
+        )
+        items = odm_metadata.load(metadata)['items']
+        files = [x for x in items.values() if 'file' in x]
+        size = sum(x['size'] for x in files)
+        phases.append({'name': 'list-items', 'returncode': rc, 'elapsed': elapsed, 'items': len(items), 'rate': len(items) / elapsed})
+
+        for (phase, extra) in (
+            ('download', shlex.split(args.download_args)),
+            ('verify', []),
+            ('upload', ['--upload-user', 'upload'] + shlex.split(args.upload_args)),
+        ):
+            if phase in skip:
+                continue
+            (rc, elapsed) = odm(
+                config,
+                ['list', metadata, phase, '--filetree', filetree] + extra,
+                verbose=args.verbose,
+            )
+            phases.append({
+                'name': phase,
+                'returncode': rc,
+                'elapsed': elapsed,
+                'items': len(files),
+                'bytes': size,
+                'rate': len(files) / elapsed,
+                'throughput': size / elapsed,
+            })
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmpdir)
+
+    output = {
+        'odm_version': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'parameters': vars(args),
+        'phases': phases,
+        'server': {'{} {}'.format(*k): v for (k, v) in server.cloud.stats.items()},
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+    else:
+        print(json.dumps(output, indent=2))
+
+    if any(x['returncode'] for x in phases):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
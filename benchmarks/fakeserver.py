@@ -0,0 +1,1030 @@
+#!/usr/bin/env python3
+
+# This file is part of ODM and distributed under the terms of the
+# MIT license. See COPYING.
+
+import argparse
+import hashlib
+import json
+import logging
+import random
+import re
+import threading
+import time
+import uuid
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+
+from odm.quickxorhash import QuickXORHash
+
+from benchmarks.synthetic import generate_items
+
+
+# File content is this block repeated, so any byte range can be generated
+# without storing anything.
+PATTERN_SIZE = 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+
+
+class Request(object):
+    def __init__(self, method, path, query, headers, body=None, rfile=None):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.body = body
+        self.rfile = rfile
+
+    def param(self, name, default=None):
+        return self.query.get(name, [default])[0]
+
+    def chunks(self):
+        ''' Yield the request body in pieces without buffering all of it. '''
+        if self.body is not None:
+            if self.body:
+                yield self.body
+            return
+
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return
+                yield self.rfile.read(size)
+                self.rfile.readline()
+
+        remaining = int(self.headers.get('Content-Length', 0))
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, CHUNK_SIZE))
+            if not chunk:
+                return
+            remaining -= len(chunk)
+            yield chunk
+
+    def read(self):
+        return b''.join(self.chunks())
+
+    def json(self):
+        body = self.read()
+        if not body:
+            return {}
+        return json.loads(body.decode('utf-8'))
+
+
+class Response(object):
+    def __init__(self, status, body=None, headers=None):
+        self.status = status
+        self.body = body
+        self.headers = dict(headers or {})
+
+
+def _error(status, code, message=None):
+    return Response(status, {'error': {'code': code, 'message': message or code}})
+
+
+def _public(obj):
+    return {k: v for (k, v) in obj.items() if not k.startswith('_')}
+
+
+class Store(object):
+    ''' One drive's worth of items, addressable by id or by parent and name. '''
+
+    def __init__(self, store_id, owner, items=None):
+        self.id = store_id
+        self.owner = owner
+        self.items = {}
+        self.children = {}
+        self.gen = 0
+        # Delta tokens from before this generation get a 410
+        self.token_floor = 0
+        self.list_id = str(uuid.uuid4())
+        self.list_items = {}
+        for item in (items or {}).values():
+            self.add(item)
+
+    def add(self, item):
+        self.gen += 1
+        item['_gen'] = self.gen
+        self.items[item['id']] = item
+        self.children.setdefault(item['id'], {})
+        parent = item['parentReference'].get('id')
+        if parent:
+            self.children.setdefault(parent, {})[item['name'].lower()] = item['id']
+        return item
+
+    def expire_tokens(self):
+        self.token_floor = self.gen + 1
+
+    def remove_child(self, item):
+        parent = item['parentReference'].get('id')
+        if parent:
+            self.children[parent].pop(item['name'].lower(), None)
+
+    def child(self, parent_id, name):
+        child_id = self.children.get(parent_id, {}).get(name.lower())
+        if child_id:
+            return self.items[child_id]
+        return None
+
+    def resolve(self, item_id, path):
+        item = self.items.get(item_id)
+        if path:
+            for name in path.strip('/').split('/'):
+                if not item:
+                    break
+                item = self.child(item['id'], name)
+        return item
+
+    def list_item_id(self, item_id):
+        for (k, v) in self.list_items.items():
+            if v == item_id:
+                return k
+        key = str(len(self.list_items) + 1)
+        self.list_items[key] = item_id
+        return key
+
+
+class FakeCloud(object):
+    ''' Stand-in for the subset of Graph, SharePoint, Google Drive and Box
+    that ODM uses, backed by synthetic drives. Users whose names start with
+    "upload" get empty drives to upload into; everyone else gets `items`
+    synthetic items. '''
+
+    def __init__(
+        self,
+        base_url,
+        items=1000,
+        depth=8,
+        name_length=24,
+        max_size=64 * 1024 * 1024,
+        page_size=200,
+        latency=0,
+        bandwidth=0,
+        error_rate=0,
+        drop_rate=0,
+        retry_after=1,
+        seed=0,
+    ):
+        self.base_url = base_url.rstrip('/') + '/'
+        self.item_count = items
+        self.depth = depth
+        self.name_length = name_length
+        self.max_size = max_size
+        self.page_size = page_size
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.retry_after = retry_after
+        self.seed = seed
+
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.RLock()
+        self.rng = random.Random(seed)
+        self.pattern = random.Random(seed).getrandbits(PATTERN_SIZE * 8).to_bytes(PATTERN_SIZE, 'little')
+        self.digests = {}
+        self.stores = {}
+        self.users = {}
+        self.sessions = {}
+        self.stats = Counter()
+
+    # Helpers
+
+    def content(self, size, start=0, end=None):
+        if end is None:
+            end = size - 1
+        pattern = memoryview(self.pattern)
+        pos = start
+        while pos <= end:
+            offset = pos % PATTERN_SIZE
+            length = min(PATTERN_SIZE - offset, end - pos + 1, CHUNK_SIZE)
+            yield pattern[offset:offset + length]
+            pos += length
+
+    def digest(self, size, algorithm):
+        key = (size, algorithm)
+        with self.lock:
+            if key in self.digests:
+                return self.digests[key]
+
+        if algorithm == 'quickXorHash':
+            h = QuickXORHash()
+        else:
+            h = hashlib.new(algorithm)
+        for chunk in self.content(size):
+            h.update(chunk)
+        if algorithm == 'quickXorHash':
+            value = h.finalize()
+        else:
+            value = h.hexdigest()
+
+        with self.lock:
+            self.digests[key] = value
+        return value
+
+    def pace(self, start, transferred):
+        if self.bandwidth:
+            delay = start + transferred / float(self.bandwidth) - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+    def inject(self):
+        ''' Maybe return a throttling or server error response. '''
+        if self.latency:
+            with self.lock:
+                jitter = self.rng.uniform(0.75, 1.25)
+            time.sleep(self.latency * jitter)
+
+        if not self.error_rate:
+            return None
+        with self.lock:
+            if self.rng.random() >= self.error_rate:
+                return None
+            status = self.rng.choice((429, 503))
+        if status == 429:
+            return Response(429, {'error': {'code': 'activityLimitReached'}}, {'Retry-After': str(self.retry_after)})
+        return _error(503, 'serviceNotAvailable')
+
+    def _synthetic_store(self, store_id, owner, seed):
+        if owner.split('@')[0].startswith('upload'):
+            items = {
+                'root': {
+                    'id': 'root',
+                    'name': 'root',
+                    'folder': {'childCount': 0},
+                    'parentReference': {'driveId': store_id},
+                    'size': 0,
+                },
+            }
+        else:
+            items = generate_items(self.item_count, self.depth, self.name_length, seed=seed, drive_id=store_id)['items']
+        for item in items.values():
+            item['size'] = min(item['size'], self.max_size)
+            if 'file' in item:
+                item['file'].pop('hashes', None)
+        return Store(store_id, owner, items)
+
+    def graph_store(self, user):
+        user = user.lower()
+        with self.lock:
+            if user not in self.users:
+                seed = self.seed + len(self.users)
+                store_id = 'b!' + hashlib.sha1('{}:{}'.format(user, seed).encode('utf-8')).hexdigest()[:16]
+                self.users[user] = {
+                    'id': str(uuid.UUID(int=random.Random(user).getrandbits(128))),
+                    'userPrincipalName': user,
+                    'mail': user,
+                    'displayName': user.split('@')[0],
+                    'accountEnabled': True,
+                    '_drive': store_id,
+                    '_box_id': str(len(self.users) + 1),
+                }
+                self.stores[store_id] = self._synthetic_store(store_id, user, seed)
+            return self.users[user], self.stores[self.users[user]['_drive']]
+
+    def graph_item(self, store, item, expand_permissions=False, sharepoint=False):
+        obj = _public(item)
+        obj['parentReference'] = dict(item['parentReference'])
+        if 'file' in item:
+            obj['file'] = dict(item['file'])
+            obj['file']['hashes'] = {
+                'quickXorHash': item.get('_hash') or self.digest(item['size'], 'quickXorHash'),
+            }
+        if expand_permissions:
+            obj['permissions'] = [{
+                'id': 'owner',
+                'roles': ['owner'],
+                'grantedTo': {'user': {'email': store.owner, 'displayName': store.owner}},
+            }]
+        if sharepoint:
+            obj['sharepointIds'] = {
+                'siteUrl': '{}sites/{}'.format(self.base_url, quote(store.owner)),
+                'listId': store.list_id,
+            }
+            if 'id' in item['parentReference']:
+                obj['sharepointIds']['listItemId'] = store.list_item_id(item['id'])
+        return obj
+
+    def page(self, req, values, path):
+        top = int(req.param('$top') or self.page_size)
+        skip = int(req.param('$skiptoken') or 0)
+        result = {'value': values[skip:skip + top]}
+        if skip + top < len(values):
+            query = {k: v[0] for (k, v) in req.query.items() if k != '$skiptoken'}
+            query['$skiptoken'] = str(skip + top)
+            result['@odata.nextLink'] = '{}v1.0/{}?{}'.format(
+                self.base_url,
+                path,
+                '&'.join('{}={}'.format(k, quote(v)) for (k, v) in query.items()),
+            )
+        return result, skip + top >= len(values)
+
+    def new_file(self, store, parent, name, size, digest, mtime=None):
+        now = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        with self.lock:
+            existing = store.child(parent['id'], name)
+            if existing:
+                store.remove_child(existing)
+            item = {
+                'id': existing['id'] if existing else uuid.uuid4().hex.upper(),
+                'name': name,
+                'size': size,
+                'file': {'mimeType': 'application/octet-stream'},
+                'fileSystemInfo': {
+                    'createdDateTime': now,
+                    'lastModifiedDateTime': mtime or now,
+                },
+                'parentReference': {'driveId': store.id, 'id': parent['id']},
+                '_hash': digest,
+            }
+            return store.add(item)
+
+    def receive(self, req, hashes):
+        start = time.monotonic()
+        received = 0
+        for chunk in req.chunks():
+            for h in hashes:
+                h.update(chunk)
+            received += len(chunk)
+            self.pace(start, received)
+        return received
+
+    def _truncated(self, body, length):
+        sent = 0
+        for chunk in body:
+            if sent + len(chunk) >= length:
+                yield chunk[:length - sent]
+                return
+            sent += len(chunk)
+            yield chunk
+
+    def download(self, size, req, etag=None):
+        status = 200
+        start = 0
+        end = size - 1
+        headers = {'Accept-Ranges': 'bytes'}
+        if etag:
+            headers['ETag'] = etag
+        match = re.match(r'bytes=(\d*)-(\d*)$', req.headers.get('Range', ''))
+        if_range = req.headers.get('If-Range')
+        if match and size and (not if_range or if_range == etag):
+            if match.group(1):
+                start = int(match.group(1))
+                if match.group(2):
+                    end = min(end, int(match.group(2)))
+            else:
+                start = max(0, size - int(match.group(2)))
+            if start > end:
+                return Response(416, b'', {'Content-Range': 'bytes */{}'.format(size)})
+            status = 206
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, size)
+        headers['Content-Type'] = 'application/octet-stream'
+        headers['Content-Length'] = str(max(0, end - start + 1))
+        response = Response(status, self.content(size, start, end), headers)
+        if self.drop_rate and end > start:
+            with self.lock:
+                drop = self.rng.random() < self.drop_rate
+            if drop:
+                # Cut the connection halfway through the body
+                response.body = self._truncated(response.body, (end - start + 1) // 2)
+                response.truncated = True
+        return response
+
+    # Auth
+
+    def token(self, req, **kwargs):
+        req.read()
+        return Response(200, {
+            'access_token': uuid.uuid4().hex,
+            'accessToken': uuid.uuid4().hex,
+            'token_type': 'Bearer',
+            'expires_in': 3600,
+            'expires_on': str(int(time.time()) + 3600),
+            'restricted_to': [],
+        })
+
+    # Graph
+
+    def graph_user(self, req, user):
+        user, store = self.graph_store(unquote(user))
+        return Response(200, _public(user))
+
+    def graph_user_drives(self, req, user):
+        user, store = self.graph_store(unquote(user))
+        return Response(200, {'value': [{
+            'id': store.id,
+            'name': 'OneDrive',
+            'driveType': 'business',
+            'owner': {'user': {'email': store.owner}},
+        }]})
+
+    def graph_drive(self, req, drive):
+        store = self.stores.get(drive)
+        if not store:
+            return _error(404, 'itemNotFound')
+        return Response(200, {'id': store.id, 'name': 'OneDrive', 'driveType': 'business'})
+
+    def graph_root(self, req, drive):
+        store = self.stores.get(drive)
+        if not store:
+            return _error(404, 'itemNotFound')
+        return Response(200, self.graph_item(store, store.items['root']))
+
+    def graph_delta(self, req, drive):
+        store = self.stores.get(drive)
+        if not store:
+            return _error(404, 'itemNotFound')
+        since = int(req.param('token') or 0)
+        if req.param('token') and since < store.token_floor:
+            return _error(410, 'resyncRequired', 'Resync required. Replace any local items with the server\'s version.')
+        with self.lock:
+            gen = store.gen
+            values = [self.graph_item(store, x) for x in store.items.values() if x['_gen'] > since]
+        result, done = self.page(req, values, 'drives/{}/root/delta'.format(drive))
+        if done:
+            result['@odata.deltaLink'] = '{}v1.0/drives/{}/root/delta?token={}'.format(self.base_url, drive, gen)
+        return Response(200, result)
+
+    def graph_items(self, req, drive, item, path=None, rest=None):
+        store = self.stores.get(drive)
+        if not store:
+            return _error(404, 'itemNotFound')
+        path = unquote(path) if path else None
+        rest = (rest or '').strip('/')
+
+        if req.method in ('PUT', 'POST') and rest in ('content', 'createUploadSession') and path:
+            # Uploads address the new item by its parent and name
+            (parent_path, _, name) = path.rstrip('/').rpartition('/')
+            parent = store.resolve(item, parent_path)
+            if not parent or 'folder' not in parent:
+                return _error(404, 'itemNotFound')
+            if rest == 'content':
+                h = QuickXORHash()
+                size = self.receive(req, [h])
+                return Response(201, self.graph_item(store, self.new_file(store, parent, name, size, h.finalize())))
+
+            payload = req.json()
+            session_id = uuid.uuid4().hex
+            with self.lock:
+                self.sessions[session_id] = {
+                    'store': store,
+                    'parent': parent,
+                    'name': name,
+                    'received': 0,
+                    'hash': QuickXORHash(),
+                    'conflict': payload.get('item', {}).get('@microsoft.graph.conflictBehavior'),
+                }
+            return Response(200, {
+                'uploadUrl': '{}graph-upload/{}'.format(self.base_url, session_id),
+                'expirationDateTime': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(time.time() + 3600)),
+            })
+
+        target = store.resolve(item, path)
+        if not target:
+            req.read()
+            return _error(404, 'itemNotFound')
+
+        if rest == '' and req.method == 'GET':
+            select = req.param('select') or req.param('$select') or ''
+            expand = req.param('expand') or req.param('$expand') or ''
+            return Response(200, self.graph_item(store, target, 'permissions' in expand, 'sharepointIds' in select))
+
+        if rest == '' and req.method == 'PATCH':
+            payload = req.json()
+            with self.lock:
+                store.remove_child(target)
+                if 'name' in payload:
+                    target['name'] = payload['name']
+                if 'parentReference' in payload:
+                    target['parentReference']['id'] = payload['parentReference']['id']
+                if 'fileSystemInfo' in payload:
+                    target.setdefault('fileSystemInfo', {}).update(payload['fileSystemInfo'])
+                store.add(target)
+            return Response(200, self.graph_item(store, target))
+
+        if rest == 'children' and req.method == 'GET':
+            with self.lock:
+                values = [self.graph_item(store, store.items[x]) for x in store.children.get(target['id'], {}).values()]
+            return Response(200, self.page(req, values, 'drives/{}/items/{}/children'.format(drive, target['id']))[0])
+
+        if rest == 'children' and req.method == 'POST':
+            payload = req.json()
+            with self.lock:
+                existing = store.child(target['id'], payload['name'])
+                if existing and 'folder' in existing:
+                    return Response(201, self.graph_item(store, existing))
+                if existing:
+                    return _error(409, 'nameAlreadyExists')
+                now = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+                folder = store.add({
+                    'id': uuid.uuid4().hex.upper(),
+                    'name': payload['name'],
+                    'size': 0,
+                    'folder': {'childCount': 0},
+                    'fileSystemInfo': {'createdDateTime': now, 'lastModifiedDateTime': now},
+                    'parentReference': {'driveId': store.id, 'id': target['id']},
+                })
+            return Response(201, self.graph_item(store, folder))
+
+        if rest == 'content' and req.method == 'GET':
+            if 'file' not in target:
+                return _error(400, 'invalidRequest')
+            return Response(302, b'', {'Location': '{}download/{}/{}'.format(self.base_url, store.id, target['id'])})
+
+        if rest == 'permissions' and req.method == 'GET':
+            return Response(200, {'value': self.graph_item(store, target, True)['permissions']})
+
+        if rest == 'invite' and req.method == 'POST':
+            payload = req.json()
+            return Response(200, {'value': [
+                {'id': uuid.uuid4().hex, 'roles': payload.get('roles', []), 'grantedTo': {'user': x}}
+                for x in payload.get('recipients', [])
+            ]})
+
+        req.read()
+        return _error(400, 'invalidRequest', 'Unsupported request')
+
+    def graph_upload(self, req, session):
+        with self.lock:
+            upload = self.sessions.get(session)
+        if not upload:
+            req.read()
+            return _error(404, 'itemNotFound')
+
+        if req.method == 'DELETE':
+            with self.lock:
+                self.sessions.pop(session, None)
+            return Response(204, b'')
+
+        match = re.match(r'bytes (\d+)-(\d+)/(\d+)$', req.headers.get('Content-Range', ''))
+        if not match:
+            req.read()
+            return _error(400, 'invalidRange')
+        (start, end, total) = (int(x) for x in match.groups())
+        if start != upload['received']:
+            req.read()
+            return _error(416, 'invalidRange', 'Expected range starting at {}'.format(upload['received']))
+
+        upload['received'] += self.receive(req, [upload['hash']])
+        if upload['received'] < total:
+            return Response(202, {
+                'nextExpectedRanges': ['{}-'.format(upload['received'])],
+            })
+
+        with self.lock:
+            self.sessions.pop(session, None)
+        item = self.new_file(upload['store'], upload['parent'], upload['name'], total, upload['hash'].finalize())
+        return Response(201, self.graph_item(upload['store'], item))
+
+    def graph_batch(self, req):
+        responses = []
+        for sub in req.json().get('requests', []):
+            parsed = urlsplit(sub['url'])
+            body = sub.get('body')
+            subreq = Request(
+                sub['method'],
+                '/v1.0' + parsed.path,
+                parse_qs(parsed.query),
+                sub.get('headers', {}),
+                body=json.dumps(body).encode('utf-8') if body is not None else b'',
+            )
+            result = self.inject() or self.dispatch(subreq)
+            responses.append({
+                'id': sub['id'],
+                'status': result.status,
+                'headers': result.headers,
+                'body': result.body if isinstance(result.body, (dict, list)) else None,
+            })
+        return Response(200, {'responses': responses})
+
+    def download_content(self, req, drive, item):
+        store = self.stores.get(drive)
+        target = store.items.get(item) if store else None
+        if not target:
+            return _error(404, 'itemNotFound')
+        return self.download(target['size'], req, '"{{{}}},{}"'.format(target['id'], target['_gen']))
+
+    # SharePoint
+
+    def sharepoint(self, req, site, call):
+        user, store = self.graph_store(unquote(site))
+        call = unquote(call)
+
+        match = re.match(r"web/lists\(guid'([^']+)'\)/(?:RootFolder|items\((\d+)\)/Folder)/Files/Add\(url='(.*)', ?overwrite=true\)$", call)
+        if match:
+            parent = store.items['root']
+            if match.group(2):
+                parent = store.items[store.list_items[match.group(2)]]
+            name = match.group(3).replace("''", "'")
+            h = QuickXORHash()
+            size = self.receive(req, [h])
+            item = self.new_file(store, parent, name, size, h.finalize())
+            return Response(200, {'d': {
+                '__metadata': {'uri': "{}sites/{}/_api/web/GetFileById('{}')".format(self.base_url, quote(store.owner), item['id'])},
+                'Name': name,
+                'Length': str(size),
+                'UniqueId': item['id'],
+            }})
+
+        match = re.match(r"web/GetFileById\('+([^']+)'+\)/(StartUpload|ContinueUpload|FinishUpload)\(uploadId=guid'([^']+)'(?:, ?fileOffset=(\d+))?\)$", call)
+        if match:
+            (item_id, action, guid, offset) = match.groups()
+            item = store.items.get(item_id)
+            if not item:
+                req.read()
+                return _error(404, 'itemNotFound')
+            with self.lock:
+                upload = self.sessions.setdefault(guid, {'received': 0, 'hash': QuickXORHash()})
+            if int(offset or 0) != upload['received']:
+                req.read()
+                return _error(400, 'invalidOffset')
+            upload['received'] += self.receive(req, [upload['hash']])
+            if action != 'FinishUpload':
+                return Response(200, {'d': {action: str(upload['received'])}})
+            with self.lock:
+                self.sessions.pop(guid, None)
+                item['size'] = upload['received']
+                item['_hash'] = upload['hash'].finalize()
+            return Response(200, {'d': {'Name': item['name'], 'Length': str(item['size']), 'UniqueId': item['id']}})
+
+        req.read()
+        return _error(400, 'invalidRequest', 'Unsupported SharePoint call')
+
+    # Google
+
+    def google_store(self):
+        with self.lock:
+            if 'google' not in self.stores:
+                self.stores['google'] = self._synthetic_store('google', 'upload@google', self.seed)
+            return self.stores['google']
+
+    def google_file(self, item):
+        obj = {
+            'id': item['id'],
+            'name': item['name'],
+            'parents': [item['parentReference'].get('id', '')],
+        }
+        if 'folder' in item:
+            obj['mimeType'] = 'application/vnd.google-apps.folder'
+        else:
+            obj['mimeType'] = item.get('_mime', 'application/octet-stream')
+            obj['size'] = str(item['size'])
+            obj['md5Checksum'] = item.get('_md5') or self.digest(item['size'], 'md5')
+        return obj
+
+    def google_files(self, req):
+        store = self.google_store()
+        if req.method == 'GET':
+            query = req.param('q', '')
+            name = re.search(r"name = '((?:[^'\\]|\\.)*)'", query)
+            parent = re.search(r"'([^']+)' in parents", query)
+            with self.lock:
+                if name:
+                    found = store.child(parent.group(1) if parent else 'root', name.group(1).replace("\\'", "'"))
+                    files = [found] if found else []
+                else:
+                    files = list(store.items.values())
+                return Response(200, {'files': [self.google_file(x) for x in files]})
+
+        payload = req.json()
+        parent = store.items.get((payload.get('parents') or ['root'])[0])
+        if not parent:
+            return _error(404, 'notFound')
+        if payload.get('mimeType') == 'application/vnd.google-apps.folder':
+            with self.lock:
+                item = store.add({
+                    'id': uuid.uuid4().hex,
+                    'name': payload['name'],
+                    'size': 0,
+                    'folder': {},
+                    'parentReference': {'driveId': 'google', 'id': parent['id']},
+                })
+        else:
+            item = self.new_file(store, parent, payload['name'], 0, None, payload.get('modifiedTime'))
+            item['_md5'] = hashlib.md5().hexdigest()
+        return Response(200, self.google_file(item))
+
+    def google_upload(self, req, file_id=None):
+        store = self.google_store()
+        upload_id = req.param('upload_id')
+        if req.method in ('POST', 'PATCH') and not upload_id:
+            payload = req.json()
+            if file_id:
+                target = store.items.get(file_id)
+                if not target:
+                    return _error(404, 'notFound')
+                parent = store.items[target['parentReference']['id']]
+                name = target['name']
+            else:
+                parent = store.items.get((payload.get('parents') or ['root'])[0])
+                name = payload['name']
+            upload_id = uuid.uuid4().hex
+            with self.lock:
+                self.sessions[upload_id] = {
+                    'parent': parent,
+                    'name': name,
+                    'mtime': payload.get('modifiedTime'),
+                    'mime': payload.get('mimeType'),
+                    'received': 0,
+                    'hash': hashlib.md5(),
+                }
+            return Response(200, b'', {
+                'Location': '{}upload/drive/v3/files?uploadType=resumable&upload_id={}'.format(self.base_url, upload_id),
+            })
+
+        with self.lock:
+            upload = self.sessions.get(upload_id)
+        if not upload:
+            req.read()
+            return _error(404, 'notFound')
+
+        match = re.match(r'bytes (?:(\d+)-(\d+)|\*)/(\d+)$', req.headers.get('Content-Range', ''))
+        if not match:
+            req.read()
+            return _error(400, 'badRequest')
+        total = int(match.group(3))
+        if match.group(1) is not None:
+            if int(match.group(1)) != upload['received']:
+                req.read()
+                return self._google_incomplete(upload)
+            upload['received'] += self.receive(req, [upload['hash']])
+
+        if upload['received'] < total:
+            return self._google_incomplete(upload)
+
+        with self.lock:
+            self.sessions.pop(upload_id, None)
+        item = self.new_file(store, upload['parent'], upload['name'], total, None, upload['mtime'])
+        item['_md5'] = upload['hash'].hexdigest()
+        if upload['mime']:
+            item['_mime'] = upload['mime']
+        return Response(200, self.google_file(item))
+
+    def _google_incomplete(self, upload):
+        headers = {}
+        if upload['received']:
+            headers['Range'] = 'bytes=0-{}'.format(upload['received'] - 1)
+        return Response(308, b'', headers)
+
+    # Box
+
+    def box_user(self, req):
+        login = req.headers.get('As-User')
+        with self.lock:
+            for user in self.users.values():
+                if user['_box_id'] == login:
+                    login = user['userPrincipalName']
+        return self.box_store(login or 'service@box')
+
+    def box_store(self, login):
+        user, store = self.graph_store(login)
+        box_id = 'box-' + user['_box_id']
+        with self.lock:
+            if box_id not in self.stores:
+                # Box uses numeric IDs and calls the root folder 0
+                source = self._synthetic_store(box_id, user['userPrincipalName'], self.seed + int(user['_box_id']) + 1000)
+                ids = {'root': '0'}
+                for (n, item_id) in enumerate(source.items, 1):
+                    ids.setdefault(item_id, str(n))
+                items = {}
+                for item in source.items.values():
+                    item = dict(item)
+                    item['id'] = ids[item['id']]
+                    item['parentReference'] = dict(item['parentReference'])
+                    if 'id' in item['parentReference']:
+                        item['parentReference']['id'] = ids[item['parentReference']['id']]
+                    items[item['id']] = item
+                self.stores[box_id] = Store(box_id, user['userPrincipalName'], items)
+            return user, self.stores[box_id]
+
+    def box_object(self, user, store, item):
+        obj = {
+            'type': 'folder' if 'folder' in item else 'file',
+            'id': item['id'],
+            'name': item['name'] if item['id'] != '0' else 'All Files',
+            'etag': str(item['_gen']),
+            'size': item['size'],
+            'modified_at': item.get('fileSystemInfo', {}).get('lastModifiedDateTime', '2019-09-19T12:00:00Z'),
+            'content_modified_at': item.get('fileSystemInfo', {}).get('lastModifiedDateTime', '2019-09-19T12:00:00Z'),
+            'owned_by': {'type': 'user', 'id': user['_box_id'], 'login': user['userPrincipalName']},
+        }
+        if 'id' in item['parentReference']:
+            obj['parent'] = {'type': 'folder', 'id': item['parentReference']['id']}
+        if 'file' in item:
+            obj['sha1'] = self.digest(item['size'], 'sha1')
+        return obj
+
+    def box_users(self, req):
+        login = req.param('filter_term') or 'service@box'
+        user, store = self.graph_store(login)
+        entry = {'type': 'user', 'id': user['_box_id'], 'login': user['userPrincipalName'], 'name': user['displayName']}
+        return Response(200, {'entries': [entry], 'total_count': 1, 'offset': 0, 'limit': 100})
+
+    def box_folder(self, req, folder_id, rest=None):
+        user, store = self.box_user(req)
+        folder = store.items.get(folder_id)
+        if not folder or 'folder' not in folder:
+            return Response(404, {'type': 'error', 'status': 404, 'code': 'not_found'})
+        if not rest:
+            return Response(200, self.box_object(user, store, folder))
+        offset = int(req.param('offset') or 0)
+        limit = int(req.param('limit') or 100)
+        with self.lock:
+            children = [store.items[x] for x in store.children.get(folder_id, {}).values()]
+        return Response(200, {
+            'entries': [self.box_object(user, store, x) for x in children[offset:offset + limit]],
+            'total_count': len(children),
+            'offset': offset,
+            'limit': limit,
+        })
+
+    def box_file(self, req, file_id, rest=None):
+        user, store = self.box_user(req)
+        item = store.items.get(file_id)
+        if not item or 'file' not in item:
+            return Response(404, {'type': 'error', 'status': 404, 'code': 'not_found'})
+        if rest:
+            return Response(302, b'', {'Location': '{}download/{}/{}'.format(self.base_url, store.id, file_id)})
+        return Response(200, self.box_object(user, store, item))
+
+    # Routing
+
+    ROUTES = [
+        ('POST', r'/_?token', 'token'),
+        ('POST', r'/oauth2/token', 'token'),
+        ('POST', r'/[^/]+/oauth2/(?:v2\.0/)?token', 'token'),
+        ('GET', r'/download/(?P<drive>[^/]+)/(?P<item>[^/]+)', 'download_content'),
+        ('PUT|DELETE', r'/graph-upload/(?P<session>[^/]+)', 'graph_upload'),
+        ('POST', r'/v1\.0/\$batch', 'graph_batch'),
+        ('GET', r'/v1\.0/users/(?P<user>[^/]+)', 'graph_user'),
+        ('GET', r'/v1\.0/users/(?P<user>[^/]+)/drives?', 'graph_user_drives'),
+        ('GET', r'/v1\.0/drives/(?P<drive>[^/]+)', 'graph_drive'),
+        ('GET', r'/v1\.0/drives/(?P<drive>[^/]+)/root', 'graph_root'),
+        ('GET', r'/v1\.0/drives/(?P<drive>[^/]+)/root/delta', 'graph_delta'),
+        ('.*', r'/v1\.0/drives/(?P<drive>[^/]+)/items/(?P<item>[^/:]+)(?::/(?P<path>.+?):)?(?P<rest>/.*)?', 'graph_items'),
+        ('POST', r'/sites/(?P<site>[^/]+)/_api/(?P<call>.+)', 'sharepoint'),
+        ('GET|POST', r'/drive/v3/files', 'google_files'),
+        ('POST|PUT', r'/upload/drive/v3/files', 'google_upload'),
+        ('PATCH', r'/upload/drive/v3/files/(?P<file_id>[^/]+)', 'google_upload'),
+        ('GET', r'/2\.0/users', 'box_users'),
+        ('GET', r'/2\.0/folders/(?P<folder_id>\d+)(?P<rest>/items)?', 'box_folder'),
+        ('GET', r'/2\.0/files/(?P<file_id>\d+)(?P<rest>/content)?', 'box_file'),
+    ]
+
+    def dispatch(self, req):
+        for (methods, pattern, name) in self.ROUTES:
+            if not re.fullmatch(methods, req.method):
+                continue
+            match = re.fullmatch(pattern, req.path)
+            if match:
+                return getattr(self, name)(req, **match.groupdict())
+        req.read()
+        return _error(404, 'notFound', 'No route for {} {}'.format(req.method, req.path))
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, fmt, *args):
+        self.server.cloud.logger.debug(fmt, *args)
+
+    def handle_one_request(self):
+        try:
+            super(FakeHandler, self).handle_one_request()
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def _handle(self):
+        cloud = self.server.cloud
+        parsed = urlsplit(self.path)
+        req = Request(self.command, parsed.path, parse_qs(parsed.query), self.headers, rfile=self.rfile)
+
+        if parsed.path == '/_stats':
+            with cloud.lock:
+                stats = {'{} {}'.format(*k): v for (k, v) in cloud.stats.items()}
+            return self._send(Response(200, stats))
+
+        is_token = 'token' in parsed.path.rsplit('/', 1)[-1]
+        response = None
+        if not is_token:
+            response = cloud.inject()
+        if response:
+            # Don't leave the body in the connection
+            if int(self.headers.get('Content-Length', 0)) > CHUNK_SIZE:
+                self.close_connection = True
+            else:
+                req.read()
+        else:
+            try:
+                response = cloud.dispatch(req)
+            except Exception:
+                cloud.logger.exception('Error handling %s %s', self.command, self.path)
+                response = _error(500, 'generalException')
+                self.close_connection = True
+
+        with cloud.lock:
+            cloud.stats[(self.command, response.status)] += 1
+        self._send(response)
+
+    def _send(self, response):
+        cloud = self.server.cloud
+        body = response.body
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode('utf-8')
+            response.headers['Content-Type'] = 'application/json'
+        if isinstance(body, bytes):
+            response.headers['Content-Length'] = str(len(body))
+            body = [body] if body else []
+
+        if getattr(response, 'truncated', False):
+            self.close_connection = True
+
+        self.send_response(response.status)
+        for (k, v) in response.headers.items():
+            self.send_header(k, v)
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+
+        if self.command == 'HEAD':
+            return
+        start = time.monotonic()
+        sent = 0
+        for chunk in body:
+            self.wfile.write(chunk)
+            sent += len(chunk)
+            cloud.pace(start, sent)
+        with cloud.lock:
+            cloud.stats[('bytes', 'sent')] += sent
+
+    do_GET = _handle
+    do_POST = _handle
+    do_PUT = _handle
+    do_PATCH = _handle
+    do_DELETE = _handle
+    do_HEAD = _handle
+
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, **kwargs):
+        super(FakeServer, self).__init__((host, port), FakeHandler)
+        self.url = 'http://{}:{}/'.format(*self.server_address)
+        self.cloud = FakeCloud(self.url, **kwargs)
+
+    def start(self):
+        ''' Serve from a background thread. '''
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a fake Graph/SharePoint/Google/Box API for offline testing')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--items', type=int, default=1000, help='Number of synthetic items per drive')
+    parser.add_argument('--depth', type=int, default=8, help='Maximum folder depth')
+    parser.add_argument('--name-length', type=int, default=24, help='Mean filename length, in characters')
+    parser.add_argument('--max-size', type=int, default=64 * 1024 * 1024, help='Largest synthetic file, in bytes')
+    parser.add_argument('--page-size', type=int, default=200, help='Items per page of listings')
+    parser.add_argument('--latency', type=float, default=0, help='Seconds added to each API request')
+    parser.add_argument('--bandwidth', type=int, default=0, help='Bytes/second per transfer (0 for unlimited)')
+    parser.add_argument('--error-rate', type=float, default=0, help='Fraction of requests that get a 429 or 503')
+    parser.add_argument('--drop-rate', type=float, default=0, help='Fraction of downloads cut off partway through')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After sent with 429s')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+    server = FakeServer(
+        args.host,
+        args.port,
+        items=args.items,
+        depth=args.depth,
+        name_length=args.name_length,
+        max_size=args.max_size,
+        page_size=args.page_size,
+        latency=args.latency,
+        bandwidth=args.bandwidth,
+        error_rate=args.error_rate,
+        drop_rate=args.drop_rate,
+        retry_after=args.retry_after,
+        seed=args.seed,
+    )
+    print('Serving on {}'.format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+
+# This file is part of ODM and distributed under the terms of the
+# MIT license. See COPYING.
+
+import argparse
+import copy
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from odm import __version__, metadata as odm_metadata, quickxorhash, util
+from odm.db import Database
+from odm.libexec import odm_list
+from odm.ms365 import Drive
+from odm.onedriveclient import OneDriveClient
+
+from benchmarks.synthetic import create_filetree, generate_items
+
+
+class FakeClient(OneDriveClient):
+    ''' Just enough of a client to run the offline code paths. '''
+
+    def __init__(self, delta_items=None):
+        self.config = {}
+        self.logger = logging.getLogger(__name__)
+        self.hash_cache = None
+        self.delta_items = delta_items or []
+
+    def get_list(self, path):
+        if path.endswith('/root'):
+            return {'id': 'root', 'name': 'root', 'parentReference': {'driveId': 'b!benchmark'}}
+        return None
+
+    def iter_pages(self, path, page_size=None, prefetch=True):
+        page_size = page_size or 200
+        for i in range(0, max(len(self.delta_items), 1), page_size):
+            # Drive.delta modifies the items, so hand out fresh ones each time
+            page = {'value': copy.deepcopy(self.delta_items[i:i + page_size])}
+            if i + page_size >= len(self.delta_items):
+                page['@odata.deltaLink'] = 'https://graph.microsoft.com/v1.0/drives/b!benchmark/root/delta?token=benchmark'
+            yield page
+
+
+def bench_quickxorhash(args, ctx):
+    results = []
+    data = os.urandom(args.hash_size * 1024 * 1024)
+    for backend in quickxorhash.available_backends():
+        def run(backend=backend):
+            h = quickxorhash.QuickXORHash(backend)
+            with memoryview(data) as view:
+                start = time.perf_counter()
+                for offset in range(0, len(data), quickxorhash.CHUNK_SIZE):
+                    h.update(view[offset:offset + quickxorhash.CHUNK_SIZE])
+                h.finalize()
+                return time.perf_counter() - start
+        results.append(('quickxorhash.{}'.format(backend), len(data), 'bytes', run))
+
+    path = os.path.join(ctx['tmpdir'], 'hashme')
+    with open(path, 'wb') as f:
+        f.write(data)
+
+    def run_parallel():
+        start = time.perf_counter()
+        quickxorhash.hash_file_parallel(path)
+        return time.perf_counter() - start
+    results.append(('quickxorhash.parallel', len(data), 'bytes', run_parallel))
+    return results
+
+
+def bench_expand_path(args, ctx):
+    client = ctx['client']
+    items = ctx['metadata']['items']
+
+    def run(fs_safe):
+        start = time.perf_counter()
+        for item_id in items:
+            client.expand_path(item_id, items, fs_safe)
+        return time.perf_counter() - start
+
+    return [
+        ('expand_path', len(items), 'items', lambda: run(False)),
+        ('expand_path.fs_safe', len(items), 'items', lambda: run(True)),
+    ]
+
+
+def bench_path_index(args, ctx):
+    items = ctx['metadata']['items']
+
+    def run(fs_safe):
+        start = time.perf_counter()
+        paths = odm_metadata.PathIndex(items)
+        lookup = paths.fs_path if fs_safe else paths.path
+        for item_id in items:
+            lookup(item_id)
+        return time.perf_counter() - start
+
+    return [
+        ('path_index', len(items), 'items', lambda: run(False)),
+        ('path_index.fs_safe', len(items), 'items', lambda: run(True)),
+    ]
+
+
+def bench_chunky_path(args, ctx):
+    names = [x['name'] for x in ctx['metadata']['items'].values()]
+    # Make sure the slow path is represented
+    names.extend([x * 20 for x in names[:len(names) // 10]])
+
+    def run():
+        start = time.perf_counter()
+        for name in names:
+            util.chunky_path(name)
+        return time.perf_counter() - start
+
+    return [('chunky_path', len(names), 'names', run)]
+
+
+def bench_delta(args, ctx):
+    items = ctx['metadata']['items']
+    changed = []
+    for item_id in items:
+        item = copy.deepcopy(items[item_id])
+        item['name'] += ' (renamed)'
+        changed.append(item)
+    client = FakeClient(changed)
+    drive = Drive(client, {'id': 'b!benchmark'})
+
+    def run():
+        base = copy.deepcopy(ctx['metadata'])
+        base['token'] = 'benchmark'
+        start = time.perf_counter()
+        drive.delta(base, include_permissions=False)
+        return time.perf_counter() - start
+
+    return [('drive.delta', len(changed), 'items', run)]
+
+
+def bench_split(args, ctx):
+    def run():
+        metadata = copy.deepcopy(ctx['metadata'])
+        splitdir = tempfile.mkdtemp(dir=ctx['tmpdir'])
+        start = time.perf_counter()
+        odm_list.split_metadata(metadata, 500, None, os.path.join(splitdir, 'split'), ctx['logger'])
+        elapsed = time.perf_counter() - start
+        shutil.rmtree(splitdir)
+        return elapsed
+
+    return [('odm_list.split', len(ctx['metadata']['items']), 'items', run)]
+
+
+def bench_clean_filetree(args, ctx):
+    extraneous = max(1, len(ctx['metadata']['items']) // 100)
+
+    def run():
+        filetree = tempfile.mkdtemp(dir=ctx['tmpdir'])
+        create_filetree(ctx['client'], ctx['metadata'], filetree, extraneous, args.seed)
+        start = time.perf_counter()
+        odm_list.clean_filetree(odm_metadata.PathIndex(ctx['metadata']['items']), ctx['metadata'], filetree, ctx['logger'])
+        elapsed = time.perf_counter() - start
+        shutil.rmtree(filetree)
+        return elapsed
+
+    return [('odm_list.clean_filetree', len(ctx['metadata']['items']), 'items', run)]
+
+
+def bench_db(args, ctx):
+    items = ctx['metadata']['items']
+    path = os.path.join(ctx['tmpdir'], 'bench.lmdb')
+
+    def run_write():
+        for fname in (path, path + '-lock'):
+            if os.path.exists(fname):
+                os.unlink(fname)
+        db = Database(path)
+        start = time.perf_counter()
+        for item_id in items:
+            db.write(item_id, items[item_id])
+        elapsed = time.perf_counter() - start
+        db.close()
+        return elapsed
+
+    def run_iterate():
+        db = Database(path)
+        start = time.perf_counter()
+        for key, value in db.iterate():
+            pass
+        elapsed = time.perf_counter() - start
+        db.close()
+        return elapsed
+
+    return [
+        ('db.write', len(items), 'items', run_write),
+        ('db.iterate', len(items), 'items', run_iterate),
+    ]
+
+
+BENCHMARKS = {
+    'quickxorhash': bench_quickxorhash,
+    'expand_path': bench_expand_path,
+    'path_index': bench_path_index,
+    'chunky_path': bench_chunky_path,
+    'delta': bench_delta,
+    'split': bench_split,
+    'clean-filetree': bench_clean_filetree,
+    'db': bench_db,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark ODM hot paths against synthetic data')
+    parser.add_argument('--items', type=int, default=10000, help='Number of synthetic drive items')
+    parser.add_argument('--depth', type=int, default=8, help='Maximum folder depth')
+    parser.add_argument('--name-length', type=int, default=24, help='Mean filename length, in characters')
+    parser.add_argument('--hash-size', type=int, default=64, help='MiB of data to hash')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs per benchmark')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', help='Comma-separated list of benchmarks ({})'.format(', '.join(BENCHMARKS)))
+    parser.add_argument('--output', help='Write results to this file instead of stdout')
+    args = parser.parse_args()
+
+    selected = args.only.split(',') if args.only else list(BENCHMARKS)
+    for name in selected:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark {}'.format(name))
+
+    tmpdir = tempfile.mkdtemp(prefix='odm-bench-')
+    ctx = {
+        'client': FakeClient(),
+        'logger': logging.getLogger('odm.benchmarks'),
+        'metadata': generate_items(args.items, args.depth, args.name_length, seed=args.seed),
+        'tmpdir': tmpdir,
+    }
+
+    results = []
+    try:
+        for name in selected:
+            for (bench, ops, unit, run) in BENCHMARKS[name](args, ctx):
+                print('Running {}'.format(bench), file=sys.stderr)
+                runs = [run() for _ in range(args.repeat)]
+                results.append({
+                    'name': bench,
+                    'ops': ops,
+                    'unit': unit,
+                    'runs': runs,
+                    'best': min(runs),
+                    'median': statistics.median(runs),
+                    'rate': ops / max(min(runs), 1e-9),
+                })
+    finally:
+        shutil.rmtree(tmpdir)
+
+    output = {
+        'odm_version': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'parameters': vars(args),
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+    else:
+        print(json.dumps(output, indent=2))
+
+
+if __name__ == '__main__':
+    main()
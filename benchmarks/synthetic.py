@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+# This file is part of ODM and distributed under the terms of the
+# MIT license. See COPYING.
+
+import base64
+import os
+import random
+
+# Mostly ASCII, with enough multibyte characters to exercise the code that
+# deals with filenames longer than 255 bytes.
+ALPHABET = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 _-.' + 'éøßж漢字🙂'
+
+
+def _name(rng, length):
+    return ''.join(rng.choice(ALPHABET) for _ in range(length)).strip() or 'x'
+
+
+def generate_items(count, depth=8, name_length=24, folder_ratio=0.1, seed=0, drive_id='b!benchmark'):
+    ''' Generate `count` items that look like the output of Drive.delta(). '''
+    rng = random.Random(seed)
+
+    root = {
+        'id': 'root',
+        'name': 'root',
+        'folder': {'childCount': 0},
+        'parentReference': {'driveId': drive_id},
+        'size': 0,
+    }
+    items = {'root': root}
+    folders = [('root', 0)]
+
+    for i in range(1, count):
+        parent_id, parent_depth = rng.choice(folders)
+        item_id = '{:016X}!{}'.format(seed, i)
+        item = {
+            'id': item_id,
+            'name': _name(rng, max(1, int(rng.gauss(name_length, name_length / 4)))),
+            'parentReference': {
+                'driveId': drive_id,
+                'id': parent_id,
+            },
+            'fileSystemInfo': {
+                'createdDateTime': '2019-09-19T12:00:00Z',
+                'lastModifiedDateTime': '2019-09-19T12:00:00Z',
+            },
+        }
+
+        if parent_depth < depth and rng.random() < folder_ratio:
+            item['folder'] = {'childCount': 0}
+            item['size'] = 0
+            folders.append((item_id, parent_depth + 1))
+        else:
+            item['size'] = int(rng.lognormvariate(10, 2))
+            item['file'] = {
+                'mimeType': 'application/octet-stream',
+                'hashes': {
+                    'quickXorHash': base64.b64encode(rng.getrandbits(160).to_bytes(20, 'little')).decode('utf-8'),
+                },
+            }
+
+        items[item_id] = item
+
+    return {'items': items}
+
+
+def create_filetree(client, metadata, path, extraneous=0, seed=0):
+    ''' Create empty files for every file in the metadata, plus some that
+    shouldn't be there. '''
+    rng = random.Random(seed)
+    items = metadata['items']
+    for item_id in items:
+        if 'file' not in items[item_id]:
+            continue
+        dest = os.path.join(path, client.expand_path(item_id, items, True))
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        open(dest, 'wb').close()
+
+    for i in range(extraneous):
+        open(os.path.join(path, 'extraneous-{}-{}'.format(i, rng.getrandbits(32))), 'wb').close()
@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+
+# This file is part of ODM and distributed under the terms of the
+# MIT license. See COPYING.
+
+import asyncio
+import functools
+import json
+import logging
+import os
+import random
+import time
+
+from datetime import datetime
+from urllib.parse import quote
+
+import requests
+import requests_toolbelt
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from odm import quickxorhash
+from odm.metrics import METRICS, request_size
+from odm.ms365 import DeltaEnumeration, permissions_path, permissions_result
+from odm.tokencache import REFRESH_MARGIN
+from odm.util import HashingWriter, PartFile
+
+from . import __version__
+
+
+class AsyncResponse(object):
+    ''' Enough of the requests.Response interface for a fully read aiohttp
+    response. '''
+
+    def __init__(self, url, status, headers, content):
+        self.url = url
+        self.status_code = status
+        self.headers = requests.structures.CaseInsensitiveDict(headers)
+        self.content = content
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise requests.exceptions.HTTPError(
+                '{} Error for url: {}'.format(self.status_code, self.url),
+                response=self,
+            )
+
+
+def _read_chunk(src, start, size):
+    with open(src, 'rb') as f:
+        f.seek(start)
+        return f.read(size)
+
+
+def _save_progress(part, state, completed):
+    if not completed:
+        # Make sure the sidecar never claims more than actually made it to
+        # disk.
+        part.sync()
+    state['written'] = part.size()
+    part.save(state)
+
+
+class AsyncOneDriveClient:
+    ''' asyncio counterpart to the bulk transfer parts of OneDriveClient, so
+    that one process can have many requests in flight. Authentication,
+    throttling and retry settings are borrowed from the synchronous client's
+    session. '''
+
+    def __init__(self, client, per_host=None):
+        if aiohttp is None:
+            raise ImportError('aiohttp is required for the asyncio client')
+        self.client = client
+        self.config = client.config
+        self.msgraph = client.msgraph
+        self.logger = logging.getLogger(__name__)
+        self.timeout = self.config.get('timeout', 60)
+        self.per_host = per_host or self.config['microsoft'].get('async_per_host', 64)
+        self.session = None
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=0, limit_per_host=self.per_host),
+            headers={
+                'User-Agent': 'odm/{} ({})'.format(__version__, self.config['microsoft']['client_id']),
+            },
+        )
+        return self
+
+    async def __aexit__(self, *args):
+        await self.session.close()
+
+    async def _run(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+    async def _token(self):
+        token = self.msgraph.token
+        if token.get('expires_at', 0) < datetime.now().timestamp() + REFRESH_MARGIN:
+            token = await self._run(self.msgraph.refresh_token, None)
+        return token
+
+    async def request(self, method, url, auth=True, **kwargs):
+        if not url.lower().startswith('http'):
+            url = ''.join([self.msgraph.baseurl, url])
+
+        kwargs.setdefault('allow_redirects', False)
+        kwargs['timeout'] = aiohttp.ClientTimeout(total=kwargs.get('timeout', self.timeout))
+        headers = dict(kwargs.pop('headers', {}))
+        if 'json' in kwargs:
+            # Serialize it here so that the body can be measured
+            kwargs['data'] = json.dumps(kwargs.pop('json')).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        sent = request_size(kwargs)
+
+        attempt = 0
+        max_attempts = self.msgraph.max_attempts
+        rejected = False
+        while attempt < max_attempts:
+            attempt += 1
+            delay = random.uniform(min(30, 2 ** attempt), min(300, 3 * 2 ** attempt))
+            result = None
+            if self.msgraph.throttle:
+                METRICS.record_sleep('graph', 'budget', await self._run(self.msgraph.throttle.acquire))
+            if auth:
+                token = await self._token()
+                headers['Authorization'] = 'Bearer ' + token['access_token']
+
+            start = time.monotonic()
+            try:
+                async with self.session.request(method, url, headers=headers, **kwargs) as resp:
+                    result = AsyncResponse(url, resp.status, resp.headers, await resp.read())
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                METRICS.record('graph', method, url, None, time.monotonic() - start)
+                self.logger.info('Retryable aiohttp error', exc_info=e)
+            else:
+                METRICS.record('graph', method, url, result, time.monotonic() - start, sent)
+                if result.status_code in (400, 500):
+                    self.logger.info(result.content)
+
+                if result.status_code == 401 and auth and not rejected:
+                    # Same as OneDriveSession.request(): get a new token and
+                    # try again straight away, but only once.
+                    self.logger.debug('Authorization token was rejected')
+                    rejected = True
+                    await self._run(self.msgraph._reject_token, token)
+                    delay = 0
+                elif result.status_code == 429:
+                    self.logger.debug('throttled')
+                    if 'retry-after' in result.headers:
+                        delay = result.headers['retry-after']
+                    if self.msgraph.throttle:
+                        self.msgraph.throttle.pause(delay)
+                elif result.status_code not in (500, 503, 504):
+                    if self.msgraph.throttle:
+                        self.msgraph.throttle.observe(result.headers)
+                    return result
+
+            if attempt < max_attempts:
+                self.logger.info('Sleeping for %d seconds before retrying', float(delay))
+                METRICS.record_retry('graph')
+                METRICS.record_sleep('graph', 'throttle' if result is not None and result.status_code == 429 else 'retry', delay)
+                await asyncio.sleep(float(delay))
+
+        raise requests.exceptions.RetryError('maximum retries exceeded')
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def iter_list(self, path):
+        while path:
+            page = await self.get(path)
+            if page.status_code == 404:
+                return
+            page.raise_for_status()
+            decoded = page.json()
+            for item in decoded.get('value', []):
+                yield item
+            path = decoded.get('@odata.nextLink')
+
+    async def get_list(self, path):
+        result = None
+        while path:
+            page_result = await self.get(path)
+
+            if page_result.status_code == 302:
+                return {
+                    'location': page_result.headers['location']
+                }
+            elif page_result.status_code == 404:
+                return None
+
+            page_result.raise_for_status()
+            decoded = page_result.json()
+
+            if result:
+                result['value'].extend(decoded['value'])
+            else:
+                result = decoded
+
+            for key in decoded:
+                if key not in ['value', '@odata.nextLink']:
+                    result[key] = decoded[key]
+
+            path = decoded.get('@odata.nextLink')
+            result.pop('@odata.nextLink', None)
+
+        return result
+
+    async def iter_pages(self, path):
+        while path:
+            page_result = await self.get(path)
+            if page_result.status_code == 404:
+                return
+            page_result.raise_for_status()
+            page = page_result.json()
+            path = page.get('@odata.nextLink')
+            yield page
+
+    async def _download(self, url, dest, calculate_hash=False, size=None):
+        ''' Download url to dest via dest.part, resuming a previous partial
+        download if the server still has the same version of the file. '''
+        destdir = os.path.dirname(dest)
+        if not os.path.exists(destdir):
+            os.makedirs(destdir, 0o0755, exist_ok=True)
+
+        part = PartFile(dest)
+        headers = {}
+        state = await self._run(part.load)
+        offset = 0
+        if state.get('etag') and 'segments' not in state:
+            offset = min(part.size(), state.get('written', part.size()))
+        if offset:
+            headers['Range'] = 'bytes={}-'.format(offset)
+            headers['If-Range'] = state['etag']
+
+        h = None
+        timeout = aiohttp.ClientTimeout(total=self.timeout * 20)
+        try:
+            # Download links are pre-authenticated
+            async with self.session.get(url, headers=headers, timeout=timeout) as r:
+                r.raise_for_status()
+                if r.content_type.startswith('multipart/'):
+                    decoder = requests_toolbelt.MultipartDecoder(await r.read(), r.headers['content-type'])
+                    for mime_part in decoder.parts:
+                        part_type = mime_part.headers[b'content-type'].decode('utf-8')
+                        with open('{}.{}'.format(dest, part_type.split(';')[0].replace('/', '_')), 'wb') as f:
+                            f.write(mime_part.content)
+                    return True
+
+                if r.status == 206:
+                    self.logger.info('Resuming download of %s at byte %d', dest, offset)
+                else:
+                    # The file changed, or the server ignored the range
+                    offset = 0
+                state = {'etag': r.headers.get('etag'), 'size': size}
+                if state['etag']:
+                    await self._run(part.save, state)
+
+                if calculate_hash and not offset:
+                    h = quickxorhash.QuickXORHash()
+
+                completed = False
+                f = await self._run(functools.partial(HashingWriter, part.path, h, offset=offset))
+                try:
+                    async for chunk in r.content.iter_chunked(1024 * 1024):
+                        # The writer might block if the disk is slow
+                        await self._run(f.write, chunk)
+                        METRICS.record_transfer('graph', 'down', len(chunk))
+                    completed = True
+                finally:
+                    await self._run(f.close)
+                    if state['etag']:
+                        await self._run(_save_progress, part, state, completed)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.logger.warning(e)
+            return None
+
+        await self._run(part.commit)
+
+        if not calculate_hash:
+            return True
+        if h is None:
+            # Part of the file came from an earlier attempt
+            return await self._run(self.client.hash_file, dest)
+        return h.finalize()
+
+    async def download_file(self, drive_id, file_id, dest, size=None):
+        url = await self.get_list('drives/{}/items/{}/content'.format(drive_id, file_id))
+
+        if url:
+            return await self._download(url['location'], dest, True, size)
+        else:
+            self.logger.error('Failed to fetch download link from API')
+            return None
+
+    async def delta(self, drive_id, base, include_permissions=True, on_page=None, checkpoint=None):
+        ''' Drive.delta(), with the permission lookups for each page made
+        concurrently. '''
+        enumeration = DeltaEnumeration(drive_id, base, on_page, checkpoint)
+
+        # Keep a bounded number of coroutines around at once
+        step = self.per_host * 4
+        while enumeration.next:
+            try:
+                async for page in self.iter_pages(enumeration.next):
+                    items = page['value']
+                    for i in range(0, len(items), step):
+                        chunk = items[i:i + step]
+                        permissions = [None] * len(chunk)
+                        if include_permissions:
+                            permissions = await asyncio.gather(*[
+                                self._item_permissions(item) for item in chunk
+                            ])
+                        for (item, perms) in zip(chunk, permissions):
+                            enumeration.merge_item(item, perms)
+                    enumeration.merged(page)
+            except requests.exceptions.HTTPError as e:
+                if e.response is None or e.response.status_code != 410:
+                    raise
+                enumeration.expired()
+            else:
+                enumeration.check_complete()
+
+        return enumeration.finish()
+
+    async def _item_permissions(self, item):
+        if 'deleted' in item:
+            return None
+        return permissions_result(item, await self.get(permissions_path(item)), self.logger)
+
+    async def _upload_file_simple(self, src, base_url):
+        data = await self._run(_read_chunk, src, 0, os.stat(src).st_size)
+        result = await self.request('PUT', base_url + 'content', data=data)
+        result.raise_for_status()
+        return result.json()
+
+    async def _upload_file_chunked(self, src, base_url, name):
+        # 10 megabytes
+        chunk_size = 1024 * 1024 * 10
+        stat = os.stat(src)
+
+        payload = {
+            'item': {
+                '@microsoft.graph.conflictBehavior': 'replace',
+                'name': name,
+            },
+        }
+
+        req_result = await self.request('POST', base_url + 'createUploadSession', json=payload)
+        req_result.raise_for_status()
+
+        upload_url = req_result.json()['uploadUrl']
+
+        start = 0
+        result = None
+        while not result:
+            size = min(chunk_size, stat.st_size - start)
+            end = start + size - 1
+
+            self.logger.debug('uploading bytes %d-%d/%d', start, end, stat.st_size)
+
+            data = await self._run(_read_chunk, src, start, size)
+            # Upload URLs are pre-authenticated
+            result = await self.request(
+                'PUT',
+                upload_url,
+                auth=False,
+                data=data,
+                headers={
+                    'Content-Range': 'bytes {}-{}/{}'.format(start, end, stat.st_size),
+                },
+                timeout=1200,
+            )
+            if result.status_code == 404:
+                self.logger.info('Invalid upload session')
+                return None
+            result.raise_for_status()
+            if result.status_code == 202:
+                start = int(result.json()['nextExpectedRanges'][0].split('-')[0])
+                result = None
+
+        return result.json()
+
+    async def upload_file(self, drive_id, parent_id, src, name):
+        # No leading or trailing whitespace
+        name = name.strip()
+
+        # There's not any obvious way to escape this character sequence, and
+        # if we do nothing the server returns "Bad request URL"
+        safe_name = name.replace('&#', '&_#')
+
+        base_url = 'drives/{}/items/{}:/{}:/'.format(drive_id, parent_id, quote(safe_name.encode('utf-8')))
+
+        try:
+            stat = os.stat(src)
+        except OSError:
+            return None
+
+        item = None
+        attempt = 0
+        while not item and attempt < 5:
+            attempt += 1
+            try:
+                # The documentation says 4 MB; they might actually mean MiB
+                if stat.st_size < 4 * 1000 * 1000:
+                    item = await self._upload_file_simple(src, base_url)
+                else:
+                    item = await self._upload_file_chunked(src, base_url, safe_name)
+            except (requests.exceptions.HTTPError, requests.exceptions.RetryError):
+                item = None
+                if attempt < 5:
+                    await asyncio.sleep(5)
+
+        if item:
+            payload = {
+                'fileSystemInfo': {
+                    'lastModifiedDateTime': datetime.fromtimestamp(stat.st_mtime).isoformat() + 'Z',
+                },
+            }
+            if name != safe_name:
+                payload['name'] = name
+                payload['@microsoft.graph.conflictBehavior'] = 'replace'
+            result = await self.request('PATCH', 'drives/{}/items/{}'.format(drive_id, item['id']), json=payload)
+            result.raise_for_status()
+            item = result.json()
+
+        return item
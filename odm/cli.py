@@ -6,12 +6,80 @@
 import argparse
 import logging
 import sys
+import time
 
 import yaml
 
 import boxsdk
 
-from odm import googledriveclient, onedriveclient
+from odm import googledriveclient, metrics, onedriveclient
+from odm.tokencache import REFRESH_MARGIN, TokenCache
+
+
+# Box access tokens last an hour if the response doesn't say otherwise
+BOX_TOKEN_LIFETIME = 3600
+
+
+def _odm_records(record):
+    return record.name.startswith('odm')
+
+
+def configure_logging(verbose):
+    ''' Configure the root logger. This is also used as the initializer for
+    worker processes, which don't inherit the parent's handlers. '''
+    logger = logging.getLogger()
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(name)s: %(message)s', '%Y-%m-%dT%H:%M:%S'))
+    if verbose == 0:
+        logger.setLevel(logging.WARNING)
+    elif verbose == 1:
+        logger.setLevel(logging.INFO)
+    else:
+        logger.setLevel(logging.DEBUG)
+
+    if verbose < 3:
+        handler.addFilter(_odm_records)
+
+    logger.addHandler(handler)
+
+
+class BoxAuth(boxsdk.JWTAuth):
+    ''' JWTAuth that shares its access token through the token cache and
+    replaces it shortly before it expires, rather than waiting for a request
+    to be rejected. '''
+
+    def __init__(self, token_cache=None, api_config=None, **kwargs):
+        self.token_cache = token_cache
+        self.cache_key = ('box', kwargs['client_id'], kwargs['enterprise_id'])
+        self.expires_at = 0
+        if token_cache:
+            token = token_cache.get(*self.cache_key)
+            if token:
+                kwargs['access_token'] = token['access_token']
+                self.expires_at = token.get('expires_at', 0)
+        super(BoxAuth, self).__init__(**kwargs)
+        if api_config:
+            # OAuth2 ignores its session's API config and uses the defaults
+            self._api_config = api_config
+
+    @property
+    def access_token(self):
+        access_token = self._access_token
+        if access_token and self.expires_at < time.time() + REFRESH_MARGIN:
+            (access_token, _) = self.refresh(access_token)
+        return access_token
+
+    def _execute_token_request(self, data, access_token, expect_refresh_token=True):
+        response = super(BoxAuth, self)._execute_token_request(data, access_token, expect_refresh_token)
+        lifetime = int(response['expires_in']) if 'expires_in' in response else BOX_TOKEN_LIFETIME
+        self.expires_at = time.time() + lifetime
+        if self.token_cache:
+            token = {
+                'access_token': response['access_token'],
+                'expires_at': self.expires_at,
+            }
+            self.token_cache.store(*self.cache_key, None, token, self.expires_at)
+        return response
 
 
 class CLI:
@@ -41,43 +109,54 @@ class CLI:
 
         self.config['args'] = self.args
 
-        # Configure root logger
-        logger = logging.getLogger()
-        handler = logging.StreamHandler(sys.stderr)
-        handler.setFormatter(logging.Formatter('%(asctime)s %(name)s: %(message)s', '%Y-%m-%dT%H:%M:%S'))
-        if self.args.verbose == 0:
-            logger.setLevel(logging.WARNING)
-        elif self.args.verbose == 1:
-            logger.setLevel(logging.INFO)
-        else:
-            logger.setLevel(logging.DEBUG)
-
-        if self.args.verbose < 3:
-            handler.addFilter(lambda x: x.name.startswith('odm'))
-
-        logger.addHandler(handler)
+        configure_logging(self.args.verbose)
 
         self.logger = logging.getLogger(__name__)
 
         self.logger.debug('Using config file %s', self.args.config)
 
+        metrics.configure(self.config)
+
+        try:
+            TokenCache.from_config(self.config)
+        except ValueError as e:
+            self.logger.critical('Invalid configuration: %s', e)
+            sys.exit(1)
+
         if client == 'google':
             self.client = googledriveclient.GoogleDriveClient(self.config)
         elif client == 'microsoft':
             self.client = onedriveclient.OneDriveClient(self.config)
         elif client == 'box':
-            auth = boxsdk.JWTAuth(
-                client_id=self.config['box']['clientID'],
-                client_secret=self.config['box']['clientSecret'],
-                enterprise_id=self.config['box']['enterpriseID'],
-                jwt_key_id=self.config['box']['appAuth']['publicKeyID'],
-                rsa_private_key_data=self.config['box']['appAuth']['privateKey'],
-                rsa_private_key_passphrase=self.config['box']['appAuth']['passphrase'],
+            box_config = self.config['box']
+            api_config = boxsdk.config.API()
+            if 'api_url' in box_config:
+                api_config.BASE_API_URL = box_config['api_url'] + '/2.0'
+                api_config.UPLOAD_URL = box_config['api_url'] + '/api/2.0'
+                api_config.OAUTH2_API_URL = box_config['api_url'] + '/oauth2'
+            network_layer = metrics.MetricsNetwork()
+
+            auth = BoxAuth(
+                token_cache=TokenCache.from_config(self.config),
+                client_id=box_config['clientID'],
+                client_secret=box_config['clientSecret'],
+                enterprise_id=box_config['enterpriseID'],
+                jwt_key_id=box_config['appAuth']['publicKeyID'],
+                rsa_private_key_data=box_config['appAuth']['privateKey'],
+                rsa_private_key_passphrase=box_config['appAuth']['passphrase'],
+                session=boxsdk.session.session.Session(network_layer=network_layer, api_config=api_config),
+                api_config=api_config,
             )
             session = boxsdk.session.session.AuthorizedSession(
                 auth,
+                network_layer=network_layer,
+                api_config=api_config,
                 default_headers={
                     'Box-Notifications': 'off',
                 },
             )
             self.client = boxsdk.Client(auth, session)
+
+    def log_metrics(self):
+        for line in metrics.METRICS.summary():
+            self.logger.info(line)
@@ -5,10 +5,17 @@
 
 import json
 import logging
+import os
+import threading
 
 import lmdb
 
 
+# (pid, path) -> Database, for Database.shared()
+_shared = {}
+_shared_lock = threading.Lock()
+
+
 class Database:
     def __init__(self, path, debug=False):
         self.logger = logging.getLogger(__name__)
@@ -25,6 +32,23 @@ class Database:
         self.cursor_txn = None
         self.iteration_finished = False
 
+    @classmethod
+    def shared(cls, path):
+        ''' Return this process's Database for path, opening it on first use.
+        An LMDB environment can only be opened once per process, so
+        everything in a process that needs the same file has to share it.
+        Forked children can neither use nor reopen their parent's
+        environment, so worker processes should be started with spawn or
+        forkserver. '''
+        key = (os.getpid(), os.path.realpath(path))
+        db = _shared.get(key)
+        if db is None:
+            with _shared_lock:
+                db = _shared.get(key)
+                if db is None:
+                    db = _shared[key] = cls(path)
+        return db
+
     def close(self):
         self.db.close()
 
@@ -45,19 +69,29 @@ class Database:
             self.cursor = None
             self.cursor_txn = None
 
-    def _write(self, key, value):
-        if self.debug:
-            self.logger.critical('Writing %s: %s', key, value)
+    def _write(self, pairs, deletes):
         with self.db.begin(write=True) as txn:
-            txn.put(key, value)
+            for (key, value) in pairs:
+                if self.debug:
+                    self.logger.critical('Writing %s: %s', key, value)
+                txn.put(key, value)
+            for key in deletes:
+                txn.delete(key)
 
     def write(self, key, value):
-        key = key.encode('utf-8')
-        value = json.dumps(value).encode('utf-8')
+        self.write_many([(key, value)])
+
+    def write_many(self, pairs, deletes=()):
+        ''' Write (and optionally delete) several keys in a single
+        transaction. '''
+        pairs = [(key.encode('utf-8'), json.dumps(value).encode('utf-8')) for (key, value) in pairs]
+        deletes = [key.encode('utf-8') for key in deletes]
+        if not pairs and not deletes:
+            return
         tries = 0
         while True:
             try:
-                self._write(key, value)
+                self._write(pairs, deletes)
                 return
             except lmdb.MapFullError:
                 self._reset_cursor()
@@ -68,6 +102,15 @@ class Database:
                 self.db.set_mapsize(new_map_size)
             tries += 1
 
+    def delete(self, key):
+        with self.db.begin(write=True) as txn:
+            txn.delete(key.encode('utf-8'))
+
+    def clear(self):
+        self._reset_cursor()
+        with self.db.begin(write=True) as txn:
+            txn.drop(self.db.open_db(txn=txn), delete=False)
+
     def update(self, key, value):
         old = self.read(key)
         old.update(value)
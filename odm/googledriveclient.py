@@ -3,10 +3,12 @@
 # This file is part of ODM and distributed under the terms of the
 # MIT license. See COPYING.
 
+import calendar
 import logging
 import os
 import random
 import requests
+import threading
 import time
 
 from datetime import datetime
@@ -16,13 +18,17 @@ import google.oauth2.service_account
 import google.auth.transport.requests
 
 from . import __version__
+from .hashcache import HashCache
+from .metrics import METRICS, request_size
+from .tokencache import REFRESH_MARGIN, TokenCache
 
 
 class GoogleDriveClient:
     def __init__(self, config):
-        self.baseurl = 'https://www.googleapis.com/'
+        self.baseurl = config['google'].get('base_url', 'https://www.googleapis.com/')
         self.config = config
         self.logger = logging.getLogger(__name__)
+        self.hash_cache = HashCache.from_config(config)
 
         cred_kwargs = {
             'subject': '{}@{}'.format(config['args'].upload_user, config['domain']),
@@ -44,13 +50,49 @@ class GoogleDriveClient:
             'User-Agent': 'odm/{}'.format(__version__),
         })
 
+        self.token_cache = TokenCache.from_config(config)
+        self._token_key = ('google', self.creds.service_account_email, None, cred_kwargs['subject'])
+        self._token_lock = threading.Lock()
+        if self.token_cache:
+            token = self.token_cache.get(*self._token_key)
+            if token:
+                self.creds.token = token['token']
+                self.creds.expiry = datetime.utcfromtimestamp(token['expires_at'])
+
+    def _token_expires(self):
+        if not self.creds.token or not self.creds.expiry:
+            return 0
+        # google-auth uses naive UTC datetimes
+        return calendar.timegm(self.creds.expiry.utctimetuple())
+
+    def _refresh_token(self):
+        # Refresh proactively instead of letting AuthorizedSession do it after
+        # the token has already been rejected.
+        with self._token_lock:
+            if self._token_expires() > time.time() + REFRESH_MARGIN:
+                return
+            self.logger.debug('Fetching fresh authorization token.')
+            self.creds.refresh(google.auth.transport.requests.Request())
+            if self.token_cache:
+                self.token_cache.store(*self._token_key, {'token': self.creds.token}, self._token_expires())
+
     def _request(self, verb, path, **kwargs):
         if self.baseurl not in path:
             path = ''.join([self.baseurl, path])
 
+        if self._token_expires() < time.time() + REFRESH_MARGIN:
+            self._refresh_token()
+
         kwargs['timeout'] = self.config.get('timeout', 60)
         kwargs['allow_redirects'] = False
-        return self.session.request(verb, path, **kwargs)
+        sent = request_size(kwargs)
+        start = time.monotonic()
+        result = None
+        try:
+            result = self.session.request(verb, path, **kwargs)
+            return result
+        finally:
+            METRICS.record('google', verb, path, result, time.monotonic() - start, sent)
 
     def request(self, verb, path, **kwargs):
         result = None
@@ -60,6 +102,7 @@ class GoogleDriveClient:
                 result = self._request(verb, path, **kwargs)
             except requests.exceptions.RequestException as e:
                 self.logger.warning(e)
+                METRICS.record_retry('google')
                 continue
 
             if result.status_code == 403 and attempt > 3:
@@ -70,6 +113,8 @@ class GoogleDriveClient:
                 # Jittered backoff
                 delay = random.uniform(0, min(300, 3 * 2 ** attempt))
                 self.logger.info('Throttled, sleeping for {} seconds'.format(delay))
+                METRICS.record_retry('google')
+                METRICS.record_sleep('google', 'throttle', delay)
                 time.sleep(delay)
             else:
                 result.raise_for_status()
@@ -127,6 +172,8 @@ class GoogleDriveClient:
         if convert:
             # FIXME: can we do some form of actual verification?
             ret['verified'] = True
+        elif self.hash_cache:
+            ret['verified'] = ret['md5Checksum'] == self.hash_cache.digest(file_name, 'md5')
         else:
             h = md5()
             with open(file_name, 'rb') as f:
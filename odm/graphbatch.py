@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+# This file is part of ODM and distributed under the terms of the
+# MIT license. See COPYING.
+
+import json
+import logging
+import random
+import time
+
+from concurrent.futures import Future
+
+import requests
+
+from .metrics import METRICS
+
+
+class BatchResponse(object):
+    ''' Enough of the requests.Response interface for a single response
+    unpacked from a JSON batch. '''
+
+    def __init__(self, url, raw):
+        self.url = url
+        self.status_code = int(raw['status'])
+        self.headers = requests.structures.CaseInsensitiveDict(raw.get('headers', {}))
+        self.body = raw.get('body')
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def content(self):
+        if isinstance(self.body, str):
+            return self.body.encode('utf-8')
+        return json.dumps(self.body).encode('utf-8')
+
+    def json(self):
+        if isinstance(self.body, str):
+            return json.loads(self.body)
+        return self.body
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise requests.exceptions.HTTPError(
+                '{} Error in batched request for url: {}'.format(self.status_code, self.url),
+                response=self,
+            )
+
+
+class GraphBatch(object):
+    ''' Collects independent requests and sends them to the Graph $batch
+    endpoint in groups. Each request gets a Future that resolves to its
+    BatchResponse once the group it's in has been sent. '''
+
+    # Graph's documented limit
+    max_size = 20
+
+    def __init__(self, session):
+        self.session = session
+        self.max_attempts = session.max_attempts
+        self.logger = logging.getLogger(__name__)
+        self._queue = []
+        self._next_id = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def _relative(self, url):
+        if url.lower().startswith(self.session.baseurl.lower()):
+            url = url[len(self.session.baseurl):]
+        elif url.lower().startswith('http'):
+            raise ValueError('Only Graph v1.0 requests can be batched: {}'.format(url))
+        return '/' + url.lstrip('/')
+
+    def add(self, method, url, json=None, headers=None, depends_on=None):
+        if len(self._queue) >= self.max_size:
+            # Anything we depend on goes out with this group, and since
+            # groups are sent in order that satisfies the dependency.
+            self.flush()
+
+        self._next_id += 1
+        request = {
+            'id': str(self._next_id),
+            'method': method.upper(),
+            'url': self._relative(url),
+        }
+        if json is not None:
+            request['body'] = json
+            headers = dict(headers or {})
+            headers.setdefault('Content-Type', 'application/json')
+        if headers:
+            request['headers'] = headers
+
+        future = Future()
+        future.batch_id = request['id']
+        self._queue.append((request, future, depends_on or []))
+        return future
+
+    def get(self, url, **kwargs):
+        return self.add('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.add('POST', url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.add('PATCH', url, **kwargs)
+
+    def _send(self, pending):
+        requests_out = []
+        for (request, future, depends_on) in pending:
+            request = dict(request)
+            waiting = [x.batch_id for x in depends_on if not x.done()]
+            if waiting:
+                request['dependsOn'] = waiting
+            requests_out.append(request)
+
+        if self.session.throttle:
+            # The batch itself takes a token, but every request in it counts
+            # against the budget.
+            for _ in range(len(requests_out) - 1):
+                METRICS.record_sleep('graph', 'budget', self.session.throttle.acquire())
+
+        result = self.session.post('$batch', json={'requests': requests_out})
+        result.raise_for_status()
+        return {x['id']: x for x in result.json()['responses']}
+
+    def flush(self):
+        pending = self._queue
+        self._queue = []
+        attempt = 0
+
+        while pending:
+            attempt += 1
+
+            # Requests can only depend on things that succeeded
+            ready = []
+            for entry in pending:
+                (request, future, depends_on) = entry
+                failed = [x for x in depends_on if x.done() and (x.exception() or not x.result().ok)]
+                if failed:
+                    future.set_result(BatchResponse(request['url'], {'status': 424}))
+                else:
+                    ready.append(entry)
+
+            if not ready:
+                return
+
+            try:
+                responses = self._send(ready)
+            except requests.exceptions.RequestException as e:
+                for (request, future, depends_on) in ready:
+                    future.set_exception(e)
+                return
+
+            pending = []
+            delay = 0
+            for entry in ready:
+                (request, future, depends_on) = entry
+                raw = responses.get(request['id'])
+                status = int(raw['status']) if raw else 503
+                if status == 424 and [x for x in depends_on if not x.done()]:
+                    # Something we depend on is being retried, so we need to
+                    # be retried too.
+                    pending.append(entry)
+                elif status in (429, 503, 504) and attempt < self.max_attempts:
+                    retry_after = requests.structures.CaseInsensitiveDict((raw or {}).get('headers', {})).get('Retry-After')
+                    if retry_after:
+                        delay = max(delay, float(retry_after))
+                    else:
+                        delay = max(delay, random.uniform(min(30, 2 ** attempt), min(300, 3 * 2 ** attempt)))
+                    pending.append(entry)
+                elif raw:
+                    future.set_result(BatchResponse(request['url'], raw))
+                else:
+                    future.set_exception(requests.exceptions.RetryError('maximum retries exceeded'))
+
+            if pending:
+                self.logger.debug('%d batched requests throttled', len(pending))
+                if self.session.throttle:
+                    self.session.throttle.pause(delay)
+                self.logger.info('Sleeping for %d seconds before retrying', delay)
+                METRICS.record_retry('graph')
+                METRICS.record_sleep('graph', 'throttle', delay)
+                time.sleep(delay)
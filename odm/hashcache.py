@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+# This file is part of ODM and distributed under the terms of the
+# MIT license. See COPYING.
+
+import hashlib
+import logging
+import mmap
+import os
+
+from odm import quickxorhash
+from odm.db import Database
+
+
+DIGESTS = ('md5', 'quickXorHash', 'sha1')
+
+
+def hash_file(path, algorithm=None, hash_workers=None):
+    ''' Calculate the digests we can get cheaply in a single pass over the
+    file. QuickXORHash is only included if it was asked for or one of the
+    fast backends is available, and large files get it from
+    hash_file_parallel() instead. '''
+    hashes = {
+        'md5': hashlib.md5(),
+        'sha1': hashlib.sha1(),
+    }
+    digests = {}
+
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+
+        if algorithm == 'quickXorHash' or quickxorhash.available_backends()[0] != 'python':
+            if size >= quickxorhash.PARALLEL_THRESHOLD:
+                digests['quickXorHash'] = quickxorhash.hash_file_parallel(path, hash_workers)
+            else:
+                hashes['quickXorHash'] = quickxorhash.QuickXORHash()
+
+        if size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY) as mapped:
+                with memoryview(mapped) as view:
+                    for start in range(0, size, quickxorhash.CHUNK_SIZE):
+                        for h in hashes.values():
+                            h.update(view[start:start + quickxorhash.CHUNK_SIZE])
+
+    for (key, h) in hashes.items():
+        if key == 'quickXorHash':
+            digests[key] = h.finalize()
+        else:
+            digests[key] = h.hexdigest()
+    return digests
+
+
+class HashCache:
+    ''' Persistent cache of file digests. Entries are keyed by device and
+    inode and are only used while the file's size and mtime still match. '''
+
+    def __init__(self, path, hash_workers=None):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.hash_workers = hash_workers
+
+    @classmethod
+    def from_config(cls, config):
+        if config.get('hash_cache'):
+            return cls(config['hash_cache'], config.get('hash_workers'))
+        return None
+
+    @property
+    def db(self):
+        return Database.shared(self.path)
+
+    def _key(self, stat):
+        return '{}:{}'.format(stat.st_dev, stat.st_ino)
+
+    def _validator(self, stat):
+        return {
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+        }
+
+    def store(self, path, digests):
+        ''' Record digests that were calculated some other way, e.g. while
+        downloading the file. '''
+        stat = os.stat(path)
+        entry = self.db.read(self._key(stat))
+        validator = self._validator(stat)
+        if entry.get('validator') != validator:
+            entry = {
+                'validator': validator,
+            }
+        for key in DIGESTS:
+            if digests.get(key):
+                entry[key] = digests[key]
+        self.db.write(self._key(stat), entry)
+
+    def digest(self, path, algorithm):
+        stat = os.stat(path)
+        entry = self.db.read(self._key(stat))
+
+        if entry.get('validator') == self._validator(stat) and algorithm in entry:
+            self.logger.debug('Using cached %s for %s', algorithm, path)
+            return entry[algorithm]
+
+        self.logger.debug('Hashing %s', path)
+        digests = hash_file(path, algorithm, self.hash_workers)
+
+        # Don't trust the result if the file changed while we were reading it
+        if self._validator(os.stat(path)) == self._validator(stat):
+            if entry.get('validator') != self._validator(stat):
+                entry = {
+                    'validator': self._validator(stat),
+                }
+            entry.update(digests)
+            self.db.write(self._key(stat), entry)
+
+        return digests[algorithm]
@@ -6,6 +6,7 @@
 import calendar
 import datetime
 import dateutil
+import functools
 import json
 import os
 import sys
@@ -19,7 +20,8 @@ import odm.cli
 
 from odm.boxnote import BoxNote
 from odm.db import Database
-from odm.util import chunky_path
+from odm.hashcache import HashCache
+from odm.util import HashingWriter, chunky_path, download_ranges, parallel_map, segment_config, split_work
 
 
 def _hash_file(path, h):
@@ -33,6 +35,19 @@ def _hash_file(path, h):
     return h.hexdigest()
 
 
+def _verify_item(path, expected, hash_cache):
+    if not os.path.exists(path):
+        return (False, None)
+
+    digest = None
+    if expected is not None:
+        if hash_cache:
+            digest = hash_cache.digest(path, 'sha1')
+        else:
+            digest = _hash_file(path, sha1())
+    return (True, digest)
+
+
 def _write_chunk(logger, path, data, size):
     logger.debug('Writing %d items to %s (%d bytes)', len(data), path, size)
     with open(path, 'wb') as f:
@@ -40,10 +55,13 @@ def _write_chunk(logger, path, data, size):
 
 
 def main():
-    cli = odm.cli.CLI(['file', 'action', '--filetree', '--item-limit', '--size-limit', '--limit'], ['--delta'], client='box')
+    cli = odm.cli.CLI(['file', 'action', '--filetree', '--item-limit', '--size-limit', '--limit', '--jobs'], ['--delta'], client='box')
     client = cli.client
 
     db = Database(cli.args.file)
+    hash_cache = HashCache.from_config(cli.config)
+    # Files at least this large are downloaded over several connections
+    (segment_threshold, segments) = segment_config(cli.config)
 
     if cli.args.action == 'status':
         if db.read('_odm_meta').get('fully_expanded'):
@@ -65,10 +83,21 @@ def main():
 
         fname_tmpl = cli.args.file.replace('.lmdb', '') + '.split.{:04d}.json'
 
-        split = 0
-        size = 0
-        count = 0
-        chunk_keys = []
+        # Files are grouped by the chain of folders above them, so each chunk
+        # covers as few folders as possible.
+        folders = {'0': ()}
+
+        def locality(folder_id):
+            chain = []
+            while folder_id not in folders:
+                chain.append(folder_id)
+                folder_id = db.read(folder_id)['parent']['id']
+            for ancestor in reversed(chain):
+                folders[ancestor] = folders[folder_id] + (ancestor,)
+                folder_id = ancestor
+            return folders[folder_id]
+
+        units = []
         for key, item in db.iterate():
             if key.startswith('_odm_') or item['type'] == 'folder':
                 continue
@@ -81,18 +110,13 @@ def main():
             if cli.args.delta and not item['_odm_modified']:
                 continue
 
-            count += 1
-            if size + item['size'] > size_limit or len(chunk_keys) >= item_limit:
-                split += 1
-                _write_chunk(cli.logger, fname_tmpl.format(split), chunk_keys, size)
-                chunk_keys = []
-                size = 0
-            chunk_keys.append(key)
-            size += item['size']
-        if chunk_keys:
-            split += 1
-            _write_chunk(cli.logger, fname_tmpl.format(split), chunk_keys, size)
-        cli.logger.info('Divided %d items into %d chunks', count, split)
+            units.append((locality(item['parent']['id']), key, item['size']))
+
+        sizes = {key: size for (_, key, size) in units}
+        chunks = split_work(units, item_limit, size_limit)
+        for (split, chunk_keys) in enumerate(chunks, 1):
+            _write_chunk(cli.logger, fname_tmpl.format(split), chunk_keys, sum(sizes[x] for x in chunk_keys))
+        cli.logger.info('Divided %d items into %d chunks', len(units), len(chunks))
         if db.iteration_finished:
             sys.exit(0)
         else:
@@ -109,6 +133,8 @@ def main():
         count = 0
         size = 0
         limit = set()
+        jobs = int(cli.args.jobs or 1)
+        verify_queue = []
 
         if cli.args.limit:
             with open(cli.args.limit, 'rb') as f:
@@ -154,10 +180,17 @@ def main():
             cli.logger.info('Working on %s', item_path)
             item_path = '/'.join([destdir, item_path])
 
+            if cli.args.action == 'verify-items' and jobs > 1:
+                verify_queue.append((item_path, item.get('sha1')))
+                continue
+
             if os.path.exists(item_path):
                 digest = None
                 if 'sha1' in item:
-                    digest = _hash_file(item_path, sha1())
+                    if hash_cache:
+                        digest = hash_cache.digest(item_path, 'sha1')
+                    else:
+                        digest = _hash_file(item_path, sha1())
                 if item.get('sha1') == digest:
                     cli.logger.debug('%s successfully verified', item_path)
                     continue
@@ -178,8 +211,22 @@ def main():
             if item['owned_by']['id'] not in user_clients:
                 user_clients[item['owned_by']['id']] = client.as_user(client.user(item['owned_by']['id']))
 
-            with open(item_path, 'wb') as f:
-                user_clients[item['owned_by']['id']].file(item['id']).download_to(f)
+            box_file = user_clients[item['owned_by']['id']].file(item['id'])
+            if segments > 1 and item.get('size', 0) >= segment_threshold:
+                # SHA-1 can't be assembled from separately hashed segments,
+                # so hash the finished file instead.
+                download_ranges(
+                    lambda start, end, writer: box_file.download_to(writer, byte_range=(start, end)),
+                    item_path,
+                    item['size'],
+                    segments,
+                )
+                h = sha1()
+                _hash_file(item_path, h)
+            else:
+                h = sha1()
+                with HashingWriter(item_path, h) as f:
+                    box_file.download_to(f)
 
             os.utime(
                 item_path,
@@ -191,12 +238,15 @@ def main():
                 )
             )
 
-            digest = _hash_file(item_path, sha1())
+            digest = h.hexdigest()
             if item.get('sha1', digest) != digest:
                 cli.logger.warn('%s has the wrong post-download hash: expected %s, got %s', item_path, item['sha1'], digest)
                 retval = 1
                 continue
 
+            if hash_cache:
+                hash_cache.store(item_path, {'sha1': digest})
+
             if item['name'].endswith('.boxnote'):
                 note = BoxNote(item_path, client)
                 text = note.convert()
@@ -212,11 +262,32 @@ def main():
                     ],
                 )
 
+        if verify_queue:
+            results = parallel_map(
+                functools.partial(_verify_item, hash_cache=hash_cache),
+                verify_queue,
+                jobs,
+                initializer=functools.partial(odm.cli.configure_logging, cli.args.verbose),
+            )
+        else:
+            results = []
+
+        for (item_path, expected), (exists, digest) in zip(verify_queue, results):
+            if not exists:
+                cli.logger.info('%s does not exist', item_path)
+                retval = 1
+            elif expected == digest:
+                cli.logger.debug('%s successfully verified', item_path)
+            else:
+                cli.logger.info('%s has the wrong hash: expected %s, got %s', item_path, expected, digest)
+                retval = 1
+
         cli.logger.info('{:.2f} MiB across {} items, elapsed time {}'.format(
             size / (1024 ** 2),
             count,
             datetime.datetime.now() - ts_start,
         ))
+        cli.log_metrics()
 
         sys.exit(retval)
 
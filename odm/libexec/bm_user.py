@@ -167,6 +167,7 @@ def main():
             count,
             datetime.datetime.now() - ts_start,
         ))
+        cli.log_metrics()
     else:
         print('Unsupported action {}'.format(cli.args.action), file=sys.stderr)
         sys.exit(1)
@@ -85,6 +85,7 @@ def main():
             count,
             datetime.datetime.now() - ts_start,
         )
+        cli.log_metrics()
 
     else:
         print('Unsupported action {}'.format(cli.args.action), file=sys.stderr)
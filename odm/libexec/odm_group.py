@@ -7,11 +7,15 @@ import json
 import sys
 
 import odm.cli
+import odm.metadata
 import odm.ms365
 
 
 def main():
-    cli = odm.cli.CLI(['group', 'action', '--display-name', '--incremental', '--owners', '--members'], ['--private'])
+    cli = odm.cli.CLI(
+        ['group', 'action', '--display-name', '--incremental', '--checkpoint', '--output', '--output-format', '--owners', '--members'],
+        ['--private'],
+    )
     client = cli.client
     groupname = client.mangle_user(cli.args.group)
 
@@ -56,12 +60,24 @@ def main():
         }
 
         if cli.args.incremental:
-            with open(cli.args.incremental, 'rb') as f:
-                base = json.load(f)
+            base = odm.metadata.load(cli.args.incremental)
 
-        group.drive.delta(base)
+        try:
+            writer = odm.metadata.writer(cli.args.output_format, cli.args.output)
+        except ValueError as e:
+            cli.logger.critical(e)
+            sys.exit(1)
+
+        checkpoint = None
+        if cli.args.checkpoint:
+            checkpoint = odm.metadata.Checkpoint(cli.args.checkpoint)
+
+        writer.start(base)
+        group.drive.delta(base, on_page=writer.update, checkpoint=checkpoint)
+        writer.finish(base)
 
-        print(json.dumps(base, indent=2))
+        if checkpoint:
+            checkpoint.remove()
 
     elif cli.args.action == 'list-channels':
         print(json.dumps(group.channels, indent=2))
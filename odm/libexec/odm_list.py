@@ -5,17 +5,368 @@
 
 import calendar
 import datetime
+import functools
 import json
 import os
 import sys
 import time
 
-from copy import copy
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import dateutil.parser
 
 import odm.cli
+import odm.metadata
 import odm.ms365
+import odm.onedriveclient
+
+from odm.util import parallel_map, split_work
+
+
+# Downloads queued per worker; results are reported in order, so this bounds
+# how far a slow file can hold up the log.
+DOWNLOAD_WINDOW = 16
+
+
+def _clean_dir(path, relpath, keep, logger):
+    # Remove extraneous files from a single directory, returning the number of
+    # files left behind and the subdirectories to descend into.
+    remaining = 0
+    subdirs = []
+    with os.scandir(path) as it:
+        for entry in it:
+            entry_relpath = '/'.join([relpath, entry.name]) if relpath else entry.name
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append((entry.path, entry_relpath))
+            elif entry.is_dir():
+                # A symlink to a directory; leave it alone, and don't follow it
+                remaining += 1
+            elif entry_relpath in keep:
+                remaining += 1
+            else:
+                logger.info('Removing %s', entry_relpath)
+                os.unlink(entry.path)
+    return (remaining, subdirs)
+
+
+def clean_filetree(paths, metadata, filetree, logger, jobs=1):
+    keep = {paths.fs_path(x) for x in metadata['items'] if 'file' in metadata['items'][x]}
+
+    # Scan the tree a level at a time, with each level's directories spread
+    # across the workers. Directories are recorded parents first, along with
+    # the number of entries left in them.
+    dirs = []
+    entries = {}
+    level = [(filetree, '', None)]
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while level:
+            futures = [executor.submit(_clean_dir, path, relpath, keep, logger) for (path, relpath, parent) in level]
+            next_level = []
+            for ((path, relpath, parent), future) in zip(level, futures):
+                (remaining, subdirs) = future.result()
+                dirs.append((path, relpath, parent))
+                entries[path] = remaining + len(subdirs)
+                next_level.extend((x, y, path) for (x, y) in subdirs)
+            level = next_level
+
+    # Working back up from the deepest directories, remove any that are now
+    # empty. The top level is left alone.
+    for (path, relpath, parent) in reversed(dirs):
+        if parent and entries[path] == 0:
+            logger.info('Removing empty directory %s', relpath)
+            os.rmdir(path)
+            entries[parent] -= 1
+
+
+def download_item(client, item, item_path, dest, digest, verify_args, logger):
+    ''' Download a file unless a verified copy already exists. Returns
+    'verified', 'downloaded' or 'failed'. '''
+    if client.verify_file(**verify_args):
+        return 'verified'
+
+    logger.info('Downloading %s to %s', item_path, dest)
+    attempt = 0
+    result = None
+    while attempt < 3 and result is None:
+        attempt += 1
+        result = client.download_file(
+            item['parentReference']['driveId'],
+            item['id'],
+            dest,
+            item['size'],
+        )
+        if result is not None and digest and result != digest:
+            logger.info('%s has the wrong hash, retrying', dest)
+            result = None
+
+    if result is None:
+        return 'failed'
+
+    os.utime(dest, (
+        time.time(),
+        calendar.timegm(dateutil.parser.parse(
+            item['fileSystemInfo']['lastModifiedDateTime']
+        ).timetuple())
+    ))
+    if client.hash_cache and digest:
+        client.hash_cache.store(dest, {'quickXorHash': digest})
+    return 'downloaded'
+
+
+def report_download(logger, dest, status):
+    if status == 'verified':
+        logger.info('Verified %s', dest)
+    elif status == 'failed':
+        logger.warning('Failed to download %s', dest)
+        return 1
+    return 0
+
+
+class UploadPipeline:
+    ''' Upload (or verify, or apply permissions to) a set of files along with
+    the folders and notebooks above them. Folders are resolved a level at a
+    time, in parallel, and each folder's files are queued as soon as it
+    exists. Permissions are applied by a separate pool so that they don't
+    hold up the transfers. '''
+
+    def __init__(self, items, paths, root, container, action, apply_permissions, domain_map, jobs, logger):
+        self.items = items
+        self.paths = paths
+        self.root = root
+        self.container = container
+        self.action = action
+        self.apply_permissions = apply_permissions
+        self.domain_map = domain_map
+        self.jobs = jobs
+        self.logger = logger
+        # folder ID -> depth below the root
+        self.depths = {}
+        # folder ID -> [(item, dest)]
+        self.files = {}
+        self.permission_executor = None
+        self.permission_futures = []
+
+    def add(self, item, dest):
+        parent_id = item['parentReference']['id']
+        self.files.setdefault(parent_id, []).append((item, dest))
+
+        # Record the depth of every folder above this one that we haven't
+        # seen yet.
+        chain = []
+        while parent_id not in self.depths:
+            parent = self.items[parent_id]
+            if 'id' not in parent['parentReference']:
+                # This is the root folder
+                parent['upload_id'] = self.root
+                self.depths[parent_id] = 0
+                break
+            chain.append(parent_id)
+            parent_id = parent['parentReference']['id']
+
+        for folder_id in reversed(chain):
+            self.depths[folder_id] = self.depths[parent_id] + 1
+            parent_id = folder_id
+
+    def _check_parent(self, step, step_path):
+        parent = self.items[step['parentReference']['id']]
+        if parent['upload_id'] == 'skip':
+            self.logger.debug('Skipping descendant %s', step_path)
+            step['upload_id'] = 'skip'
+            return False
+
+        if parent['upload_id'] == 'failed':
+            self.logger.info('Failed to verify %s: parent does not exist', step_path)
+            step['upload_id'] = 'failed'
+            return False
+
+        return True
+
+    def _resolve_folder(self, item_id):
+        step = self.items[item_id]
+        step_path = self.paths.path(item_id)
+        if not self._check_parent(step, step_path):
+            return 0
+
+        parent = self.items[step['parentReference']['id']]
+        if 'package' in step:
+            if step['package']['type'] != 'oneNote':
+                self.logger.info('Skipping %s, unknown package type %s', step_path, step['package']['type'])
+                step['upload_id'] = 'skip'
+                return 0
+
+            try:
+                step['upload_id'] = parent['upload_id'].get_notebook(step['name'], self.container, self.action == 'upload')
+            except TypeError:
+                step['upload_id'] = 'skip'
+                self.logger.error('Failed to create notebook %s', step_path)
+                return 1
+
+            if self.action == 'verify-upload' and not step['upload_id']:
+                step['upload_id'] = 'failed'
+                return 1
+
+        else:
+            try:
+                step['upload_id'] = parent['upload_id'].get_folder(step['name'], self.action == 'upload')
+            except TypeError:
+                step['upload_id'] = 'skip'
+                self.logger.error('Failed to create folder %s', step_path)
+                return 1
+
+            if self.action == 'verify-upload' and not step['upload_id']:
+                step['upload_id'] = 'failed'
+                return 0
+
+        self._queue_permissions(step)
+        return 0
+
+    def _upload_file(self, step, dest):
+        self.logger.info('Working on %s', dest)
+        step_path = self.paths.path(step['id'])
+        if not self._check_parent(step, step_path):
+            return 0
+
+        retval = 0
+        parent = self.items[step['parentReference']['id']]
+        if self.action == 'upload':
+            if step['file']['mimeType'] == 'application/msonenote':
+                step['upload_id'] = parent['upload_id'].upload_file_sharepoint(dest, step['name'])
+            else:
+                step['upload_id'] = parent['upload_id'].upload_file(dest, step['name'])
+            if not step['upload_id']:
+                step['upload_id'] = 'failed'
+                self.logger.error('Failed to upload %s', step_path)
+                return 1
+        else:
+            step['upload_id'] = parent['upload_id'].verify_file(dest, step['name'])
+            if step['upload_id']:
+                self.logger.info('Verified %s', step_path)
+            else:
+                self.logger.warning('Failed to verify %s', step_path)
+                retval = 1
+
+        self._queue_permissions(step, True)
+        return retval
+
+    def _queue_permissions(self, step, leaf=False):
+        # FIXME: should we check to see if permissions already exist
+        if self.apply_permissions and 'upload_id' in step and 'permissions' in step:
+            self.permission_futures.append(self.permission_executor.submit(self._apply_permissions, step, leaf))
+        elif leaf:
+            # Try to keep memory usage under control by pruning leaves
+            # once they're processed.
+            step.clear()
+
+    def _apply_permissions(self, step, leaf):
+        # FIXME: what should we do about missing users?
+        for perm in step['permissions']:
+            if 'link' in perm:
+                self.logger.info('Skipping %s scoped shared link', perm['link']['scope'])
+                continue
+
+            if 'owner' in perm['roles']:
+                self.logger.debug('Skipping owner permission')
+                continue
+
+            if 'email' not in perm['grantedTo']['user']:
+                self.logger.info('Skipping permission with no email: %s', perm['grantedTo']['user'].get('displayName'))
+                continue
+
+            (user, domain) = perm['grantedTo']['user']['email'].split('@')
+            if domain in self.domain_map:
+                domain = self.domain_map[domain]
+
+            try:
+                self.logger.info('Applying permissions for %s@%s', user, domain)
+                step['upload_id'].share(
+                    '{}@{}'.format(user, domain),
+                    perm['roles'],
+                )
+            except AttributeError:
+                # FIXME: It would be better to implement this
+                self.logger.info('Skipping permission on file uploaded via SharePoint')
+
+        if leaf:
+            step.clear()
+
+    def run(self):
+        levels = {}
+        for (folder_id, depth) in self.depths.items():
+            levels.setdefault(depth, []).append(folder_id)
+
+        retval = 0
+        file_futures = []
+        with ThreadPoolExecutor(max_workers=self.jobs) as folder_executor, \
+                ThreadPoolExecutor(max_workers=self.jobs) as file_executor, \
+                ThreadPoolExecutor(max_workers=self.jobs) as permission_executor:
+            self.permission_executor = permission_executor
+            for depth in sorted(levels):
+                # Everything at this depth only depends on the level above
+                if depth > 0:
+                    for result in folder_executor.map(self._resolve_folder, levels[depth]):
+                        retval |= result
+
+                for folder_id in levels[depth]:
+                    for (item, dest) in self.files.get(folder_id, []):
+                        file_futures.append(file_executor.submit(self._upload_file, item, dest))
+
+            for future in file_futures:
+                retval |= future.result()
+
+            # All of the files are done, so nothing else will be queued.
+            for future in self.permission_futures:
+                future.result()
+
+        return retval
+
+
+def split_metadata(metadata, length, size_limit, split_prefix, logger):
+    items = metadata['items']
+    paths = odm.metadata.PathIndex(items)
+
+    # Sorting by path keeps each folder's files together, so uploaders
+    # working on different chunks don't all have to look up the same folders.
+    chunks = split_work(
+        ((paths.path(x), x, items[x]['size']) for x in items if 'file' in items[x]),
+        length,
+        size_limit,
+    ) or [[]]
+
+    # Each chunk gets its files and their ancestors; everything else (e.g.
+    # empty folders) goes in every chunk.
+    members = []
+    used = set()
+    for chunk in chunks:
+        chunk_members = set()
+        for item_id in chunk:
+            chunk_members.add(item_id)
+            item = items[item_id]
+            while 'id' in item['parentReference'] and item['parentReference']['id'] not in chunk_members:
+                item = items[item['parentReference']['id']]
+                chunk_members.add(item['id'])
+        used.update(chunk_members)
+        members.append(chunk_members)
+
+    order = {x: i for (i, x) in enumerate(items)}
+    shared = [x for x in items if x not in used]
+
+    for (i, chunk_members) in enumerate(members):
+        fname = '{}{:0{align}d}.json'.format(
+            split_prefix,
+            i,
+            align=len(str(len(chunks) - 1)),
+        )
+        logger.debug('Saving list %d to %s (%d files)', i, fname, len(chunks[i]))
+
+        output = {
+            'items': {x: items[x] for x in sorted(chunk_members.union(shared), key=order.get)},
+        }
+
+        with open(fname, 'w') as f:
+            json.dump(output, f, indent=2)
+
+    return len(chunks)
 
 
 def main():
@@ -27,10 +378,12 @@ def main():
             '--upload-path',
             '--domain-map',
             '--length',
+            '--size-limit',
             '--split-prefix',
             '--limit',
             '--exclude',
             '--diff',
+            '--jobs',
             'file',
             'action',
         ],
@@ -43,8 +396,7 @@ def main():
     ts_start = datetime.datetime.now()
     retval = 0
 
-    with open(cli.args.file, 'rb') as f:
-        metadata = json.load(f)
+    metadata = odm.metadata.load(cli.args.file)
 
     destdir = cli.args.filetree.rstrip('/') if cli.args.filetree else '/var/tmp'
 
@@ -107,13 +459,42 @@ def main():
 
         size = 0
         count = 0
+        paths = odm.metadata.PathIndex(metadata['items'])
+
+        jobs = int(cli.args.jobs or 1)
+        verify_queue = []
+        download_queue = deque()
+        executor = None
+        if jobs > 1:
+            # The workers are the parallelism, don't fan out any further
+            client.config['hash_workers'] = 1
+            if cli.args.action == 'download':
+                client.msgraph.set_pool_size(jobs)
+                executor = ThreadPoolExecutor(max_workers=jobs)
+            elif cli.args.action in ('upload', 'verify-upload', 'apply-permissions'):
+                # Folders, files and permissions each get a pool of workers
+                client.msgraph.set_pool_size(jobs * 3)
+
+        uploader = None
+        if cli.args.action in ('upload', 'verify-upload', 'apply-permissions'):
+            uploader = UploadPipeline(
+                metadata['items'],
+                paths,
+                upload_path,
+                upload_container,
+                cli.args.action,
+                apply_permissions,
+                domain_map,
+                jobs,
+                cli.logger,
+            )
 
         for item_id in metadata['items']:
             item = metadata['items'][item_id]
             if 'file' not in item:
                 continue
 
-            item_path = client.expand_path(item_id, metadata['items'])
+            item_path = paths.path(item_id)
 
             if item_path in exclude:
                 cli.logger.debug('Skipping excluded item %s', item_path)
@@ -133,7 +514,7 @@ def main():
             size += item['size']
             count += 1
 
-            dest = '/'.join([destdir, client.expand_path(item_id, metadata['items'], True)])
+            dest = '/'.join([destdir, paths.fs_path(item_id)])
 
             digest = None
             if 'hashes' in item['file']:
@@ -149,35 +530,21 @@ def main():
 
             if cli.args.action == 'download':
                 verify_args['strict'] = False
-                if client.verify_file(**verify_args):
-                    cli.logger.info('Verified %s', dest)
+                download_args = (client, item, item_path, dest, digest, verify_args, cli.logger)
+                if executor:
+                    download_queue.append((dest, executor.submit(download_item, *download_args)))
+                    # Bound the number of items in flight, and report results
+                    # in the same order as a sequential run.
+                    while len(download_queue) > jobs * DOWNLOAD_WINDOW:
+                        (queued_dest, future) = download_queue.popleft()
+                        retval |= report_download(cli.logger, queued_dest, future.result())
                 else:
-                    cli.logger.info('Downloading %s to %s', item_path, dest)
-                    attempt = 0
-                    result = None
-                    while attempt < 3 and result is None:
-                        attempt += 1
-                        result = client.download_file(
-                            item['parentReference']['driveId'],
-                            item['id'],
-                            dest,
-                        )
-                        if digest and result != digest:
-                            cli.logger.info('%s has the wrong hash, retrying', dest)
-                            result = None
-                    if result is None:
-                        cli.logger.warning('Failed to download %s', dest)
-                        retval = 1
-                    else:
-                        os.utime(dest, (
-                            time.time(),
-                            calendar.timegm(dateutil.parser.parse(
-                                item['fileSystemInfo']['lastModifiedDateTime']
-                            ).timetuple())
-                        ))
+                    retval |= report_download(cli.logger, dest, download_item(*download_args))
 
             elif cli.args.action == 'verify' and digest:
-                if client.verify_file(**verify_args):
+                if jobs > 1:
+                    verify_queue.append(verify_args)
+                elif client.verify_file(**verify_args):
                     cli.logger.info('Verified %s', dest)
                 else:
                     cli.logger.warning('Failed to verify %s', dest)
@@ -188,123 +555,39 @@ def main():
                     # No permissions to apply, don't waste time
                     continue
 
-                cli.logger.info('Working on %s', dest)
-
-                steps = []
-                # Find parents by tracing up through references
-                cur = item
-                while 'upload_id' not in cur:
-                    if 'id' not in cur['parentReference']:
-                        # This is the root folder
-                        cur['upload_id'] = upload_path
-                    else:
-                        steps.insert(0, cur)
-                        cur = metadata['items'][cur['parentReference']['id']]
-
-                for step in steps:
-                    leaf = False
-                    step_path = client.expand_path(step['id'], metadata['items'])
-                    parent = metadata['items'][step['parentReference']['id']]
-                    if parent['upload_id'] == 'skip':
-                        cli.logger.debug('Skipping descendant %s', step_path)
-                        step['upload_id'] = 'skip'
-                        continue
-
-                    if parent['upload_id'] == 'failed':
-                        cli.logger.info('Failed to verify %s: parent does not exist', step_path)
-                        step['upload_id'] = 'failed'
-                        continue
-
-                    if 'package' in step:
-                        if step['package']['type'] != 'oneNote':
-                            cli.logger.info('Skipping %s, unknown package type %s', step_path, step['package']['type'])
-                            step['upload_id'] = 'skip'
-                            continue
-
-                        try:
-                            step['upload_id'] = parent['upload_id'].get_notebook(step['name'], upload_container, cli.args.action == 'upload')
-                        except TypeError:
-                            step['upload_id'] = 'skip'
-                            cli.logger.error('Failed to create notebook %s', step_path)
-                            retval = 1
-                            continue
-
-                        if cli.args.action == 'verify-upload' and not step['upload_id']:
-                            step['upload_id'] = 'failed'
-                            retval = 1
-                            continue
-
-                    elif 'folder' in step:
-                        try:
-                            step['upload_id'] = parent['upload_id'].get_folder(step['name'], cli.args.action == 'upload')
-                        except TypeError:
-                            step['upload_id'] = 'skip'
-                            cli.logger.error('Failed to create folder %s', step_path)
-                            retval = 1
-                            continue
-
-                        if cli.args.action == 'verify-upload' and not step['upload_id']:
-                            step['upload_id'] = 'failed'
-                            continue
-
-                    else:
-                        leaf = True
-                        if cli.args.action == 'upload':
-                            if step['file']['mimeType'] == 'application/msonenote':
-                                step['upload_id'] = parent['upload_id'].upload_file_sharepoint(dest, step['name'])
-                            else:
-                                step['upload_id'] = parent['upload_id'].upload_file(dest, step['name'])
-                            if not step['upload_id']:
-                                step['upload_id'] = 'failed'
-                                cli.logger.error('Failed to upload %s', step_path)
-                                retval = 1
-                                continue
-                        else:
-                            step['upload_id'] = parent['upload_id'].verify_file(dest, step['name'])
-                            if step['upload_id']:
-                                cli.logger.info('Verified %s', step_path)
-                            else:
-                                cli.logger.warning('Failed to verify %s', step_path)
-                                retval = 1
-
-                    # FIXME: what should we do about missing users?
-                    # FIXME: should we check to see if permissions already exist
-                    if apply_permissions and 'upload_id' in step and 'permissions' in step:
-                        for perm in step['permissions']:
-                            if 'link' in perm:
-                                cli.logger.info('Skipping %s scoped shared link', perm['link']['scope'])
-                                continue
-
-                            if 'owner' in perm['roles']:
-                                cli.logger.debug('Skipping owner permission')
-                                continue
-
-                            if 'email' not in perm['grantedTo']['user']:
-                                cli.logger.info('Skipping permission with no email: %s', perm['grantedTo']['user'].get('displayName'))
-                                continue
-
-                            (user, domain) = perm['grantedTo']['user']['email'].split('@')
-                            if domain in domain_map:
-                                domain = domain_map[domain]
-
-                            try:
-                                cli.logger.info('Applying permissions for %s@%s', user, domain)
-                                step['upload_id'].share(
-                                    '{}@{}'.format(user, domain),
-                                    perm['roles'],
-                                )
-                            except AttributeError:
-                                # FIXME: It would be better to implement this
-                                cli.logger.info('Skipping permission on file uploaded via SharePoint')
-
-                    # Try to keep memory usage under control by pruning leaves
-                    # once they're processed.
-                    if leaf:
-                        step.clear()
+                uploader.add(item, dest)
 
             elif cli.args.action == 'list-filenames':
                 print(item_path)
 
+        if uploader:
+            retval |= uploader.run()
+
+        while download_queue:
+            (queued_dest, future) = download_queue.popleft()
+            retval |= report_download(cli.logger, queued_dest, future.result())
+
+        if executor:
+            executor.shutdown()
+
+        if verify_queue:
+            results = parallel_map(
+                functools.partial(
+                    odm.onedriveclient.verify_local_file,
+                    hash_cache=client.hash_cache,
+                    hash_workers=client.config.get('hash_workers'),
+                ),
+                [(x['dest'], x.get('size'), x.get('file_hash')) for x in verify_queue],
+                jobs,
+                initializer=functools.partial(odm.cli.configure_logging, cli.args.verbose),
+            )
+            for verify_args, verified in zip(verify_queue, results):
+                if verified:
+                    cli.logger.info('Verified %s', verify_args['dest'])
+                else:
+                    cli.logger.warning('Failed to verify %s', verify_args['dest'])
+                    retval = 1
+
         if cli.args.action == 'download-estimate':
             delta_msg = 'wild guess time {!s}'.format(
                 datetime.timedelta(seconds=int(count + (size / (24 * 1024 * 1024))))
@@ -313,19 +596,20 @@ def main():
             delta_msg = 'elapsed time {!s}'.format(datetime.datetime.now() - ts_start)
 
         cli.logger.info('%.2f MiB across %d items, %s', size / (1024 ** 2), count, delta_msg)
+        cli.log_metrics()
 
     elif cli.args.action == 'clean-filetree':
-        fullpaths = [client.expand_path(x, metadata['items'], True) for x in metadata['items'] if 'file' in metadata['items'][x]]
-        for root, dirs, files in os.walk(cli.args.filetree):
-            relpath = os.path.relpath(root, cli.args.filetree)
-            for fname in files:
-                relfpath = '/'.join([relpath, fname])
-                if relfpath[:2] == './':
-                    relfpath = relfpath[2:]
-                if relfpath not in fullpaths:
-                    cli.logger.info('Removing %s', relfpath)
-                    fpath = '/'.join([root, fname])
-                    os.unlink(fpath)
+        if not cli.args.filetree:
+            cli.logger.critical('No filetree specified')
+            sys.exit(1)
+
+        clean_filetree(
+            odm.metadata.PathIndex(metadata['items']),
+            metadata,
+            cli.args.filetree,
+            cli.logger,
+            int(cli.args.jobs or 1),
+        )
 
     elif cli.args.action == 'split':
         if cli.args.length:
@@ -333,48 +617,16 @@ def main():
         else:
             length = 500
 
-        split_prefix = cli.args.split_prefix or cli.args.file
-
-        count = 0
-        split = 0
+        size_limit = None
+        if cli.args.size_limit:
+            # gigabytes
+            size_limit = int(cli.args.size_limit) * 1024 * 1024 * 1024
 
-        for item_id in metadata['items']:
-            item = metadata['items'][item_id]
-            if 'file' not in item:
-                continue
-
-            item['odm_split'] = [split]
-
-            while 'id' in item['parentReference']:
-                item = metadata['items'][item['parentReference']['id']]
-                item['odm_split'] = set(item.get('odm_split', [])).union([split])
-
-            count += 1
-            if count >= length:
-                split += 1
-                count = 0
-
-        for i in range(0, split + 1):
-            fname = '{}{:0{align}d}.json'.format(
-                split_prefix,
-                i,
-                align=len(str(split)),
-            )
-            cli.logger.debug('Saving list %d to %s', i, fname)
-
-            output = {
-                'items': {}
-            }
-            for item_id in metadata['items']:
-                item = metadata['items'][item_id]
-                if 'odm_split' not in item or i in item['odm_split']:
-                    output['items'][item_id] = copy(item)
-                    output['items'][item_id].pop('odm_split', None)
+        split_prefix = cli.args.split_prefix or cli.args.file
 
-            with open(fname, 'w') as f:
-                json.dump(output, f, indent=2)
+        chunks = split_metadata(metadata, length, size_limit, split_prefix, cli.logger)
 
-        cli.logger.info('Split %s into %d chunks of %d', cli.args.file, split + 1, length)
+        cli.logger.info('Split %s into %d chunks of at most %d files', cli.args.file, chunks, length)
 
     else:
         cli.logger.critical('Unsupported action %s', cli.args.action)
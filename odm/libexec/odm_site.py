@@ -7,11 +7,12 @@ import json
 import sys
 
 import odm.cli
+import odm.metadata
 import odm.ms365
 
 
 def main():
-    cli = odm.cli.CLI(['site', 'action', '--incremental'])
+    cli = odm.cli.CLI(['site', 'action', '--incremental', '--checkpoint', '--output', '--output-format'])
     client = cli.client
 
     site = odm.ms365.Site(client, cli.args.site)
@@ -30,12 +31,24 @@ def main():
         }
 
         if cli.args.incremental:
-            with open(cli.args.incremental, 'rb') as f:
-                base = json.load(f)
+            base = odm.metadata.load(cli.args.incremental)
 
-        site.drive.delta(base)
+        try:
+            writer = odm.metadata.writer(cli.args.output_format, cli.args.output)
+        except ValueError as e:
+            cli.logger.critical(e)
+            sys.exit(1)
+
+        checkpoint = None
+        if cli.args.checkpoint:
+            checkpoint = odm.metadata.Checkpoint(cli.args.checkpoint)
+
+        writer.start(base)
+        site.drive.delta(base, on_page=writer.update, checkpoint=checkpoint)
+        writer.finish(base)
 
-        print(json.dumps(base, indent=2))
+        if checkpoint:
+            checkpoint.remove()
 
     elif cli.args.action == 'list-pages':
         print(json.dumps(client.get_list('https://graph.microsoft.com/beta/sites/{}/pages'.format(site._id)), indent=2))
@@ -3,24 +3,25 @@
 # This file is part of ODM and distributed under the terms of the
 # MIT license. See COPYING.
 
-import json
 import sys
 
 import odm.cli
 
+from odm.util import dump_json_list
+
 
 def main():
     cli = odm.cli.CLI(['action'])
     client = cli.client
 
     if cli.args.action == 'list-users':
-        print(json.dumps(client.list_users(), indent=2))
+        dump_json_list(client.list_users(), sys.stdout)
 
     elif cli.args.action == 'list-sites':
-        print(json.dumps(client.list_sites(), indent=2))
+        dump_json_list(client.list_sites(), sys.stdout)
 
     elif cli.args.action == 'list-groups':
-        print(json.dumps(client.list_groups(), indent=2))
+        dump_json_list(client.list_groups(), sys.stdout)
 
     else:
         print('Unsupported action {}'.format(cli.args.action), file=sys.stderr)
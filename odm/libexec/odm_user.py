@@ -9,11 +9,12 @@ import sys
 from requests.exceptions import HTTPError
 
 import odm.cli
+import odm.metadata
 import odm.ms365
 
 
 def main():
-    cli = odm.cli.CLI(['user', 'action', '--incremental'], ['--include-permissions'])
+    cli = odm.cli.CLI(['user', 'action', '--incremental', '--checkpoint', '--output', '--output-format'], ['--include-permissions'])
     client = cli.client
     username = client.mangle_user(cli.args.user)
 
@@ -35,12 +36,24 @@ def main():
         }
 
         if cli.args.incremental:
-            with open(cli.args.incremental, 'rb') as f:
-                base = json.load(f)
+            base = odm.metadata.load(cli.args.incremental)
 
-        user.drive.delta(base, include_permissions=cli.args.include_permissions)
+        try:
+            writer = odm.metadata.writer(cli.args.output_format, cli.args.output)
+        except ValueError as e:
+            cli.logger.critical(e)
+            sys.exit(1)
+
+        checkpoint = None
+        if cli.args.checkpoint:
+            checkpoint = odm.metadata.Checkpoint(cli.args.checkpoint)
+
+        writer.start(base)
+        user.drive.delta(base, include_permissions=cli.args.include_permissions, on_page=writer.update, checkpoint=checkpoint)
+        writer.finish(base)
 
-        print(json.dumps(base, indent=2))
+        if checkpoint:
+            checkpoint.remove()
 
     elif cli.args.action == 'list-notebooks':
         # This consistently throws a 403 for some users
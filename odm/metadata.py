@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+
+# This file is part of ODM and distributed under the terms of the
+# MIT license. See COPYING.
+
+import json
+import os
+import sys
+
+from odm.db import Database
+from odm.util import chunky_path
+
+
+FORMATS = ('json', 'ndjson', 'lmdb')
+
+# Everything in the metadata other than the items themselves (delta token,
+# change summary) is stored under this key.
+TRAILER_KEY = '@odm.metadata'
+DELETED_KEY = '@odm.deleted'
+
+CHECKPOINT_KEY = '@odm.checkpoint'
+SEEN_PREFIX = '@odm.seen/'
+
+# Number of items per LMDB transaction when writing an existing base
+WRITE_BATCH = 1000
+
+
+def _trailer(base):
+    return {k: v for (k, v) in base.items() if k != 'items'}
+
+
+def _split_update(items, item_ids):
+    pairs = []
+    deletes = []
+    for item_id in item_ids:
+        if item_id in items:
+            pairs.append((item_id, items[item_id]))
+        else:
+            deletes.append(item_id)
+    return (pairs, deletes)
+
+
+def _write_items(db, items):
+    batch = []
+    for (item_id, item) in items.items():
+        batch.append((item_id, item))
+        if len(batch) >= WRITE_BATCH:
+            db.write_many(batch)
+            batch = []
+    db.write_many(batch)
+
+
+class JSONWriter:
+    ''' The traditional single indented document, written once the listing
+    is complete. '''
+
+    def __init__(self, path=None):
+        self.path = path
+
+    def start(self, base):
+        pass
+
+    def update(self, items, item_ids):
+        pass
+
+    def finish(self, base):
+        if self.path:
+            with open(self.path, 'w') as f:
+                json.dump(base, f, indent=2)
+                f.write('\n')
+        else:
+            json.dump(base, sys.stdout, indent=2)
+            sys.stdout.write('\n')
+
+
+class NDJSONWriter:
+    ''' One item per line, written as items are merged. Later records replace
+    earlier ones with the same ID, deletions are recorded as tombstones, and
+    the last line holds the rest of the metadata. '''
+
+    def __init__(self, path=None):
+        self.path = path
+        self.f = open(path, 'w') if path else sys.stdout
+
+    def _write(self, record):
+        self.f.write(json.dumps(record, separators=(',', ':')))
+        self.f.write('\n')
+
+    def start(self, base):
+        for item in base['items'].values():
+            self._write(item)
+
+    def update(self, items, item_ids):
+        for item_id in item_ids:
+            if item_id in items:
+                self._write(items[item_id])
+            else:
+                self._write({'id': item_id, DELETED_KEY: True})
+        self.f.flush()
+
+    def finish(self, base):
+        self._write({TRAILER_KEY: _trailer(base)})
+        if self.path:
+            self.f.close()
+        else:
+            self.f.flush()
+
+
+class LMDBWriter:
+    ''' Items keyed by ID in an odm.db.Database, written a page at a time. '''
+
+    def __init__(self, path):
+        self.db = Database(path)
+
+    def start(self, base):
+        self.db.clear()
+        _write_items(self.db, base['items'])
+
+    def update(self, items, item_ids):
+        self.db.write_many(*_split_update(items, item_ids))
+
+    def finish(self, base):
+        self.db.write(TRAILER_KEY, _trailer(base))
+        self.db.close()
+
+
+class Checkpoint:
+    ''' Progress of a delta enumeration, saved after every page so that an
+    interrupted listing can pick up where it left off. Items are stored by ID
+    alongside the enumeration state and the IDs seen during a resync, all
+    updated in a single transaction. '''
+
+    def __init__(self, path):
+        self.path = path
+        self.db = Database(path)
+
+    def load(self):
+        ''' Returns (base, state, seen), or None if there is no saved
+        progress. '''
+        state = self.db.read(CHECKPOINT_KEY)
+        if not state:
+            return None
+        base = dict(state.pop('base'))
+        base['items'] = {}
+        seen = set()
+        for (key, value) in self.db.iterate():
+            if key == CHECKPOINT_KEY:
+                continue
+            if key.startswith(SEEN_PREFIX):
+                seen.add(key[len(SEEN_PREFIX):])
+            else:
+                base['items'][key] = value
+        return (base, state, seen)
+
+    def start(self, base, state):
+        self.db.clear()
+        _write_items(self.db, base['items'])
+        self.save(base, [], state)
+
+    def save(self, base, item_ids, state, seen=()):
+        (pairs, deletes) = _split_update(base['items'], item_ids)
+        pairs.extend((SEEN_PREFIX + x, True) for x in seen)
+        saved = dict(state)
+        saved['base'] = _trailer(base)
+        pairs.append((CHECKPOINT_KEY, saved))
+        self.db.write_many(pairs, deletes)
+
+    def reset_seen(self):
+        self.db.write_many([], [k for (k, v) in self.db.iterate() if k.startswith(SEEN_PREFIX)])
+
+    def remove(self):
+        self.db.close()
+        for path in (self.path, self.path + '-lock'):
+            if os.path.exists(path):
+                os.unlink(path)
+
+
+class PathIndex:
+    ''' Paths of the items in a drive listing, equivalent to
+    OneDriveClient.expand_path(). The path of each folder is computed at most
+    once and remembered, so looking up an item costs a join instead of a walk
+    up the tree. '''
+
+    def __init__(self, items):
+        self.items = items
+        # folder ID -> path, for plain and filesystem-safe paths
+        self._prefixes = ({}, {})
+
+    def _prefix(self, item_id, fs_safe):
+        prefixes = self._prefixes[fs_safe]
+        if item_id in prefixes:
+            return prefixes[item_id]
+
+        # Walk up to the nearest ancestor we already know about, then fill
+        # in the chain on the way back down.
+        chain = []
+        while item_id not in prefixes:
+            item = self.items[item_id]
+            if 'id' not in item['parentReference']:
+                prefixes[item_id] = ''
+                break
+            chain.append(item)
+            item_id = item['parentReference']['id']
+
+        prefix = prefixes[item_id]
+        for item in reversed(chain):
+            prefix = self._join(prefix, item['name'], fs_safe)
+            prefixes[item['id']] = prefix
+        return prefix
+
+    @staticmethod
+    def _join(prefix, name, fs_safe):
+        if fs_safe:
+            name = '/'.join(chunky_path(name))
+        if prefix:
+            return '/'.join([prefix, name])
+        return name
+
+    def _path(self, item_id, fs_safe):
+        item = self.items[item_id]
+        if 'folder' in item or 'id' not in item['parentReference']:
+            path = self._prefix(item_id, fs_safe)
+        else:
+            path = self._join(self._prefix(item['parentReference']['id'], fs_safe), item['name'], fs_safe)
+        return path or '/'
+
+    def path(self, item_id):
+        return self._path(item_id, False)
+
+    def fs_path(self, item_id):
+        ''' The path with long names split into chunks that fit in a Unix
+        filename. '''
+        return self._path(item_id, True)
+
+
+def writer(fmt=None, path=None):
+    fmt = fmt or 'json'
+    if fmt == 'json':
+        return JSONWriter(path)
+    if fmt == 'ndjson':
+        return NDJSONWriter(path)
+    if fmt == 'lmdb':
+        if not path:
+            raise ValueError('lmdb output requires an output path')
+        return LMDBWriter(path)
+    raise ValueError('unknown metadata format {}, expected one of {}'.format(fmt, ', '.join(FORMATS)))
+
+
+def _load_ndjson(f):
+    metadata = {'items': {}}
+    for line in f:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if TRAILER_KEY in record:
+            metadata.update(record[TRAILER_KEY])
+        elif DELETED_KEY in record:
+            metadata['items'].pop(record['id'], None)
+        elif 'id' in record:
+            metadata['items'][record['id']] = record
+        else:
+            # A complete JSON document that happens to be on one line
+            return record
+    return metadata
+
+
+def _load_lmdb(path):
+    db = Database(path)
+    metadata = {'items': {}}
+    for (key, value) in db.iterate():
+        if key == TRAILER_KEY:
+            metadata.update(value)
+        else:
+            metadata['items'][key] = value
+    db.close()
+    return metadata
+
+
+def load(path):
+    ''' Read metadata written in any of the supported formats. '''
+    with open(path, 'rb') as f:
+        head = f.read(4096).lstrip()
+        if not head.startswith(b'{'):
+            return _load_lmdb(path)
+        f.seek(0)
+        if head.split(b'\n', 1)[0].strip() == b'{':
+            return json.load(f)
+        return _load_ndjson(f)
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+
+# This file is part of ODM and distributed under the terms of the
+# MIT license. See COPYING.
+
+import atexit
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from collections import Counter, defaultdict
+from urllib.parse import unquote, urlsplit
+
+try:
+    from boxsdk.network.default_network import DefaultNetwork
+except ImportError:
+    DefaultNetwork = object
+
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, float('inf'))
+
+# Path segments that are followed by an identifier
+COLLECTIONS = {
+    'channels',
+    'drives',
+    'files',
+    'folders',
+    'groups',
+    'items',
+    'messages',
+    'notebooks',
+    'pages',
+    'permissions',
+    'personal',
+    'sections',
+    'sites',
+    'teams',
+    'users',
+}
+
+ID_RE = re.compile(r'^(?:\d+|[0-9a-fA-F-]{32,}|(?=.*\d)[-\w!.=]{16,}|.*@.*)$')
+PATH_RE = re.compile(r':/.*?:(?=/|$)')
+
+
+def endpoint_class(method, url):
+    ''' Collapse a URL into a low-cardinality label by replacing identifiers
+    and path-based addressing with placeholders. '''
+    path = PATH_RE.sub(':/{path}:', unquote(urlsplit(url).path))
+    segments = []
+    previous = None
+    for segment in path.strip('/').split('/'):
+        if previous in COLLECTIONS or ID_RE.match(segment):
+            segment = '{id}'
+        segments.append(segment)
+        previous = segment
+    return '{} /{}'.format(method.upper(), '/'.join(segments))
+
+
+def _body_size(body):
+    if body is None:
+        return 0
+    if isinstance(body, (bytes, bytearray, str)):
+        return len(body)
+    if hasattr(body, 'fileno'):
+        try:
+            return os.fstat(body.fileno()).st_size - body.tell()
+        except (OSError, ValueError):
+            return 0
+    if hasattr(body, 'len'):
+        return body.len
+    return 0
+
+
+def request_size(kwargs):
+    ''' The size of the body a requests call is about to send, or None if it
+    should be taken from the prepared request afterwards. File bodies have to
+    be measured up front, since sending them leaves them at EOF. '''
+    if kwargs.get('data') is None:
+        return None
+    return _body_size(kwargs['data'])
+
+
+def _response_size(response):
+    if 'content-length' in response.headers:
+        try:
+            return int(response.headers['content-length'])
+        except ValueError:
+            pass
+    if getattr(response, '_content_consumed', True):
+        return len(response.content or b'')
+    return 0
+
+
+def _labels(**kwargs):
+    return ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for (k, v) in kwargs.items())
+
+
+class Metrics:
+    ''' Process-wide request statistics. Forked children have their own
+    copy, so work done in a multiprocessing pool isn't counted. '''
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._exporter = None
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.latency = defaultdict(lambda: [0] * len(BUCKETS))
+            self.latency_sum = Counter()
+            self.requests = Counter()
+            self.status = Counter()
+            self.retries = Counter()
+            self.sleep = Counter()
+            self.transfer = Counter()
+
+    def record(self, backend, method, url, response, elapsed, sent=None):
+        ''' Record a single HTTP attempt. response is None if no response was
+        received; sent is the size of the request body, if it was measured
+        before sending. '''
+        key = (backend, endpoint_class(method, url))
+        received = 0
+        code = 'error'
+        if response is None:
+            sent = 0
+        else:
+            code = str(response.status_code)
+            if sent is None:
+                request = getattr(response, 'request', None)
+                sent = _body_size(request.body) if request is not None else 0
+            received = _response_size(response)
+
+        with self._lock:
+            self.requests[key] += 1
+            self.latency_sum[key] += elapsed
+            buckets = self.latency[key]
+            for (i, bound) in enumerate(BUCKETS):
+                if elapsed <= bound:
+                    buckets[i] += 1
+                    break
+            self.status[key + (code,)] += 1
+            self.transfer[(backend, 'up')] += sent
+            self.transfer[(backend, 'down')] += received
+
+    def record_retry(self, backend):
+        with self._lock:
+            self.retries[backend] += 1
+
+    def record_sleep(self, backend, reason, seconds):
+        ''' reason is 'throttle' for server-requested backoff, 'retry' for
+        backoff after an error, and 'budget' for waiting on the shared
+        request budget. '''
+        with self._lock:
+            self.sleep[(backend, reason)] += float(seconds)
+
+    def record_transfer(self, backend, direction, size):
+        ''' Count data moved outside of a recorded request, e.g. a streamed
+        download with no Content-Length. '''
+        with self._lock:
+            self.transfer[(backend, direction)] += size
+
+    def as_dict(self):
+        with self._lock:
+            endpoints = []
+            for (backend, endpoint) in sorted(self.requests):
+                key = (backend, endpoint)
+                endpoints.append({
+                    'backend': backend,
+                    'endpoint': endpoint,
+                    'count': self.requests[key],
+                    'latency_sum': self.latency_sum[key],
+                    'latency_buckets': dict(zip([str(x) for x in BUCKETS], self.latency[key])),
+                    'status': {k[2]: v for (k, v) in self.status.items() if k[:2] == key},
+                })
+            return {
+                'started': self.started,
+                'updated': time.time(),
+                'endpoints': endpoints,
+                'retries': dict(self.retries),
+                'sleep': {'{}.{}'.format(*k): v for (k, v) in self.sleep.items()},
+                'transfer': {'{}.{}'.format(*k): v for (k, v) in self.transfer.items()},
+            }
+
+    def as_prometheus(self):
+        lines = []
+        with self._lock:
+            lines.append('# TYPE odm_request_duration_seconds histogram')
+            for key in sorted(self.requests):
+                (backend, endpoint) = key
+                total = 0
+                for (bound, count) in zip(BUCKETS, self.latency[key]):
+                    total += count
+                    le = '+Inf' if bound == float('inf') else str(bound)
+                    lines.append('odm_request_duration_seconds_bucket{{{}}} {}'.format(
+                        _labels(backend=backend, endpoint=endpoint, le=le), total))
+                lines.append('odm_request_duration_seconds_sum{{{}}} {}'.format(
+                    _labels(backend=backend, endpoint=endpoint), self.latency_sum[key]))
+                lines.append('odm_request_duration_seconds_count{{{}}} {}'.format(
+                    _labels(backend=backend, endpoint=endpoint), self.requests[key]))
+
+            lines.append('# TYPE odm_responses_total counter')
+            for ((backend, endpoint, code), count) in sorted(self.status.items()):
+                lines.append('odm_responses_total{{{}}} {}'.format(_labels(backend=backend, endpoint=endpoint, code=code), count))
+
+            lines.append('# TYPE odm_retries_total counter')
+            for (backend, count) in sorted(self.retries.items()):
+                lines.append('odm_retries_total{{{}}} {}'.format(_labels(backend=backend), count))
+
+            lines.append('# TYPE odm_sleep_seconds_total counter')
+            for ((backend, reason), seconds) in sorted(self.sleep.items()):
+                lines.append('odm_sleep_seconds_total{{{}}} {}'.format(_labels(backend=backend, reason=reason), seconds))
+
+            lines.append('# TYPE odm_transfer_bytes_total counter')
+            for ((backend, direction), size) in sorted(self.transfer.items()):
+                lines.append('odm_transfer_bytes_total{{{}}} {}'.format(_labels(backend=backend, direction=direction), size))
+
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        ''' A few human-readable lines for the end of a run. '''
+        with self._lock:
+            backends = sorted(set(x[0] for x in self.requests))
+            lines = []
+            for backend in backends:
+                keys = [x for x in self.requests if x[0] == backend]
+                count = sum(self.requests[x] for x in keys)
+                latency = sum(self.latency_sum[x] for x in keys)
+                codes = Counter()
+                for (k, v) in self.status.items():
+                    if k[0] == backend:
+                        codes[k[2]] += v
+                slowest = max(keys, key=lambda x: self.latency_sum[x])
+                lines.append(
+                    '{}: {} requests ({}), {} retries, mean latency {:.3f}s, '
+                    'slept {:.1f}s throttled, {:.1f}s retrying, {:.1f}s waiting for budget, '
+                    '{:.2f} MiB up, {:.2f} MiB down, most time in {}'.format(
+                        backend,
+                        count,
+                        ', '.join('{} {}'.format(v, k) for (k, v) in sorted(codes.items())),
+                        self.retries[backend],
+                        latency / count,
+                        self.sleep[(backend, 'throttle')],
+                        self.sleep[(backend, 'retry')],
+                        self.sleep[(backend, 'budget')],
+                        self.transfer[(backend, 'up')] / (1024 ** 2),
+                        self.transfer[(backend, 'down')] / (1024 ** 2),
+                        slowest[1],
+                    )
+                )
+            return lines
+
+    def export(self, path, fmt='prometheus'):
+        if fmt == 'json':
+            content = json.dumps(self.as_dict(), indent=2)
+        else:
+            content = self.as_prometheus()
+
+        # Write atomically so that collectors never see a partial file
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(content)
+        os.rename(tmp, path)
+
+    def start_export(self, path, fmt='prometheus', interval=30):
+        ''' Periodically write the current metrics to path, and once more at
+        exit. '''
+        if self._exporter:
+            return
+
+        def _export():
+            try:
+                self.export(path, fmt)
+            except OSError as e:
+                self.logger.warning('Unable to export metrics: %s', e)
+
+        def _loop():
+            while True:
+                time.sleep(interval)
+                _export()
+
+        self._exporter = threading.Thread(target=_loop, daemon=True)
+        self._exporter.start()
+        atexit.register(_export)
+
+
+METRICS = Metrics()
+
+
+def configure(config):
+    ''' Start exporting metrics if the config asks for it. '''
+    metrics_config = config.get('metrics')
+    if metrics_config:
+        METRICS.start_export(
+            metrics_config['path'],
+            metrics_config.get('format', 'prometheus'),
+            metrics_config.get('interval', 30),
+        )
+
+
+class MetricsNetwork(DefaultNetwork):
+    ''' boxsdk network layer that records requests and retry sleeps. '''
+
+    def request(self, method, url, access_token, **kwargs):
+        sent = request_size(kwargs)
+        start = time.monotonic()
+        response = None
+        try:
+            response = super(MetricsNetwork, self).request(method, url, access_token, **kwargs)
+            return response
+        finally:
+            METRICS.record(
+                'box',
+                method,
+                url,
+                getattr(response, 'request_response', None),
+                time.monotonic() - start,
+                sent,
+            )
+
+    def retry_after(self, delay, request_method, *args, **kwargs):
+        METRICS.record_retry('box')
+        METRICS.record_sleep('box', 'retry', delay)
+        return super(MetricsNetwork, self).retry_after(delay, request_method, *args, **kwargs)
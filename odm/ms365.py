@@ -5,6 +5,7 @@
 
 import logging
 import os
+import threading
 import time
 import uuid
 
@@ -17,7 +18,6 @@ except ImportError:
 
 from requests.exceptions import HTTPError, RetryError
 
-from odm import quickxorhash
 from odm.util import ChunkyFile
 
 
@@ -69,7 +69,7 @@ class Container(object):
     def _find_notebook(self, name):
         # Find the created notebook in OneDrive. I hate this.
         folder = self.drive.root.get_folder('Notebooks')
-        for child in folder.children:
+        for child in folder.iter_children():
             if child['name'] == name:
                 return Notebook(self.client, child)
 
@@ -162,7 +162,7 @@ class Group(Container):
 
             for owner in owners:
                 user = User(client, client.mangle_user(owner))
-                payload['owners@odata.bind'].append('https://graph.microsoft.com/v1.0/users/{}'.format(user.show()['id']))
+                payload['owners@odata.bind'].append('{}users/{}'.format(client.msgraph.baseurl, user.show()['id']))
             payload['members@odata.bind'] = list(payload['owners@odata.bind'])
 
         if members:
@@ -171,7 +171,7 @@ class Group(Container):
 
             for member in members:
                 user = User(client, client.mangle_user(member))
-                payload['members@odata.bind'].append('https://graph.microsoft.com/v1.0/users/{}'.format(user.show()['id']))
+                payload['members@odata.bind'].append('{}users/{}'.format(client.msgraph.baseurl, user.show()['id']))
 
         result = client.msgraph.post('/groups', json=payload)
         result.raise_for_status()
@@ -295,6 +295,7 @@ class Drive(object):
     def __init__(self, client, raw):
         self.client = client
         self.raw = raw
+        self.logger = logging.getLogger(__name__)
 
         if raw:
             self.root = DriveFolder(client, client.get_list('drives/{}/root'.format(raw['id'])))
@@ -305,79 +306,213 @@ class Drive(object):
     def __str__(self):
         return self.raw.get('id', 'None')
 
-    def delta(self, base, include_permissions=True):
-        include_delta = False
-
+    def _merge_page(self, enumeration, page, include_permissions):
+        permissions = {}
+        if include_permissions:
+            with self.client.msgraph.batch() as batch:
+                for item in page['value']:
+                    if 'deleted' not in item:
+                        permissions[item['id']] = batch.get(permissions_path(item))
+
+        for item in page['value']:
+            perms = None
+            if item['id'] in permissions:
+                perms = permissions_result(item, permissions[item['id']].result(), self.logger)
+            enumeration.merge_item(item, perms)
+
+    def delta(self, base, include_permissions=True, on_page=None, checkpoint=None):
+        ''' Merge the changes since base['token'] into base. If checkpoint is
+        an odm.metadata.Checkpoint, progress is saved after every page and an
+        interrupted enumeration of the same drive is resumed from it. '''
         if not self.raw:
             return {}
 
-        path = 'drives/{}/root/delta?select=deleted,file,fileSystemInfo,folder,id,malware,name,package,parentReference,size'.format(self.raw['id'])
+        enumeration = DeltaEnumeration(self.raw['id'], base, on_page, checkpoint)
+
+        # Merge each page as it arrives so that we never hold more than one
+        # page of results in addition to the base.
+        while enumeration.next:
+            try:
+                for page in self.client.iter_pages(enumeration.next):
+                    self._merge_page(enumeration, page, include_permissions)
+                    enumeration.merged(page)
+            except HTTPError as e:
+                if e.response is None or e.response.status_code != 410:
+                    raise
+                enumeration.expired()
+            else:
+                enumeration.check_complete()
 
-        token = base.get('token')
-        if token:
-            include_delta = True
-            # FIXME: need to deal with expired tokens
-            path += '&token={}'.format(token)
+        return enumeration.finish()
 
-        result = self.client.get_list(path)
 
-        base['token'] = result['@odata.deltaLink'].split('=')[-1]
+class DeltaEnumeration(object):
+    ''' The bookkeeping for merging a delta enumeration of a drive into
+    base, shared by Drive.delta() and the asyncio client. The caller fetches
+    the pages starting from `next`, passes their items to merge_item() and
+    each finished page to merged(), and calls expired() if the server
+    responds with 410 Gone. '''
 
-        delta = {
-            'deleted': [],
-            'changed': [],
+    def __init__(self, drive_id, base, on_page=None, checkpoint=None):
+        self.drive_id = drive_id
+        self.base = base
+        self.on_page = on_page
+        self.checkpoint = checkpoint
+        self.logger = logging.getLogger(__name__)
+        self.state = {
+            'drive': drive_id,
+            'next': delta_path(drive_id, base.get('token')),
+            'include_delta': bool(base.get('token')),
+            'resync': False,
+            'delta': {
+                'deleted': [],
+                'changed': [],
+            },
         }
+        self.seen = set()
+
+        if checkpoint:
+            saved = checkpoint.load()
+            if saved and saved[1]['drive'] == drive_id:
+                self.logger.info('Resuming delta enumeration of %s from %s', drive_id, checkpoint.path)
+                (saved_base, self.state, self.seen) = saved
+                item_ids = set(base['items']).union(saved_base['items'])
+                base.clear()
+                base.update(saved_base)
+                if on_page:
+                    on_page(base['items'], list(item_ids))
+            else:
+                checkpoint.start(base, self.state)
 
-        while len(result['value']):
-            item = result['value'].pop(0)
-            old = base['items'].pop(item['id'], None)
-            if 'deleted' in item:
-                # Save the whole old item, since we don't want to pollute
-                # `items` with deleted things.
-                if old:
-                    delta['deleted'].append(old)
+    @property
+    def next(self):
+        return self.state['next']
+
+    def merge_item(self, item, permissions=None):
+        merge_delta_item(self.base, self.state['delta'], item, permissions, self.state['resync'])
+
+    def merged(self, page):
+        item_ids = [item['id'] for item in page['value']]
+        page_seen = []
+        if self.state['resync']:
+            page_seen = [x for x in item_ids if x not in self.seen]
+            self.seen.update(page_seen)
+
+        self.state['next'] = page.get('@odata.nextLink')
+        if '@odata.deltaLink' in page:
+            self.state['token'] = page['@odata.deltaLink'].split('=')[-1]
+
+        if self.checkpoint:
+            self.checkpoint.save(self.base, item_ids, self.state, page_seen)
+        if self.on_page:
+            self.on_page(self.base['items'], item_ids)
+
+    def expired(self):
+        # The token (or a nextLink derived from it) has expired, so enumerate
+        # the whole drive again and reconcile it with what we already have.
+        self.logger.warning('Delta token for %s expired, resynchronizing', self.drive_id)
+        self.state['next'] = delta_path(self.drive_id)
+        self.state['resync'] = True
+        self.seen = set()
+        if self.checkpoint:
+            self.checkpoint.reset_seen()
+            self.checkpoint.save(self.base, [], self.state)
+
+    def check_complete(self):
+        if self.state['next']:
+            # The pages stopped early, so retrying the same link isn't going
+            # to get us anywhere.
+            raise RuntimeError('Failed to fetch delta page {}'.format(self.state['next']))
+
+    def finish(self):
+        if self.state['resync']:
+            # Anything we didn't see during a full enumeration is gone
+            removed = [x for x in self.base['items'] if x not in self.seen]
+            for item_id in removed:
+                self.state['delta']['deleted'].append(self.base['items'].pop(item_id))
+            if self.on_page:
+                self.on_page(self.base['items'], removed)
+
+        if 'token' not in self.state:
+            raise RuntimeError('Delta enumeration of {} finished without a deltaLink'.format(self.drive_id))
+        self.base['token'] = self.state['token']
+
+        if self.state['include_delta']:
+            self.base['delta'] = self.state['delta']
+
+        return self.base
+
+
+def delta_path(drive_id, token=None):
+    path = 'drives/{}/root/delta?select=deleted,file,fileSystemInfo,folder,id,malware,name,package,parentReference,size'.format(drive_id)
+    if token:
+        path += '&token={}'.format(token)
+    return path
+
+
+def permissions_path(item):
+    return 'drives/{}/items/{}?select=id,permissions&expand=permissions'.format(item['parentReference']['driveId'], item['id'])
+
+
+def permissions_result(item, response, logger):
+    ''' Extract the permissions from the response to a permissions_path()
+    request. Items that have vanished or can't be read are merged without
+    permissions; anything else that failed (e.g. throttling that outlasted
+    the retries) raises, so the page isn't merged with bogus data. '''
+    if response.status_code in (403, 404):
+        logger.warning('Unable to fetch permissions for %s: %d', item['id'], response.status_code)
+        return None
+    response.raise_for_status()
+    return response.json()
 
-            else:
-                if include_permissions:
-                    item.update(
-                        self.client.msgraph.get(
-                            'drives/{}/items/{}?select=id,permissions&expand=permissions'.format(item['parentReference']['driveId'], item['id'])
-                        ).json()
-                    )
 
-                # Don't record inherited permissions
-                perms = item.pop('permissions', None)
-                if perms and 'inheritedFrom' not in perms[0]:
-                    item['permissions'] = perms
+def merge_delta_item(base, delta, item, permissions=None, resync=False):
+    ''' Merge one item from a delta page into base, recording what changed
+    in delta. During a resync every item is returned, so unchanged items are
+    not reported. '''
+    old = base['items'].pop(item['id'], None)
+    if 'deleted' in item:
+        # Save the whole old item, since we don't want to pollute
+        # `items` with deleted things.
+        if old:
+            delta['deleted'].append(old)
+        return
 
-                # Remove unused odata information
-                for key in list(item):
-                    if '@odata' in key:
-                        item.pop(key, None)
+    if permissions:
+        item.update(permissions)
 
-                if old:
-                    # Drop information about previous renames
-                    old.pop('oldName', None)
+    # Don't record inherited permissions
+    perms = item.pop('permissions', None)
+    if perms and 'inheritedFrom' not in perms[0]:
+        item['permissions'] = perms
 
-                    # Save the old name if it's different
-                    if old['name'] != item['name']:
-                        old['oldName'] = old['name']
+    # Remove unused odata information
+    for key in list(item):
+        if '@odata' in key:
+            item.pop(key, None)
 
-                    old.update(item)
+    if old and resync and all(old.get(k) == v for (k, v) in item.items()):
+        base['items'][item['id']] = old
+        return
 
-                    # Only need to save the ID here, everything else should be
-                    # determinable from the main entry.
-                    delta['changed'].append(old['id'])
+    if old:
+        # Drop information about previous renames
+        old.pop('oldName', None)
 
-                    base['items'][item['id']] = old
+        # Save the old name if it's different
+        if old['name'] != item['name']:
+            old['oldName'] = old['name']
 
-                else:
-                    base['items'][item['id']] = item
+        old.update(item)
+
+        # Only need to save the ID here, everything else should be
+        # determinable from the main entry.
+        delta['changed'].append(old['id'])
 
-        if include_delta:
-            base['delta'] = delta
+        base['items'][item['id']] = old
 
-        return base
+    else:
+        base['items'][item['id']] = item
 
 
 class DriveItem(object):
@@ -443,20 +578,31 @@ class DriveFolder(DriveItem):
     def __init__(self, client, raw):
         super(DriveFolder, self).__init__(client, raw)
         self._children = None
+        # Uploads resolve sibling folders from several threads at once
+        self._children_lock = threading.Lock()
+
+    def iter_children(self, page_size=None):
+        return self.client.iter_list(
+            'drives/{}/items/{}/children'.format(self.raw['parentReference']['driveId'], self.raw['id']),
+            page_size,
+        )
 
     @property
     def children(self):
-        if not self._children:
-            self._children = self.client.get_list('drives/{}/items/{}/children'.format(self.raw['parentReference']['driveId'], self.raw['id']))['value']
-        return self._children
+        with self._children_lock:
+            if not self._children:
+                self._children = list(self.iter_children(999))
+            return self._children
 
     def get_child(self, name):
         # No leading or trailing whitespace
         name = name.strip()
 
         # Check to see if we already have metadata for this file
-        if self._children:
-            for child in self._children:
+        with self._children_lock:
+            children = self._children
+        if children:
+            for child in children:
                 if child['name'] == name:
                     return child
 
@@ -486,7 +632,8 @@ class DriveFolder(DriveItem):
             return None
 
         # Invalidate cache
-        self._children = None
+        with self._children_lock:
+            self._children = None
 
         self.logger.debug('Creating folder %s', name)
         payload = {
@@ -512,7 +659,8 @@ class DriveFolder(DriveItem):
             return None
 
         # Invalidate cache
-        self._children = None
+        with self._children_lock:
+            self._children = None
 
         self.logger.debug('Creating notebook %s', name)
 
@@ -552,8 +700,7 @@ class DriveFolder(DriveItem):
             # Probably a OneNote file.
             return match
 
-        h = quickxorhash.QuickXORHash()
-        fhash = h.hash_file(src)
+        fhash = self.client.hash_file(src)
         if fhash == match['file']['hashes']['quickXorHash']:
             self.logger.info('Verified uploaded %s', src)
             return match
@@ -4,8 +4,12 @@
 # MIT license. See COPYING.
 
 import base64
+import functools
 import logging
 import os
+import threading
+
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import requests
 import requests_toolbelt
@@ -13,23 +17,78 @@ import requests_toolbelt
 from bs4 import BeautifulSoup
 
 from odm import inkml, onedrivesession, quickxorhash, sharepointsession
-from odm.util import KETSUBAN, chunky_path
+from odm.hashcache import HashCache
+from odm.metrics import METRICS
+from odm.tokencache import TokenCache
+from odm.util import KETSUBAN, HashingWriter, PartFile, RangeNotSatisfied, chunky_path, download_ranges, segment_config, segment_ranges
+
+
+# Downloads are read in pieces this big; a dropped connection loses whatever
+# part of a piece had already arrived.
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+def hash_local_file(path, hash_cache=None, hash_workers=None):
+    if hash_cache:
+        return hash_cache.digest(path, 'quickXorHash')
+    return quickxorhash.hash_file_parallel(path, hash_workers)
+
+
+def verify_local_file(dest, size=None, file_hash=None, strict=True, hash_cache=None, hash_workers=None):
+    ''' OneDriveClient.verify_file() without the client, so that it can be
+    handed to worker processes. '''
+    logger = logging.getLogger(__name__)
+
+    if not os.path.exists(dest):
+        logger.info('%s does not exist', dest)
+        return False
+
+    if strict and size is None and file_hash is None:
+        logger.debug('No size or hash provided for %s', dest)
+        return False
+
+    if size is not None:
+        stat = os.stat(dest)
+        if stat.st_size != size:
+            logger.info('%s is the wrong size: expected %d, got %d', dest, size, stat.st_size)
+            return False
+
+    if file_hash:
+        real_hash = hash_local_file(dest, hash_cache, hash_workers)
+        if real_hash != file_hash:
+            logger.info('%s has the wrong hash: expected %s, got %s', dest, file_hash, real_hash)
+            return False
+
+    return True
 
 
 class OneDriveClient:
     def __init__(self, config):
         self.config = config
         self.logger = logging.getLogger(__name__)
-        self.msgraph = onedrivesession.OneDriveSession(self.config.get('domain'), self.config['microsoft'], self.config.get('timeout', 60))
+        self.token_cache = TokenCache.from_config(self.config)
+        self.msgraph = onedrivesession.OneDriveSession(
+            self.config.get('domain'),
+            self.config['microsoft'],
+            self.config.get('timeout', 60),
+            token_cache=self.token_cache,
+        )
         self._sharepoint = {}
+        self._sharepoint_lock = threading.Lock()
+        self._destdirs = set()
+        self.hash_cache = HashCache.from_config(self.config)
+        # Files at least this large are downloaded over several connections
+        (self.segment_threshold, self.segments) = segment_config(self.config)
 
     def sharepoint(self, site_url):
-        if site_url not in self._sharepoint:
-            self._sharepoint[site_url] = sharepointsession.SharepointSession(
-                site_url,
-                self.config['microsoft'],
-                self.config.get('timeout', 60),
-            )
+        with self._sharepoint_lock:
+            if site_url not in self._sharepoint:
+                self._sharepoint[site_url] = sharepointsession.SharepointSession(
+                    site_url,
+                    self.config['microsoft'],
+                    self.config.get('timeout', 60),
+                    token_cache=self.token_cache,
+                )
         return self._sharepoint[site_url]
 
     def mangle_user(self, username):
@@ -72,19 +131,60 @@ class OneDriveClient:
 
         return result
 
+    def _get_page(self, path):
+        result = self.msgraph.get(path, allow_redirects=False)
+        if result.status_code == 404:
+            return None
+        result.raise_for_status()
+        return result.json()
+
+    def _fetch_page(self, executor, path):
+        if executor:
+            return executor.submit(self._get_page, path)
+        future = Future()
+        future.set_result(self._get_page(path))
+        return future
+
+    def iter_pages(self, path, page_size=None, prefetch=True):
+        ''' Yield each page of a collection as it arrives, optionally fetching
+        the next page in the background while the caller works on this one. '''
+        if page_size:
+            path += '{}$top={}'.format('&' if '?' in path else '?', page_size)
+
+        executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        try:
+            future = self._fetch_page(executor, path)
+            while future:
+                page = future.result()
+                if page is None:
+                    return
+                future = None
+                if '@odata.nextLink' in page:
+                    self.logger.debug('Getting next page...')
+                    future = self._fetch_page(executor, page['@odata.nextLink'])
+                yield page
+        finally:
+            if executor:
+                executor.shutdown(wait=False)
+
+    def iter_list(self, path, page_size=None, prefetch=True):
+        ''' Like get_list(), but yields items one at a time instead of
+        collecting the whole collection in memory. '''
+        for page in self.iter_pages(path, page_size, prefetch):
+            for item in page.get('value', []):
+                yield item
+
     def list_users(self):
-        users = self.get_list(
-            'users?$select=id,displayName,givenName,jobTitle,mail,userPrincipalName,accountEnabled,onPremisesImmutableId,onPremisesSyncEnabled'
+        return self.iter_list(
+            'users?$select=id,displayName,givenName,jobTitle,mail,userPrincipalName,accountEnabled,onPremisesImmutableId,onPremisesSyncEnabled',
+            page_size=999,
         )
-        if users:
-            return users['value']
-        return []
 
     def list_sites(self):
-        return self.get_list('sites?search=')['value']
+        return self.iter_list('sites?search=')
 
     def list_groups(self):
-        return self.get_list('groups')['value']
+        return self.iter_list('groups', page_size=999)
 
     def expand_path(self, item_id, items, fs_safe=False):
         path = []
@@ -104,65 +204,165 @@ class OneDriveClient:
             return '/'.join(path)
         return '/'
 
+    def hash_file(self, path):
+        return hash_local_file(path, self.hash_cache, self.config.get('hash_workers'))
+
     def verify_file(self, dest, size=None, file_hash=None, strict=True):
-        if not os.path.exists(dest):
-            self.logger.info('%s does not exist', dest)
-            return False
+        return verify_local_file(dest, size, file_hash, strict, self.hash_cache, self.config.get('hash_workers'))
+
+    def _fetch_range(self, url, start, end, writer, validator):
+        headers = {'Range': 'bytes={}-{}'.format(start, end)}
+        if validator.get('etag'):
+            headers['If-Range'] = validator['etag']
+        with self.msgraph.get(url, stream=True, headers=headers, timeout=self.config.get('timeout', 60) * 20) as r:
+            r.raise_for_status()
+            if r.status_code != 206:
+                raise RangeNotSatisfied(url)
+            validator.setdefault('etag', r.headers.get('etag'))
+            for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                writer.write(chunk)
+
+    def _download_segmented(self, url, part, size, calculate_hash=False):
+        ''' Fetch a large file as several concurrent ranges, picking up
+        where a previous attempt left off. Returns None if the server doesn't
+        support ranges. '''
+        state = part.load()
+        progress = []
+        if (
+            state.get('size') == size
+            and state.get('etag')
+            and len(state.get('segments', [])) == len(segment_ranges(size, self.segments))
+        ):
+            progress = state['segments']
+            self.logger.info('Resuming download of %s', part.dest)
+        validator = {'etag': state.get('etag')} if progress else {}
+
+        new_hash = None
+        if calculate_hash and quickxorhash.numpy is not None and not progress:
+            # Combining per-segment state needs a backend that exposes it
+            new_hash = functools.partial(quickxorhash.QuickXORHash, 'numpy')
+
+        self.logger.debug('Downloading %s in %d segments', part.dest, self.segments)
+        try:
+            segments = download_ranges(
+                functools.partial(self._fetch_range, url, validator=validator),
+                part.path,
+                size,
+                self.segments,
+                new_hash,
+                progress,
+            )
+        except RangeNotSatisfied:
+            self.logger.debug('Range requests are not satisfiable for %s', url)
+            part.discard()
+            return None
+        except Exception:
+            if validator.get('etag'):
+                part.sync()
+                part.save({'etag': validator['etag'], 'size': size, 'segments': progress})
+            raise
 
-        if strict and size is None and file_hash is None:
-            self.logger.debug('No size or hash provided for %s', dest)
-            return False
+        part.commit()
 
-        if size is not None:
-            stat = os.stat(dest)
-            if stat.st_size != size:
-                self.logger.info('%s is the wrong size: expected %d, got %d', dest, size, stat.st_size)
-                return False
+        if not calculate_hash:
+            return True
 
-        if file_hash:
-            h = quickxorhash.QuickXORHash()
-            real_hash = h.hash_file(dest)
-            if real_hash != file_hash:
-                self.logger.info('%s has the wrong hash: expected %s, got %s', dest, file_hash, real_hash)
-                return False
+        if new_hash is None:
+            return self.hash_file(part.dest)
 
-        return True
+        h = quickxorhash.QuickXORHash('numpy')
+        for (offset, length, segment) in segments:
+            h.combine(segment.state(), length, offset)
+        return h.finalize()
 
-    def _download(self, url, dest, calculate_hash=False):
+    def _download(self, url, dest, calculate_hash=False, size=None):
+        ''' Download url to dest via dest.part, resuming a previous partial
+        download if the server still has the same version of the file. '''
         destdir = os.path.dirname(dest)
-        if not os.path.exists(destdir):
-            os.makedirs(destdir, 0o0755)
+        if destdir not in self._destdirs:
+            os.makedirs(destdir, 0o0755, exist_ok=True)
+            self._destdirs.add(destdir)
 
-        h = None
-        if calculate_hash:
-            h = quickxorhash.QuickXORHash()
+        part = PartFile(dest)
+
+        if size is not None and size >= self.segment_threshold and self.segments > 1:
+            try:
+                result = self._download_segmented(url, part, size, calculate_hash)
+            except (requests.exceptions.RequestException, IOError) as e:
+                self.logger.warning(e)
+                return None
+            if result is not None:
+                return result
+
+        headers = {}
+        state = part.load()
+        offset = 0
+        if state.get('etag') and 'segments' not in state:
+            offset = min(part.size(), state.get('written', part.size()))
+        if offset:
+            headers['Range'] = 'bytes={}-'.format(offset)
+            headers['If-Range'] = state['etag']
 
+        h = None
         try:
-            with self.msgraph.get(url, stream=True, timeout=self.config.get('timeout', 60) * 20) as r:
+            with self.msgraph.get(url, stream=True, headers=headers, timeout=self.config.get('timeout', 60) * 20) as r:
                 r.raise_for_status()
                 if r.headers['content-type'].startswith('multipart/'):
                     decoder = requests_toolbelt.MultipartDecoder.from_response(r)
-                    for part in decoder.parts:
-                        with open('{}.{}'.format(dest, part.headers['content-type'].split(';')[0].replace('/', '_')), 'wb') as f:
-                            f.write(part.content)
+                    for mime_part in decoder.parts:
+                        with open('{}.{}'.format(dest, mime_part.headers['content-type'].split(';')[0].replace('/', '_')), 'wb') as f:
+                            f.write(mime_part.content)
+                    return True
+
+                if r.status_code == 206:
+                    self.logger.info('Resuming download of %s at byte %d', dest, offset)
                 else:
-                    with open(dest, 'wb') as f:
-                        for chunk in r.iter_content(chunk_size=1024 * 1024):
+                    # The file changed, or the server ignored the range
+                    offset = 0
+                state = {'etag': r.headers.get('etag'), 'size': size}
+                if state['etag']:
+                    part.save(state)
+
+                if calculate_hash and not offset:
+                    h = quickxorhash.QuickXORHash()
+
+                # Without a Content-Length the request metrics can't
+                # know how much we downloaded.
+                counted = 'content-length' in r.headers
+                completed = False
+                try:
+                    with HashingWriter(part.path, h, offset=offset) as f:
+                        for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
                             f.write(chunk)
-                            if h is not None:
-                                h.update(bytearray(chunk))
+                            if not counted:
+                                METRICS.record_transfer('graph', 'down', len(chunk))
+                    completed = True
+                finally:
+                    if state['etag']:
+                        if not completed:
+                            # Make sure the sidecar never claims more than
+                            # actually made it to disk.
+                            part.sync()
+                        state['written'] = part.size()
+                        part.save(state)
         except requests.exceptions.RequestException as e:
             self.logger.warning(e)
             return None
-        if calculate_hash:
-            return h.finalize()
-        return True
 
-    def download_file(self, drive_id, file_id, dest):
+        part.commit()
+
+        if not calculate_hash:
+            return True
+        if h is None:
+            # Part of the file came from an earlier attempt
+            return self.hash_file(dest)
+        return h.finalize()
+
+    def download_file(self, drive_id, file_id, dest, size=None):
         url = self.get_list('drives/{}/items/{}/content'.format(drive_id, file_id))
 
         if url:
-            return self._download(url['location'], dest, True)
+            return self._download(url['location'], dest, True, size)
         else:
             self.logger.error('Failed to fetch download link from API')
             return None
@@ -5,6 +5,7 @@
 
 import logging
 import random
+import threading
 import time
 
 import requests
@@ -13,18 +14,28 @@ import requests_oauthlib
 from oauthlib.oauth2 import BackendApplicationClient
 
 from . import __version__
+from .graphbatch import GraphBatch
+from .metrics import METRICS, request_size
+from .throttle import SharedThrottle
+from .tokencache import REFRESH_MARGIN
 
 
 class OneDriveSession(requests_oauthlib.OAuth2Session):
-    def __init__(self, domain, ms_config, timeout, **kwargs):
-        self.baseurl = 'https://graph.microsoft.com/v1.0/'
+    def __init__(self, domain, ms_config, timeout, token_cache=None, **kwargs):
+        self.baseurl = ms_config.get('graph_url', 'https://graph.microsoft.com/v1.0/')
         self.logger = logging.getLogger(__name__)
         self.domain = domain
         self.ms_config = ms_config
         self.timeout = timeout
+        self.token_cache = token_cache
+        self.throttle = SharedThrottle.from_config(ms_config['client_id'], ms_config)
+        self.max_attempts = ms_config.get('max_attempts', 30)
+        self._token_lock = threading.Lock()
         client = BackendApplicationClient(client_id=ms_config['client_id'])
         kwargs['client'] = client
         super(OneDriveSession, self).__init__(**kwargs)
+        self.pool_size = 0
+        self.set_pool_size(ms_config.get('pool_size', 10))
         # This is just so OAuth2Session.request() will call refresh_token()
         self.auto_refresh_url = 'placeholder'
         # This is just so OAuth2Session.request() won't raise TokenUpdated
@@ -34,10 +45,29 @@ class OneDriveSession(requests_oauthlib.OAuth2Session):
             'User-Agent': 'odm/{} ({})'.format(__version__, ms_config['client_id']),
         })
 
-    def _fresh_token(self):
+    def set_pool_size(self, pool_size):
+        ''' Make sure that at least pool_size connections per host can be
+        kept open, e.g. for that many worker threads. '''
+        if pool_size > self.pool_size:
+            self.pool_size = pool_size
+            self.mount('https://', requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+
+    @property
+    def token_url(self):
+        return '{}{}/oauth2/v2.0/token'.format(self.ms_config.get('login_url', 'https://login.microsoftonline.com/'), self.domain)
+
+    def _fresh_token(self, rejected=None):
+        if self.token_cache:
+            token = self.token_cache.get('microsoft', self.ms_config['client_id'], self.domain)
+            # Don't hand back a token the server has already turned down,
+            # but do use one that another process has fetched since.
+            if token and (not rejected or token['access_token'] != rejected['access_token']):
+                self.token = token
+                return
+
         self.logger.debug('Fetching fresh authorization token.')
         self.fetch_token(
-            token_url='https://login.microsoftonline.com/{}/oauth2/v2.0/token'.format(self.domain),
+            token_url=self.token_url,
             client_id=self.ms_config['client_id'],
             client_secret=self.ms_config['client_secret'],
             include_client_id=True,
@@ -46,8 +76,25 @@ class OneDriveSession(requests_oauthlib.OAuth2Session):
             ],
         )
 
+        if self.token_cache:
+            self.token_cache.store('microsoft', self.ms_config['client_id'], self.domain, None, self.token, self.token['expires_at'])
+
+    def batch(self):
+        return GraphBatch(self)
+
     def refresh_token(self, token_url, **kwargs):
-        self._fresh_token()
+        with self._token_lock:
+            # Another thread may have refreshed it while we were waiting
+            if self.token.get('expires_at', 0) > time.time() + REFRESH_MARGIN:
+                return self.token
+            self._fresh_token()
+        return self.token
+
+    def _reject_token(self, stale):
+        with self._token_lock:
+            # Only the first thread to notice gets a new token
+            if self.token.get('access_token') == stale.get('access_token'):
+                self._fresh_token(stale)
 
     def request(self, method, url, **kwargs):
         if not url.lower().startswith('http'):
@@ -56,36 +103,68 @@ class OneDriveSession(requests_oauthlib.OAuth2Session):
         if 'timeout' not in kwargs:
             kwargs['timeout'] = self.timeout
 
+        if url == self.token_url:
+            # This is fetch_token() asking for a new token, so don't try to
+            # attach or refresh the old one.
+            kwargs['withhold_token'] = True
+        elif self.token.get('expires_at', 0) < time.time() + REFRESH_MARGIN:
+            # Refresh proactively instead of waiting for the token to expire
+            self.refresh_token(None)
+
         attempt = 0
-        # FIXME: this should probably be configurable
-        max_attempts = 30
+        max_attempts = self.max_attempts
+        rejected = False
 
         while attempt < max_attempts:
             attempt += 1
             delay = random.uniform(min(30, 2 ** attempt), min(300, 3 * 2 ** attempt))
+            result = None
+            token = self.token
+            if self.throttle:
+                METRICS.record_sleep('graph', 'budget', self.throttle.acquire())
+            sent = request_size(kwargs)
+            start = time.monotonic()
             try:
                 result = super(OneDriveSession, self).request(method, url, **kwargs)
             except(
                 requests.exceptions.ReadTimeout,
                 requests.exceptions.ConnectionError,
             ) as e:
+                METRICS.record('graph', method, url, None, time.monotonic() - start)
                 self.logger.info('Retryable requests error', exc_info=e)
             else:
+                METRICS.record('graph', method, url, result, time.monotonic() - start, sent)
                 if result.status_code in (400, 500):
                     self.logger.info(result.content)
 
-                if result.status_code == 429:
+                if result.status_code == 401 and not rejected and not kwargs.get('withhold_token'):
+                    # The token may have been revoked, or be one that another
+                    # process cached; get a new one and try again straight
+                    # away. Pre-authenticated URLs can also return 401, so
+                    # only do this once.
+                    self.logger.debug('Authorization token was rejected')
+                    rejected = True
+                    self._reject_token(token)
+                    delay = 0
+                elif result.status_code == 429:
                     self.logger.debug('throttled')
                     if 'retry-after' in result.headers:
                         delay = result.headers['retry-after']
+                    if self.throttle:
+                        # Make everyone else back off too
+                        self.throttle.pause(delay)
                 elif result.status_code not in (500, 503, 504):
+                    if self.throttle:
+                        self.throttle.observe(result.headers)
                     return result
 
             if 'data' in kwargs and hasattr(kwargs['data'], 'read'):
                 raise(requests.exceptions.RetryError('retries unavailable with file-like data'))
 
             if attempt < max_attempts:
-                self.logger.info('Sleeping for %d seconds before retrying', delay)
+                self.logger.info('Sleeping for %d seconds before retrying', float(delay))
+                METRICS.record_retry('graph')
+                METRICS.record_sleep('graph', 'throttle' if result is not None and result.status_code == 429 else 'retry', delay)
                 time.sleep(float(delay))
 
         raise(requests.exceptions.RetryError('maximum retries exceeded'))
@@ -5,21 +5,66 @@
 
 import base64
 import logging
+import mmap
+import multiprocessing
+import os
 import struct
+import threading
 
-from ctypes import cdll, c_char_p, c_void_p, c_ulonglong
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from ctypes import cdll, c_char, c_char_p, c_void_p, c_ulonglong
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+BACKENDS = ('libqxh', 'numpy', 'python')
+
+CHUNK_SIZE = 512 * 1024
+
+# Files smaller than this aren't worth farming out to multiple workers
+PARALLEL_THRESHOLD = 64 * 1024 * 1024
+
+
+def available_backends():
+    backends = []
+    try:
+        cdll.LoadLibrary('libqxh.so.0')
+    except OSError:
+        pass
+    else:
+        backends.append('libqxh')
+
+    if numpy is not None:
+        backends.append('numpy')
+
+    backends.append('python')
+    return backends
 
 
 class QuickXORHash:
-    def __init__(self):
+    def __init__(self, backend=None):
         logger = logging.getLogger(__name__)
-        try:
-            self.libqxh = cdll.LoadLibrary('libqxh.so.0')
-        except OSError:
-            self.HAS_LIBQXH = False
-            logger.debug('Using pure Python for hash calculation')
-        else:
-            self.HAS_LIBQXH = True
+
+        if backend not in (None,) + BACKENDS:
+            raise ValueError('Unknown QuickXORHash backend {}'.format(backend))
+
+        self.HAS_LIBQXH = False
+        self.HAS_NUMPY = False
+
+        if backend in (None, 'libqxh'):
+            try:
+                self.libqxh = cdll.LoadLibrary('libqxh.so.0')
+            except OSError:
+                if backend:
+                    raise
+            else:
+                self.HAS_LIBQXH = True
+
+        if self.HAS_LIBQXH:
+            self.backend = 'libqxh'
             logger.debug('Using libqxh for hash calculation')
             self.libqxh.qxh_new.restype = c_void_p
             self.libqxh.qxh_update.argtypes = [c_void_p, c_char_p, c_ulonglong]
@@ -29,6 +74,12 @@ class QuickXORHash:
             self.qxh = self.libqxh.qxh_new()
             return
 
+        if backend in (None, 'numpy'):
+            if numpy is not None:
+                self.HAS_NUMPY = True
+            elif backend:
+                raise ImportError('numpy is required for the numpy QuickXORHash backend')
+
         # Constants
         self.width = 160
         self.shift = 11
@@ -36,60 +87,156 @@ class QuickXORHash:
         # State
         self.shifted = 0
         self.length = 0
-        self.cell = [0] * (int((self.width - 1) / 64) + 1)
+
+        if self.HAS_NUMPY:
+            self.backend = 'numpy'
+            logger.debug('Using numpy for hash calculation')
+            # One element per bit of state, least significant first
+            self.bits = numpy.zeros(self.width, dtype=numpy.uint8)
+            # Byte i of a chunk always lands self.shift * i bits after the
+            # chunk's starting position.
+            self.offsets = numpy.arange(self.width) * self.shift
+        else:
+            self.backend = 'python'
+            logger.debug('Using pure Python for hash calculation')
+            self.cell = [0] * (int((self.width - 1) / 64) + 1)
+
+    def _update_numpy(self, data):
+        buf = numpy.frombuffer(data, dtype=numpy.uint8)
+        tail = len(buf) % self.width
+
+        # Bytes that are a multiple of the width apart share a position in
+        # the state, so collapse each column with XOR before shifting.
+        rows = buf[:len(buf) - tail].reshape(-1, self.width)
+        if len(rows):
+            columns = numpy.bitwise_xor.reduce(rows, axis=0)
+        else:
+            columns = numpy.zeros(self.width, dtype=numpy.uint8)
+        columns[:tail] ^= buf[len(buf) - tail:]
+
+        # Since the shift is coprime with the width, the starting bit of each
+        # column is a permutation of the state's bit positions.
+        positions = (self.offsets + self.shifted) % self.width
+        column_bits = numpy.unpackbits(columns[:, numpy.newaxis], axis=1, bitorder='little')
+        placed = numpy.empty(self.width, dtype=numpy.uint8)
+        for bit in range(8):
+            placed[positions] = column_bits[:, bit]
+            # Rotate the bit into place, wrapping around the top of the state
+            self.bits ^= numpy.roll(placed, bit)
 
     def update(self, data):
+        # Accept anything that supports the buffer protocol (bytes, bytearray,
+        # memoryview, mmap...) and work on it in place.
+        if not isinstance(data, bytes):
+            data = memoryview(data).cast('B')
+
+        if not len(data):
+            return
+
         if self.HAS_LIBQXH:
-            self.libqxh.qxh_update(self.qxh, str(data), len(data))
+            if isinstance(data, bytes):
+                self.libqxh.qxh_update(self.qxh, data, len(data))
+            elif data.readonly:
+                # ctypes can only borrow writable buffers
+                self.libqxh.qxh_update(self.qxh, data.tobytes(), len(data))
+            else:
+                buf = (c_char * len(data)).from_buffer(data)
+                self.libqxh.qxh_update(self.qxh, buf, len(data))
+                del buf
             return
 
-        cell_index = int(self.shifted / 64)
-        cell_bitpos = int(self.shifted % 64)
+        if self.HAS_NUMPY:
+            self._update_numpy(data)
+        else:
+            cell_index = int(self.shifted / 64)
+            cell_bitpos = int(self.shifted % 64)
 
-        for i in range(0, min(self.width, len(data))):
-            next_cell = cell_index + 1
-            cell_bits = 64
-            # Last cell needs to wrap around
-            if next_cell == len(self.cell):
-                next_cell = 0
-                # Last cell usually isn't a full 64 bits
-                if self.width % 64 > 0:
-                    cell_bits = self.width % 64
+            for i in range(0, min(self.width, len(data))):
+                next_cell = cell_index + 1
+                cell_bits = 64
+                # Last cell needs to wrap around
+                if next_cell == len(self.cell):
+                    next_cell = 0
+                    # Last cell usually isn't a full 64 bits
+                    if self.width % 64 > 0:
+                        cell_bits = self.width % 64
 
-            new_byte = 0
-            for j in range(i, len(data), self.width):
-                new_byte ^= data[j]
+                new_byte = 0
+                for j in range(i, len(data), self.width):
+                    new_byte ^= data[j]
 
-            # Python doesn't have fixed-width data types, so we need to
-            # explicitly throw away extra bits.
-            self.cell[cell_index] ^= new_byte << cell_bitpos & 0xffffffffffffffff
+                # Python doesn't have fixed-width data types, so we need to
+                # explicitly throw away extra bits.
+                self.cell[cell_index] ^= new_byte << cell_bitpos & 0xffffffffffffffff
 
-            if cell_bitpos > cell_bits - 8:
-                self.cell[next_cell] ^= new_byte >> (cell_bits - cell_bitpos)
+                if cell_bitpos > cell_bits - 8:
+                    self.cell[next_cell] ^= new_byte >> (cell_bits - cell_bitpos)
 
-            cell_bitpos += self.shift
-            if cell_bitpos >= cell_bits:
-                cell_index = next_cell
-                cell_bitpos -= cell_bits
+                cell_bitpos += self.shift
+                if cell_bitpos >= cell_bits:
+                    cell_index = next_cell
+                    cell_bitpos -= cell_bits
 
         self.shifted += self.shift * (len(data) % self.width)
         self.shifted %= self.width
         self.length += len(data)
 
+    def state(self):
+        ''' Return the current state as a single integer, without the length
+        mixed in. '''
+        if self.HAS_LIBQXH:
+            raise TypeError('libqxh does not expose its internal state')
+
+        if self.HAS_NUMPY:
+            return int.from_bytes(numpy.packbits(self.bits, bitorder='little').tobytes(), 'little')
+
+        state = 0
+        for i in range(0, len(self.cell)):
+            state |= self.cell[i] << (64 * i)
+        return state & ((1 << self.width) - 1)
+
+    def combine(self, state, length, offset):
+        ''' Merge in the state of a separately hashed region of `length` bytes
+        that started `offset` bytes into the data. Once every region has been
+        merged the result is the same as hashing the data sequentially. '''
+        if self.HAS_LIBQXH:
+            raise TypeError('libqxh does not expose its internal state')
+
+        # The region was hashed as if it started at bit 0, so rotate it to
+        # where its first byte would have landed.
+        rotate = (offset * self.shift) % self.width
+        mask = (1 << self.width) - 1
+        state = ((state << rotate) | (state >> (self.width - rotate))) & mask
+
+        if self.HAS_NUMPY:
+            self.bits ^= numpy.unpackbits(
+                numpy.frombuffer(state.to_bytes(self.width // 8, 'little'), dtype=numpy.uint8),
+                bitorder='little',
+            )
+        else:
+            for i in range(0, len(self.cell)):
+                self.cell[i] ^= (state >> (64 * i)) & 0xffffffffffffffff
+
+        self.length += length
+        self.shifted = (self.length * self.shift) % self.width
+
     def finalize(self):
         if self.HAS_LIBQXH:
             digest = self.libqxh.qxh_finalize(self.qxh)
             self.libqxh.qxh_free(self.qxh)
-            return digest
+            return digest.decode('utf-8')
 
-        # Convert cells to byte array
-        b_data = bytearray()
-        for i in range(0, len(self.cell)):
-            chunk = struct.unpack('8B', struct.pack('Q', self.cell[i]))
-            if (i + 1) * 64 <= self.width:
-                b_data.extend(chunk)
-            else:
-                b_data.extend(chunk[0:int(self.width / 8 % 8)])
+        if self.HAS_NUMPY:
+            b_data = bytearray(numpy.packbits(self.bits, bitorder='little').tobytes())
+        else:
+            # Convert cells to byte array
+            b_data = bytearray()
+            for i in range(0, len(self.cell)):
+                chunk = struct.unpack('8B', struct.pack('Q', self.cell[i]))
+                if (i + 1) * 64 <= self.width:
+                    b_data.extend(chunk)
+                else:
+                    b_data.extend(chunk[0:int(self.width / 8 % 8)])
 
         # Convert length to byte array
         b_length = struct.unpack('8B', struct.pack('Q', self.length))
@@ -99,14 +246,100 @@ class QuickXORHash:
         for i in range(0, len(b_length)):
             b_data[i + offset] ^= b_length[i]
 
-        return base64.b64encode(b_data)
+        # Match the str digests in Graph metadata
+        return base64.b64encode(b_data).decode('utf-8')
 
-    def hash_file(self, path):
+    def hash_file(self, path, use_mmap=True, offset=0, length=None):
         with open(path, 'rb') as f:
-            while True:
-                chunk = f.read(512 * 1024)
-                if chunk:
-                    self.update(bytearray(chunk))
-                else:
-                    break
+            size = os.fstat(f.fileno()).st_size
+            end = size if length is None else min(size, offset + length)
+            if offset or length is not None:
+                # Only the mmap method can hash part of a file
+                use_mmap = True
+            if use_mmap and end > offset:
+                # libqxh can only borrow writable buffers, and a private
+                # mapping is writable without copying anything.
+                access = mmap.ACCESS_COPY if self.HAS_LIBQXH else mmap.ACCESS_READ
+                with mmap.mmap(f.fileno(), 0, access=access) as mapped:
+                    if hasattr(mapped, 'madvise'):
+                        mapped.madvise(mmap.MADV_SEQUENTIAL)
+                    with memoryview(mapped) as view:
+                        for start in range(offset, end, CHUNK_SIZE):
+                            self.update(view[start:min(end, start + CHUNK_SIZE)])
+            else:
+                buf = bytearray(CHUNK_SIZE)
+                with memoryview(buf) as view:
+                    while True:
+                        length = f.readinto(buf)
+                        if length:
+                            self.update(view[:length])
+                        else:
+                            break
         return self.finalize()
+
+
+def _hash_region(path, offset, length, backend):
+    h = QuickXORHash(backend)
+    h.hash_file(path, offset=offset, length=length)
+    return h.state()
+
+
+_pool = None
+_pool_key = None
+_pool_lock = threading.Lock()
+
+
+def _process_pool(workers):
+    ''' A pool of hashing processes shared by every call in this process.
+    Callers are often threaded, so the workers come from a forkserver rather
+    than forking whatever state the caller's other threads are in. '''
+    global _pool, _pool_key
+    key = (os.getpid(), workers)
+    with _pool_lock:
+        if _pool_key != key:
+            if _pool is not None and _pool_key[0] == key[0]:
+                _pool.shutdown(wait=False)
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver'))
+            _pool_key = key
+        return _pool
+
+
+def hash_file_parallel(path, workers=None, processes=True, backend=None):
+    ''' Hash a file by splitting it into regions that are hashed
+    concurrently, then combining the partial states. '''
+    size = os.stat(path).st_size
+    workers = workers or os.cpu_count() or 1
+    if processes and multiprocessing.current_process().daemon:
+        # We're already one of several worker processes (e.g. verify
+        # --jobs), which aren't allowed children of their own.
+        workers = 1
+
+    h = QuickXORHash(backend)
+    if workers < 2 or size < PARALLEL_THRESHOLD:
+        return h.hash_file(path)
+
+    if h.HAS_LIBQXH:
+        # libqxh can't hand back partial states. Splitting the work across
+        # numpy workers beats it, but pure Python workers never will.
+        if numpy is None:
+            return h.hash_file(path)
+        h = QuickXORHash('numpy')
+    backend = h.backend
+
+    # Several regions per worker evens out any stragglers
+    region_size = max(CHUNK_SIZE, -(-size // (workers * 4)))
+    regions = [(offset, min(region_size, size - offset)) for offset in range(0, size, region_size)]
+
+    if processes:
+        executor = _process_pool(workers)
+    else:
+        executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = [executor.submit(_hash_region, path, offset, length, backend) for (offset, length) in regions]
+        for (offset, length), future in zip(regions, futures):
+            h.combine(future.result(), length, offset)
+    finally:
+        if not processes:
+            executor.shutdown()
+
+    return h.finalize()
@@ -5,35 +5,68 @@
 
 import logging
 import random
+import threading
 import time
 
 import adal
 import requests
 
 from . import __version__
+from .metrics import METRICS, request_size
+from .throttle import SharedThrottle
+from .tokencache import REFRESH_MARGIN
 
 
 class SharepointSession(requests.Session):
-    def __init__(self, site_url, ms_config, timeout, **kwargs):
+    def __init__(self, site_url, ms_config, timeout, token_cache=None, **kwargs):
         self.site_url = site_url
         super(SharepointSession, self).__init__(**kwargs)
         self.logger = logging.getLogger(__name__)
         self.ms_config = ms_config
         self.timeout = timeout
+        self.token_cache = token_cache
+        self.throttle = SharedThrottle.from_config(ms_config['client_id'], ms_config)
+        self.max_attempts = ms_config.get('max_attempts', 30)
+        self._token_lock = threading.Lock()
+        pool_size = ms_config.get('pool_size', 10)
+        self.mount('https://', requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
         self._fresh_token()
         self.headers.update({
             'User-Agent': 'NONISV|UniversityOfMichigan|odm/{} ({})'.format(__version__, ms_config['client_id']),
         })
 
-    def _fresh_token(self):
+    def _fresh_token(self, rejected=None):
+        if self.token_cache:
+            token = self.token_cache.get('sharepoint', self.ms_config['client_id'], self.site_url)
+            # Don't hand back a token the server has already turned down,
+            # but do use one that another process has fetched since.
+            if token and (not rejected or token['accessToken'] != rejected['accessToken']):
+                self._token = token
+                return
+
         self.logger.debug('Fetching fresh authorization token.')
-        ctx = adal.AuthenticationContext('https://login.microsoftonline.com/{}.onmicrosoft.com'.format(self.ms_config['tenant']))
-        self._token = ctx.acquire_token_with_client_certificate(
+        ctx = adal.AuthenticationContext(
+            '{}{}.onmicrosoft.com'.format(self.ms_config.get('login_url', 'https://login.microsoftonline.com/'), self.ms_config['tenant']),
+            # adal only knows about Microsoft's own authorities
+            validate_authority='login_url' not in self.ms_config,
+        )
+        token = ctx.acquire_token_with_client_certificate(
             self.site_url,
             self.ms_config['client_id'],
             self.ms_config['client_cert_key'],
             self.ms_config['client_cert'],
         )
+        token['expires_at'] = time.time() + int(token['expiresIn'])
+        self._token = token
+
+        if self.token_cache:
+            self.token_cache.store('sharepoint', self.ms_config['client_id'], self.site_url, None, token, token['expires_at'])
+
+    def _refresh_token(self, stale, rejected=False):
+        with self._token_lock:
+            # Only the first thread to notice gets a new token
+            if self._token is stale:
+                self._fresh_token(stale if rejected else None)
 
     def request(self, method, url, **kwargs):
         if not url.startswith('http'):
@@ -44,42 +77,59 @@ class SharepointSession(requests.Session):
 
         headers = kwargs.get('headers', {})
         headers.update({
-            'Authorization': 'Bearer ' + self._token['accessToken'],
             'Accept': 'application/json;odata=verbose'
         })
         kwargs['headers'] = headers
 
         attempt = 0
-        # FIXME: this should probably be configurable
-        max_attempts = 30
+        max_attempts = self.max_attempts
         while attempt < max_attempts:
             attempt += 1
             delay = random.uniform(min(30, 2 ** attempt), min(300, 3 * 2 ** attempt))
+            result = None
+            token = self._token
+            if token['expires_at'] < time.time() + REFRESH_MARGIN:
+                self._refresh_token(token)
+                token = self._token
+            headers['Authorization'] = 'Bearer ' + token['accessToken']
+            if self.throttle:
+                METRICS.record_sleep('sharepoint', 'budget', self.throttle.acquire())
+            sent = request_size(kwargs)
+            start = time.monotonic()
             try:
                 result = super(SharepointSession, self).request(method, url, **kwargs)
             except(
                 requests.exceptions.ReadTimeout,
                 requests.exceptions.ConnectionError,
             ) as e:
+                METRICS.record('sharepoint', method, url, None, time.monotonic() - start)
                 self.logger.info('Retryable requests error', exc_info=e)
             else:
+                METRICS.record('sharepoint', method, url, result, time.monotonic() - start, sent)
                 if result.status_code in (400, 500):
                     self.logger.info(result.content)
 
                 if result.status_code == 401:
-                    self._fresh_token()
+                    self._refresh_token(token, rejected=True)
                 elif result.status_code == 429:
                     self.logger.debug('throttled')
                     if 'retry-after' in result.headers:
                         delay = result.headers['retry-after']
+                    if self.throttle:
+                        # Make everyone else back off too
+                        self.throttle.pause(delay)
                 elif result.status_code not in (500, 503, 504):
+                    if self.throttle:
+                        self.throttle.observe(result.headers)
                     return result
 
             if 'data' in kwargs and hasattr(kwargs['data'], 'read'):
                 raise(requests.exceptions.RetryError('retries unavailable with file-like data'))
 
             if attempt < max_attempts:
-                self.logger.info('Sleeping for %d seconds before retrying', delay)
+                self.logger.info('Sleeping for %d seconds before retrying', float(delay))
+                METRICS.record_retry('sharepoint')
+                METRICS.record_sleep('sharepoint', 'throttle' if result is not None and result.status_code == 429 else 'retry', delay)
                 time.sleep(float(delay))
 
         raise(requests.exceptions.RetryError('maximum retries exceeded'))
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+# This file is part of ODM and distributed under the terms of the
+# MIT license. See COPYING.
+
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+from contextlib import contextmanager
+
+
+# tokens, last refill, paused until, reduced rate, reduced rate until
+STATE = struct.Struct('<ddddd')
+
+
+class SharedThrottle:
+    ''' Token bucket shared by every process on the host that uses the same
+    key, stored in a small memory-mapped file and guarded with flock(). '''
+
+    def __init__(self, key, rate=10, burst=None, path=None):
+        self.logger = logging.getLogger(__name__)
+        self.rate = float(rate)
+        self.burst = float(burst or rate * 2)
+        if not path:
+            path = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+        self.path = os.path.join(path, 'odm-throttle-{}'.format(key))
+        self._lock = threading.Lock()
+        self._pid = None
+
+    @classmethod
+    def from_config(cls, key, ms_config):
+        config = ms_config.get('throttle')
+        if not config:
+            return None
+        return cls(key, config.get('rate', 10), config.get('burst'), config.get('path'))
+
+    def _open(self):
+        # flock() locks are shared with forked children, so each process needs
+        # its own file description.
+        if self._pid == os.getpid():
+            return
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o0600)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size < STATE.size:
+                os.ftruncate(self._fd, STATE.size)
+                os.pwrite(self._fd, STATE.pack(self.burst, time.time(), 0, 0, 0), 0)
+            self._mmap = mmap.mmap(self._fd, STATE.size)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._pid = os.getpid()
+
+    @contextmanager
+    def _state(self):
+        with self._lock:
+            self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                state = list(STATE.unpack_from(self._mmap))
+                yield state
+                STATE.pack_into(self._mmap, 0, *state)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def acquire(self):
+        ''' Block until a request is allowed, and return how long that
+        took. '''
+        waited = 0
+        while True:
+            with self._state() as state:
+                (tokens, last, paused_until, reduced_rate, reduced_until) = state
+                now = time.time()
+                rate = self.rate
+                if reduced_until > now:
+                    rate = min(rate, reduced_rate)
+
+                tokens = min(self.burst, tokens + max(0, now - last) * rate)
+                if paused_until > now:
+                    wait = paused_until - now
+                elif tokens >= 1:
+                    tokens -= 1
+                    wait = 0
+                else:
+                    wait = (1 - tokens) / rate
+                state[0:2] = [tokens, now]
+
+            if not wait:
+                return waited
+            if wait > 1:
+                self.logger.debug('Throttling for %.2f seconds', wait)
+            time.sleep(wait)
+            waited += wait
+
+    def pause(self, seconds):
+        ''' Stop every process from making requests for a while, e.g. because
+        one of them was told to Retry-After. '''
+        with self._state() as state:
+            state[2] = max(state[2], time.time() + float(seconds))
+
+    def observe(self, headers):
+        ''' Slow down before we're actually throttled, based on the RateLimit
+        headers that Graph sends once 80% of the budget has been used. '''
+        try:
+            limit = int(headers['RateLimit-Limit'])
+            remaining = int(headers['RateLimit-Remaining'])
+            reset = int(headers['RateLimit-Reset'])
+        except (KeyError, ValueError):
+            return
+
+        if remaining <= 0:
+            self.logger.info('Rate limit budget exhausted, pausing for %d seconds', reset)
+            self.pause(reset)
+            return
+
+        if reset <= 0 or remaining >= limit:
+            return
+
+        # Spread what's left of the budget over the rest of the window
+        with self._state() as state:
+            state[3] = remaining / float(reset)
+            state[4] = time.time() + reset
+        self.logger.debug('Rate limit budget low, slowing to %.2f requests/second', remaining / float(reset))
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+# This file is part of ODM and distributed under the terms of the
+# MIT license. See COPYING.
+
+import json
+import logging
+import time
+
+from cryptography.fernet import Fernet, InvalidToken
+
+from odm.db import Database
+
+
+# Tokens this close to expiring are refreshed instead of being used
+REFRESH_MARGIN = 300
+
+
+class TokenCache:
+    ''' Encrypted on-disk cache of access tokens, so that separate
+    invocations don't each have to authenticate from scratch. '''
+
+    def __init__(self, path, key):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.fernet = Fernet(key)
+
+    @classmethod
+    def from_config(cls, config):
+        cache_config = config.get('token_cache')
+        if not cache_config:
+            return None
+        if not cache_config.get('key'):
+            raise ValueError('token_cache requires a key')
+        try:
+            return cls(cache_config['path'], cache_config['key'])
+        except (TypeError, ValueError):
+            raise ValueError('token_cache key is not a valid Fernet key')
+
+    @property
+    def db(self):
+        return Database.shared(self.path)
+
+    def _key(self, backend, client, resource, subject):
+        return ':'.join([backend, client, resource or '', subject or ''])
+
+    def get(self, backend, client, resource=None, subject=None):
+        entry = self.db.read(self._key(backend, client, resource, subject))
+        if not entry:
+            return None
+
+        if entry['expires_at'] < time.time() + REFRESH_MARGIN:
+            self.logger.debug('Cached %s token for %s is about to expire', backend, client)
+            return None
+
+        try:
+            token = json.loads(self.fernet.decrypt(entry['token'].encode('utf-8')).decode('utf-8'))
+        except InvalidToken:
+            self.logger.warning('Unable to decrypt cached %s token for %s', backend, client)
+            return None
+
+        self.logger.debug('Using cached %s token for %s', backend, client)
+        return token
+
+    def store(self, backend, client, resource, subject, token, expires_at):
+        self.db.write(
+            self._key(backend, client, resource, subject),
+            {
+                'expires_at': expires_at,
+                'token': self.fernet.encrypt(json.dumps(token).encode('utf-8')).decode('utf-8'),
+            },
+        )
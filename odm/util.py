@@ -3,6 +3,15 @@
 # This file is part of ODM and distributed under the terms of the
 # MIT license. See COPYING.
 
+import functools
+import json
+import multiprocessing
+import os
+import queue
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
 KETSUBAN = '''
 iVBORw0KGgoAAAANSUhEUgAAAMkAAADhCAYAAABiOZFeAAAFVElEQVR42u3dvW1bMRSAUffuvGNG
 SJsRPIen8wpKKzzAFHl1L3+s8wGqZMUIxFPQ5CPf3iRpZh/v77f7V29//3z++Gr97DP/TuRzvmFB
@@ -52,17 +61,316 @@ class ChunkyFile():
         return ret
 
 
+class HashingWriter():
+    ''' Write-only file object that writes and hashes data on background
+    threads, so that neither blocks whoever is producing the data. If offset
+    is given, the existing file is kept up to that point and written after
+    it. '''
+
+    def __init__(self, fname, h=None, queue_size=16, offset=0):
+        if offset:
+            self.f = open(fname, 'r+b')
+            self.f.truncate(offset)
+            self.f.seek(offset)
+        else:
+            self.f = open(fname, 'wb')
+        self.h = h
+        self.error = None
+        self._threads = []
+        self._queues = []
+
+        consumers = [self.f.write]
+        if h is not None:
+            consumers.append(h.update)
+
+        for consumer in consumers:
+            q = queue.Queue(queue_size)
+            t = threading.Thread(target=self._consume, args=(q, consumer), daemon=True)
+            t.start()
+            self._queues.append(q)
+            self._threads.append(t)
+
+    def _consume(self, q, consumer):
+        while True:
+            data = q.get()
+            if data is None:
+                return
+            if self.error is None:
+                try:
+                    consumer(data)
+                except Exception as e:
+                    # Keep draining the queue so the producer doesn't block
+                    self.error = e
+
+    def write(self, data):
+        if self.error is not None:
+            raise self.error
+        # The consumers see the data after we return, so it can't be a
+        # buffer the caller might reuse.
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        for q in self._queues:
+            q.put(data)
+        return len(data)
+
+    def close(self):
+        if self.f.closed:
+            return
+        for q in self._queues:
+            q.put(None)
+        for t in self._threads:
+            t.join()
+        self.f.close()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class PartFile():
+    ''' An in-progress download, written to dest.part with a JSON sidecar
+    recording what's needed to resume it. '''
+
+    def __init__(self, dest):
+        self.dest = dest
+        self.path = dest + '.part'
+        self.sidecar = dest + '.part.json'
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.sidecar, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def sync(self):
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def save(self, state):
+        tmp = '{}.{}.tmp'.format(self.sidecar, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, self.sidecar)
+
+    def commit(self):
+        os.replace(self.path, self.dest)
+        self.discard()
+
+    def discard(self):
+        for path in (self.path, self.sidecar):
+            if os.path.exists(path):
+                os.unlink(path)
+
+
+class RangeNotSatisfied(Exception):
+    ''' The server ignored a Range request and sent the whole file. '''
+    pass
+
+
+class SegmentWriter():
+    ''' Write-only file object that writes one region of a file in place,
+    optionally hashing just that region. '''
+
+    def __init__(self, fd, offset, h=None):
+        self.fd = fd
+        self.offset = offset
+        self.h = h
+
+    def write(self, data):
+        with memoryview(data) as view:
+            written = 0
+            while written < len(view):
+                written += os.pwrite(self.fd, view[written:], self.offset + written)
+        self.offset += written
+        if self.h is not None:
+            self.h.update(data)
+        return written
+
+
+def segment_config(config):
+    ''' Return the size at which downloads are fetched as concurrent byte
+    ranges, and how many ranges to use. '''
+    return (
+        config.get('download_segment_threshold', 256 * 1024 * 1024),
+        config.get('download_segments', 4),
+    )
+
+
+def segment_ranges(size, segments):
+    ''' Split size bytes into at most `segments` (offset, length) pairs. '''
+    segment_size = max(1, -(-size // segments))
+    return [(offset, min(segment_size, size - offset)) for offset in range(0, size, segment_size)]
+
+
+def download_ranges(fetch, dest, size, segments, new_hash=None, progress=None):
+    ''' Download a file of `size` bytes as concurrent byte ranges written
+    directly into a preallocated file. fetch(start, end, writer) must write
+    bytes start through end (inclusive) to writer. Returns a list of
+    (offset, length, h) tuples, where h is a new_hash() that has seen only
+    that segment, or None.
+
+    progress is a list of the bytes completed in each segment. If it's
+    non-empty the existing file is resumed from those points, and whether or
+    not the download succeeds it's updated with how far each segment got.
+    Hashes only cover the data fetched by this call. '''
+    regions = segment_ranges(size, segments)
+    if progress is None:
+        progress = []
+    resume = bool(progress)
+    if not resume:
+        progress.extend([0] * len(regions))
+
+    fd = os.open(dest, os.O_WRONLY | os.O_CREAT | (0 if resume else os.O_TRUNC), 0o666)
+    writers = {}
+    try:
+        if not resume:
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except (AttributeError, OSError):
+                # Not all platforms and filesystems support this, but we
+                # don't need the space reserved for correctness.
+                os.ftruncate(fd, size)
+
+        def _fetch(i):
+            (offset, length) = regions[i]
+            writer = writers[i] = SegmentWriter(fd, offset + progress[i], new_hash() if new_hash else None)
+            if progress[i] < length:
+                fetch(offset + progress[i], offset + length - 1, writer)
+            if writer.offset != offset + length:
+                raise IOError('Expected {} bytes at offset {}, got {}'.format(length, offset, writer.offset - offset))
+            return (offset, length, writer.h)
+
+        with ThreadPoolExecutor(max_workers=len(regions) or 1) as executor:
+            return list(executor.map(_fetch, range(len(regions))))
+    finally:
+        for (i, writer) in writers.items():
+            progress[i] = writer.offset - regions[i][0]
+        os.close(fd)
+
+
 def chunky_path(name):
+    encoded = name.encode('utf-8')
+    if len(encoded) <= 255:
+        return [name]
+
     path = []
-    while len(name.encode('utf-8')) > 255:
+    while len(encoded) > 255:
         # Many Unix filesystems only allow filenames <= 255 bytes. Find the
-        # longest string that will fit in 255 bytes once encoded.
-        for j in range(0, len(name)):
-            if len(name[:j].encode('utf-8')) > 255:
-                j -= 1
-                break
-        path.append(name[:j])
-        name = name[j:]
-    path.append(name)
+        # longest prefix that fits without splitting a character, by backing
+        # up over UTF-8 continuation bytes (0b10xxxxxx).
+        cut = 255
+        while encoded[cut] & 0xc0 == 0x80:
+            cut -= 1
+        path.append(encoded[:cut].decode('utf-8'))
+        encoded = encoded[cut:]
+    path.append(encoded.decode('utf-8'))
 
     return path
+
+
+def _parallel_call(func, args):
+    return func(*args)
+
+
+def parallel_map(func, iterable, jobs, chunksize=1, initializer=None):
+    ''' Apply func to each tuple of arguments from iterable in a pool of
+    worker processes, yielding the results in order as they become available.
+    The workers are started from a forkserver, since the caller may have
+    other threads running, so func and its arguments have to be picklable
+    (e.g. a module-level function or a functools.partial of one). '''
+    with multiprocessing.get_context('forkserver').Pool(jobs, initializer) as pool:
+        for result in pool.imap(functools.partial(_parallel_call, func), iterable, chunksize):
+            yield result
+
+
+def dump_json_list(items, f):
+    ''' Write an iterable as a JSON array formatted like json.dump(indent=2),
+    without needing the whole list in memory. '''
+    f.write('[')
+    empty = True
+    for item in items:
+        f.write('\n  ' if empty else ',\n  ')
+        f.write(json.dumps(item, indent=2).replace('\n', '\n  '))
+        empty = False
+    f.write(']\n' if empty else '\n]\n')
+
+
+def split_work(units, item_limit=None, size_limit=None):
+    ''' Divide (locality, key, size) units into chunks of at most item_limit
+    units and size_limit bytes, returning a list of lists of keys. Units are
+    kept in locality order so that neighbours (e.g. files in the same folder)
+    end up in the same chunk, and the cuts are placed so that the chunks come
+    out roughly the same size instead of leaving a runt at the end. '''
+    units = sorted(units, key=lambda x: x[0])
+    if not units:
+        return []
+
+    def weight(size):
+        # Anything over the limit gets a chunk to itself anyway, so don't let
+        # it skew the balance of the rest.
+        return min(size, size_limit) if size_limit else size
+
+    total_count = len(units)
+    total_size = sum(weight(x[2]) for x in units)
+    by_count = -(-total_count // item_limit) if item_limit else 1
+    by_size = -(-total_size // size_limit) if size_limit else 1
+    nchunks = max(by_count, by_size)
+
+    def fits(count, size):
+        return (not item_limit or count <= item_limit) and (not size_limit or size <= size_limit)
+
+    chunks = [[]]
+    chunk_sizes = [0]
+    seen_count = 0
+    seen_size = 0
+    last_ideal = 0
+    for (locality, key, size) in units:
+        # Which chunk this unit would land in if the work were divided evenly
+        # along whichever limit is the tighter one; cut wherever that changes.
+        if by_size > by_count:
+            ideal = int((seen_size + weight(size) / 2) * nchunks / total_size)
+        else:
+            ideal = seen_count * nchunks // total_count
+
+        if chunks[-1] and (ideal > last_ideal or not fits(len(chunks[-1]) + 1, chunk_sizes[-1] + size)):
+            chunks.append([])
+            chunk_sizes.append(0)
+
+        chunks[-1].append(key)
+        chunk_sizes[-1] += size
+        seen_count += 1
+        seen_size += weight(size)
+        last_ideal = ideal
+
+    # Hard cuts forced by oversized units can leave the chunks around them
+    # short, so merge neighbours back together wherever they still fit.
+    merged = [chunks[0]]
+    merged_size = chunk_sizes[0]
+    for (chunk, size) in zip(chunks[1:], chunk_sizes[1:]):
+        if fits(len(merged[-1]) + len(chunk), merged_size + size):
+            merged[-1] = merged[-1] + chunk
+            merged_size += size
+        else:
+            merged.append(chunk)
+            merged_size = size
+
+    return merged
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+# This file is part of ODM and distributed under the terms of the
+# MIT license. See COPYING.
+
+import random
+
+import pytest
+
+# Mostly ASCII, with enough multibyte characters to exercise the code that
+# deals with filenames longer than 255 bytes.
+ALPHABET = 'abcdefghijklmnopqrstuvwxyz0123456789 _-.' + 'éøßж漢字🙂'
+
+
+def make_items(count, seed=0, drive_id='b!test'):
+    ''' A drive listing of `count` items in the shape Drive.delta() returns,
+    in a random tree. '''
+    rng = random.Random(seed)
+    items = {
+        'root': {
+            'id': 'root',
+            'name': 'root',
+            'folder': {'childCount': 0},
+            'parentReference': {'driveId': drive_id},
+            'size': 0,
+        },
+    }
+    folders = ['root']
+
+    for i in range(1, count):
+        item_id = 'item{}'.format(i)
+        item = {
+            'id': item_id,
+            'name': ''.join(rng.choice(ALPHABET) for _ in range(rng.randint(1, 40))).strip(' .') or 'x',
+            'parentReference': {
+                'driveId': drive_id,
+                'id': rng.choice(folders),
+            },
+            'fileSystemInfo': {
+                'lastModifiedDateTime': '2019-09-19T12:00:00Z',
+            },
+        }
+        if rng.random() < 0.1:
+            item['folder'] = {'childCount': 0}
+            item['size'] = 0
+            folders.append(item_id)
+        else:
+            item['size'] = rng.randrange(10 ** 6)
+            item['file'] = {
+                'mimeType': 'application/octet-stream',
+                'hashes': {
+                    'quickXorHash': 'hash{}'.format(i),
+                },
+            }
+        items[item_id] = item
+
+    return items
+
+
+@pytest.fixture
+def items():
+    return make_items(2000, seed=1)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+# This file is part of ODM and distributed under the terms of the
+# MIT license. See COPYING.
+
+import pytest
+import requests
+
+from odm import graphbatch
+from odm.graphbatch import GraphBatch
+
+
+class FakeResponse:
+    def __init__(self, responses):
+        self.responses = responses
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return {'responses': self.responses}
+
+
+class FakeSession:
+    ''' Answers each $batch POST by calling respond() for every request in
+    it. '''
+
+    baseurl = 'https://graph.example.com/v1.0/'
+    throttle = None
+
+    def __init__(self, respond, max_attempts=3):
+        self.respond = respond
+        self.max_attempts = max_attempts
+        self.sent = []
+
+    def post(self, url, json):
+        assert url == '$batch'
+        self.sent.append(json['requests'])
+        responses = []
+        for request in json['requests']:
+            response = self.respond(request, len(self.sent))
+            if response is not None:
+                response['id'] = request['id']
+                responses.append(response)
+        return FakeResponse(responses)
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    monkeypatch.setattr(graphbatch.time, 'sleep', lambda x: None)
+
+
+def _ok(request, attempt):
+    return {'status': 200, 'body': {'url': request['url']}}
+
+
+def test_batch():
+    session = FakeSession(_ok)
+    with GraphBatch(session) as batch:
+        futures = [batch.get('drives/{}'.format(i)) for i in range(45)]
+        full = batch.get(session.baseurl + 'me')
+
+    # Groups of at most 20
+    assert [len(x) for x in session.sent] == [20, 20, 6]
+    for (i, future) in enumerate(futures):
+        assert future.result().ok
+        assert future.result().json() == {'url': '/drives/{}'.format(i)}
+    assert full.result().json() == {'url': '/me'}
+
+
+def test_body():
+    session = FakeSession(_ok)
+    with GraphBatch(session) as batch:
+        batch.patch('drives/1', json={'name': 'x'})
+    assert session.sent[0][0]['body'] == {'name': 'x'}
+    assert session.sent[0][0]['headers'] == {'Content-Type': 'application/json'}
+
+
+def test_foreign_url():
+    with pytest.raises(ValueError):
+        GraphBatch(FakeSession(_ok)).get('https://example.com/drives/1')
+
+
+def test_retry():
+    def respond(request, attempt):
+        if request['url'] == '/throttled' and attempt < 3:
+            return {'status': 429, 'headers': {'Retry-After': '0'}}
+        if request['url'] == '/missing' and attempt < 2:
+            return None
+        return _ok(request, attempt)
+
+    session = FakeSession(respond)
+    with GraphBatch(session) as batch:
+        ok = batch.get('ok')
+        throttled = batch.get('throttled')
+        missing = batch.get('missing')
+
+    # Only the requests that didn't succeed are sent again
+    assert [[x['url'] for x in sent] for sent in session.sent] == [
+        ['/ok', '/throttled', '/missing'],
+        ['/throttled', '/missing'],
+        ['/throttled'],
+    ]
+    for future in (ok, throttled, missing):
+        assert future.result().status_code == 200
+
+
+def test_retries_exhausted():
+    def respond(request, attempt):
+        if request['url'] == '/throttled':
+            return {'status': 429, 'headers': {'Retry-After': '0'}}
+        return None
+
+    session = FakeSession(respond, max_attempts=2)
+    with GraphBatch(session) as batch:
+        throttled = batch.get('throttled')
+        missing = batch.get('missing')
+
+    assert len(session.sent) == 2
+    assert throttled.result().status_code == 429
+    with pytest.raises(requests.exceptions.HTTPError):
+        throttled.result().raise_for_status()
+    with pytest.raises(requests.exceptions.RetryError):
+        missing.result()
+
+
+def test_send_failure():
+    class Broken(FakeSession):
+        def post(self, url, json):
+            raise requests.exceptions.ConnectionError('no')
+
+    with GraphBatch(Broken(_ok)) as batch:
+        future = batch.get('drives/1')
+    with pytest.raises(requests.exceptions.ConnectionError):
+        future.result()
+
+
+def test_depends_on():
+    def respond(request, attempt):
+        if request['url'] == '/parent' and attempt == 1:
+            return {'status': 503}
+        if request.get('dependsOn') and attempt == 1:
+            # Graph doesn't run a request whose dependency failed
+            return {'status': 424}
+        return _ok(request, attempt)
+
+    session = FakeSession(respond)
+    with GraphBatch(session) as batch:
+        parent = batch.post('parent', json={})
+        child = batch.patch('child', json={}, depends_on=[parent])
+
+    assert session.sent[0][1]['dependsOn'] == [parent.batch_id]
+    # The child waits for the retried parent rather than failing with it
+    assert [x['url'] for x in session.sent[1]] == ['/parent', '/child']
+    assert session.sent[1][1]['dependsOn'] == [parent.batch_id]
+    assert parent.result().ok
+    assert child.result().ok
+
+
+def test_depends_on_failed():
+    def respond(request, attempt):
+        if request['url'] == '/parent':
+            return {'status': 404}
+        return _ok(request, attempt)
+
+    session = FakeSession(respond)
+    with GraphBatch(session) as batch:
+        parent = batch.get('parent')
+    with GraphBatch(session) as batch:
+        child = batch.get('child', depends_on=[parent])
+
+    # Nothing is sent for a request whose dependency already failed
+    assert len(session.sent) == 1
+    assert child.result().status_code == 424
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+# This file is part of ODM and distributed under the terms of the
+# MIT license. See COPYING.
+
+import hashlib
+import os
+
+import pytest
+
+from odm import hashcache
+from odm.hashcache import HashCache
+from odm.quickxorhash import QuickXORHash
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return HashCache(str(tmp_path / 'cache'))
+
+
+@pytest.fixture
+def data_file(tmp_path):
+    path = tmp_path / 'data'
+    path.write_bytes(os.urandom(100000))
+    return str(path)
+
+
+def test_hash_file(data_file):
+    with open(data_file, 'rb') as f:
+        data = f.read()
+    h = QuickXORHash()
+    h.update(data)
+
+    digests = hashcache.hash_file(data_file, 'quickXorHash')
+    assert digests['md5'] == hashlib.md5(data).hexdigest()
+    assert digests['sha1'] == hashlib.sha1(data).hexdigest()
+    assert digests['quickXorHash'] == h.finalize()
+
+
+def test_cached(cache, data_file, monkeypatch):
+    expected = cache.digest(data_file, 'sha1')
+    # Everything that was calculated along the way is remembered
+    md5 = cache.digest(data_file, 'md5')
+
+    monkeypatch.setattr(hashcache, 'hash_file', None)
+    assert cache.digest(data_file, 'sha1') == expected
+    assert cache.digest(data_file, 'md5') == md5
+
+
+def test_changed(cache, data_file):
+    before = cache.digest(data_file, 'md5')
+    with open(data_file, 'ab') as f:
+        f.write(b'more')
+    assert cache.digest(data_file, 'md5') != before
+
+
+def test_store(cache, data_file, monkeypatch):
+    cache.store(data_file, {'quickXorHash': 'downloaded', 'crc32': 'ignored'})
+    monkeypatch.setattr(hashcache, 'hash_file', None)
+    assert cache.digest(data_file, 'quickXorHash') == 'downloaded'
+    assert 'crc32' not in cache.db.read(cache._key(os.stat(data_file)))
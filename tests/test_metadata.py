@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+# This file is part of ODM and distributed under the terms of the
+# MIT license. See COPYING.
+
+import copy
+import json
+
+import pytest
+
+import odm.metadata
+
+from odm.onedriveclient import OneDriveClient
+
+
+@pytest.fixture
+def long_items(items):
+    # Names that need splitting, including one where a 255 byte cut would
+    # land in the middle of a character.
+    items['long'] = {
+        'id': 'long',
+        'name': 'ж' * 200,
+        'folder': {'childCount': 0},
+        'parentReference': {'id': 'root'},
+        'size': 0,
+    }
+    items['longer'] = {
+        'id': 'longer',
+        'name': 'a' + '漢' * 300,
+        'file': {'mimeType': 'application/octet-stream'},
+        'parentReference': {'id': 'long'},
+        'size': 1,
+    }
+    return items
+
+
+@pytest.mark.parametrize('fs_safe', [False, True])
+def test_path_index(long_items, fs_safe):
+    # expand_path doesn't need a working client
+    client = OneDriveClient.__new__(OneDriveClient)
+    paths = odm.metadata.PathIndex(long_items)
+    lookup = paths.fs_path if fs_safe else paths.path
+
+    # Twice over, so that the second pass is answered from the cache
+    for _ in range(2):
+        for item_id in long_items:
+            assert lookup(item_id) == client.expand_path(item_id, long_items, fs_safe)
+
+    assert lookup('root') == '/'
+    if fs_safe:
+        assert all(len(x.encode('utf-8')) <= 255 for x in lookup('longer').split('/'))
+
+
+@pytest.mark.parametrize('fmt', ['json', 'ndjson', 'lmdb'])
+def test_round_trip(tmp_path, items, fmt):
+    path = str(tmp_path / 'metadata')
+    base = {
+        'items': copy.deepcopy(items),
+        'token': 'delta-token',
+    }
+
+    writer = odm.metadata.writer(fmt, path)
+    writer.start(base)
+
+    # A later page modifies one item and deletes another
+    changed = sorted(items)[1]
+    deleted = sorted(items)[2]
+    base['items'][changed]['name'] = 'renamed'
+    base['items'].pop(deleted)
+    writer.update(base['items'], [changed, deleted])
+
+    base['changes'] = {'added': 0, 'modified': 1, 'deleted': 1}
+    writer.finish(base)
+
+    assert odm.metadata.load(path) == base
+
+
+@pytest.mark.parametrize('indent', [None, 4])
+def test_load_json_document(tmp_path, items, indent):
+    # Metadata written by older versions, or by anything else
+    path = tmp_path / 'metadata'
+    base = {'items': items, 'token': 'delta-token'}
+    path.write_text(json.dumps(base, indent=indent))
+    assert odm.metadata.load(str(path)) == base
+
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        odm.metadata.writer('xml')
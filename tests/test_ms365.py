@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+# This file is part of ODM and distributed under the terms of the
+# MIT license. See COPYING.
+
+import copy
+import logging
+import re
+
+import pytest
+import requests
+
+from odm.graphbatch import BatchResponse
+from odm.metadata import Checkpoint
+from odm.ms365 import Drive, merge_delta_item, permissions_result
+
+LOGGER = logging.getLogger(__name__)
+
+ITEM = {
+    'id': 'item1',
+    'name': 'file.txt',
+    'parentReference': {
+        'driveId': 'drive1',
+        'id': 'root',
+    },
+    'file': {},
+}
+
+
+def _response(status, body):
+    return BatchResponse('drives/drive1/items/item1', {'status': status, 'body': body})
+
+
+def test_permissions_result_ok():
+    perms = [{'id': 'p1', 'roles': ['read']}]
+    result = permissions_result(ITEM, _response(200, {'id': 'item1', 'permissions': perms}), LOGGER)
+    assert result == {'id': 'item1', 'permissions': perms}
+
+
+@pytest.mark.parametrize('status', [403, 404])
+def test_permissions_result_skipped(status, caplog):
+    error = {'error': {'code': 'accessDenied', 'message': 'nope'}}
+    assert permissions_result(ITEM, _response(status, error), LOGGER) is None
+    assert 'item1' in caplog.text
+
+    base = {'items': {}}
+    merge_delta_item(base, {'deleted': [], 'changed': []}, dict(ITEM), None)
+    assert 'error' not in base['items']['item1']
+    assert 'permissions' not in base['items']['item1']
+
+
+@pytest.mark.parametrize('status', [429, 500, 503])
+def test_permissions_result_failed(status):
+    with pytest.raises(requests.exceptions.HTTPError):
+        permissions_result(ITEM, _response(status, {'error': {'code': 'tooManyRequests'}}), LOGGER)
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class FakeClient:
+    ''' Serves the delta pages for one drive. A request without a token
+    enumerates every item; a request with one of the tokens in `changes`
+    returns those items. '''
+
+    def __init__(self, items, page_size=200):
+        self.items = items
+        self.page_size = page_size
+        self.changes = {}
+        self.expired = set()
+        self.requested = []
+        self.stop_after = None
+
+    def get_list(self, path):
+        return {'id': 'root'}
+
+    def iter_pages(self, path):
+        while path:
+            self.requested.append(path)
+            if self.stop_after is not None and len(self.requested) > self.stop_after:
+                # What iter_pages() does when the page is missing
+                return
+            token = re.search(r'&token=([^&]+)', path)
+            skip = re.search(r'&skip=(\d+)', path)
+            if token and token.group(1) in self.expired:
+                raise requests.exceptions.HTTPError(response=FakeResponse(410))
+            values = list(self.changes[token.group(1)]) if token else list(self.items.values())
+            start = int(skip.group(1)) if skip else 0
+            page = {'value': copy.deepcopy(values[start:start + self.page_size])}
+            if start + self.page_size < len(values):
+                path = re.sub(r'&skip=\d+', '', path) + '&skip={}'.format(start + self.page_size)
+                page['@odata.nextLink'] = path
+            else:
+                path = None
+                page['@odata.deltaLink'] = 'https://graph.example.com/delta?token=latest'
+            yield page
+
+
+@pytest.fixture
+def client(items):
+    return FakeClient(items)
+
+
+def _drive(client):
+    return Drive(client, {'id': 'b!test'})
+
+
+def test_delta(client):
+    base = _drive(client).delta({'items': {}}, include_permissions=False)
+    assert base['items'] == client.items
+    assert base['token'] == 'latest'
+    assert 'delta' not in base
+    assert len(client.requested) == 10
+
+
+def test_delta_changes(client):
+    base = copy.deepcopy({'items': client.items, 'token': 'old'})
+    renamed = dict(client.items['item5'], name='renamed')
+    client.changes['old'] = [renamed, {'id': 'item6', 'deleted': {}}]
+
+    base = _drive(client).delta(base, include_permissions=False)
+    assert base['items']['item5']['name'] == 'renamed'
+    assert base['items']['item5']['oldName'] == client.items['item5']['name']
+    assert 'item6' not in base['items']
+    assert base['delta']['changed'] == ['item5']
+    assert [x['id'] for x in base['delta']['deleted']] == ['item6']
+    assert base['token'] == 'latest'
+
+
+def test_delta_no_deltalink(client):
+    client.page_size = 10000
+
+    def iter_pages(path):
+        yield {'value': list(client.items.values())}
+
+    client.iter_pages = iter_pages
+    with pytest.raises(RuntimeError):
+        _drive(client).delta({'items': {}}, include_permissions=False)
+
+
+def test_delta_stopped_early(client):
+    client.stop_after = 3
+    with pytest.raises(RuntimeError):
+        _drive(client).delta({'items': {}}, include_permissions=False)
+
+
+def _interrupt_after(count):
+    pages = []
+
+    def on_page(items, item_ids):
+        pages.append(item_ids)
+        if len(pages) == count:
+            raise KeyboardInterrupt
+    return on_page
+
+
+def test_checkpoint_resume(tmp_path, client):
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint'))
+    with pytest.raises(KeyboardInterrupt):
+        # The first call is for the initial state
+        _drive(client).delta({'items': {}}, include_permissions=False, on_page=_interrupt_after(5), checkpoint=checkpoint)
+
+    client.requested = []
+    base = _drive(client).delta({'items': {}}, include_permissions=False, checkpoint=checkpoint)
+    assert base['items'] == client.items
+    assert base['token'] == 'latest'
+    # Each page is saved before on_page() sees it
+    assert len(client.requested) == 5
+    assert client.requested[0].endswith('&skip=1000')
+
+
+def test_checkpoint_other_drive(tmp_path, client):
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint'))
+    with pytest.raises(KeyboardInterrupt):
+        _drive(client).delta({'items': {}}, include_permissions=False, on_page=_interrupt_after(5), checkpoint=checkpoint)
+
+    client.requested = []
+    base = Drive(client, {'id': 'b!other'}).delta({'items': {}}, include_permissions=False, checkpoint=checkpoint)
+    assert base['items'] == client.items
+    assert len(client.requested) == 10
+
+
+def _stale_base(client):
+    base = copy.deepcopy({'items': client.items, 'token': 'old'})
+    base['items']['ghost'] = dict(base['items']['item7'], id='ghost')
+    base['items']['item8']['name'] = 'stale'
+    client.expired.add('old')
+    return base
+
+
+def test_resync(client):
+    base = _drive(client).delta(_stale_base(client), include_permissions=False)
+    assert base['items'].pop('item8') == dict(client.items['item8'], oldName='stale')
+    assert base['items'] == {k: v for (k, v) in client.items.items() if k != 'item8'}
+    assert base['token'] == 'latest'
+    # Unchanged items aren't reported
+    assert base['delta']['changed'] == ['item8']
+    assert [x['id'] for x in base['delta']['deleted']] == ['ghost']
+
+
+def test_resync_resume(tmp_path, client):
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint'))
+    with pytest.raises(KeyboardInterrupt):
+        _drive(client).delta(
+            _stale_base(client),
+            include_permissions=False,
+            on_page=_interrupt_after(6),
+            checkpoint=checkpoint,
+        )
+
+    # Items seen before the interruption mustn't be mistaken for deleted ones
+    client.requested = []
+    base = _drive(client).delta(_stale_base(client), include_permissions=False, checkpoint=checkpoint)
+    assert client.requested[0].endswith('&skip=1200')
+    assert 'token=' not in client.requested[0]
+    assert base['items']['item8']['name'] == client.items['item8']['name']
+    assert set(base['items']) == set(client.items)
+    assert [x['id'] for x in base['delta']['deleted']] == ['ghost']
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+# This file is part of ODM and distributed under the terms of the
+# MIT license. See COPYING.
+
+import copy
+import logging
+import os
+import threading
+
+import pytest
+
+from odm.libexec.odm_list import UploadPipeline, clean_filetree
+from odm.metadata import PathIndex
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _tree(path):
+    files = set()
+    dirs = set()
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        rel = os.path.relpath(dirpath, path)
+        for name in filenames + [x for x in dirnames if os.path.islink(os.path.join(dirpath, x))]:
+            files.add(os.path.normpath(os.path.join(rel, name)))
+        if rel != '.':
+            dirs.add(rel)
+    return (files, dirs)
+
+
+@pytest.mark.parametrize('jobs', [1, 4])
+def test_clean_filetree(tmp_path, items, jobs):
+    filetree = tmp_path / 'filetree'
+    paths = PathIndex(items)
+    keep = set()
+    for item_id in items:
+        if 'file' in items[item_id]:
+            keep.add(paths.fs_path(item_id))
+            dest = filetree / paths.fs_path(item_id)
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            dest.touch()
+
+    # Extraneous files next to wanted ones, and a whole extraneous tree
+    some_dir = os.path.dirname(sorted(keep, key=len)[-1])
+    (filetree / some_dir / 'extraneous').touch()
+    (filetree / 'extraneous').touch()
+    (filetree / 'gone' / 'deeper').mkdir(parents=True)
+    (filetree / 'gone' / 'deeper' / 'file').touch()
+    # Symlinks are left alone, and not followed
+    (tmp_path / 'elsewhere').mkdir()
+    (tmp_path / 'elsewhere' / 'file').touch()
+    (filetree / 'link').symlink_to(tmp_path / 'elsewhere')
+
+    clean_filetree(paths, {'items': items}, str(filetree), LOGGER, jobs)
+
+    (files, dirs) = _tree(str(filetree))
+    assert files == keep | {'link'}
+    # Only directories that still have something in them survive
+    assert dirs == {'/'.join(x.split('/')[:i]) for x in files for i in range(1, x.count('/') + 1)}
+    assert os.path.exists(str(tmp_path / 'elsewhere' / 'file'))
+
+
+class FakeFolder:
+    ''' Just enough of DriveFolder to upload into, recording what happens
+    to it in a dict shared by the whole tree. '''
+
+    def __init__(self, store, path=''):
+        self.store = store
+        self.path = path
+
+    def _join(self, name):
+        return '/'.join([self.path, name]) if self.path else name
+
+    def _record(self, key, value):
+        with self.store['lock']:
+            self.store.setdefault(key, []).append(value)
+
+    def get_folder(self, name, create):
+        path = self._join(name)
+        if name in self.store['broken']:
+            raise TypeError(name)
+        if not create and path not in self.store.get('folders', []):
+            return None
+        if create:
+            self._record('folders', path)
+        return FakeFolder(self.store, path)
+
+    def upload_file(self, src, name):
+        self._record('files', (self._join(name), src))
+        return FakeFolder(self.store, self._join(name))
+
+    def verify_file(self, src, name):
+        path = self._join(name)
+        if path in [x[0] for x in self.store.get('files', [])]:
+            return FakeFolder(self.store, path)
+        return None
+
+    def share(self, email, roles):
+        self._record('shared', (self.path, email, tuple(roles)))
+
+
+def _pipeline(items, store, action='upload', apply_permissions=False):
+    items = copy.deepcopy(items)
+    pipeline = UploadPipeline(items, PathIndex(items), FakeFolder(store), None, action, apply_permissions, {'example.com': 'example.org'}, 4, LOGGER)
+    for item_id in list(items):
+        if 'file' in items[item_id]:
+            pipeline.add(items[item_id], '/src/' + item_id)
+    return pipeline
+
+
+@pytest.fixture
+def store():
+    return {'lock': threading.Lock(), 'broken': set()}
+
+
+def _files(items):
+    paths = PathIndex(items)
+    return {(paths.path(x), '/src/' + x) for x in items if 'file' in items[x]}
+
+
+def test_upload_pipeline(items, store):
+    assert _pipeline(items, store).run() == 0
+
+    assert sorted(store['files']) == sorted(_files(items))
+    # Each folder is created once, and only the ones with files under them
+    assert len(store['folders']) == len(set(store['folders']))
+    assert set(store['folders']) == {'/'.join(x[0].split('/')[:i]) for x in store['files'] for i in range(1, x[0].count('/') + 1)}
+
+
+def test_upload_pipeline_broken_folder(items, store):
+    paths = PathIndex(items)
+    broken = next(x for x in items if 'folder' in items[x] and x != 'root' and any(
+        items[y]['parentReference'].get('id') == x and 'file' in items[y] for y in items
+    ))
+    store['broken'].add(items[broken]['name'])
+
+    assert _pipeline(items, store).run() == 1
+
+    prefix = paths.path(broken) + '/'
+    assert {x for x in _files(items) if not x[0].startswith(prefix)} == set(store['files'])
+
+
+def test_verify_upload(items, store):
+    _pipeline(items, store).run()
+    assert _pipeline(items, store, 'verify-upload').run() == 0
+
+    missing = sorted(store['files'])[0]
+    store['files'].remove(missing)
+    assert _pipeline(items, store, 'verify-upload').run() == 1
+
+
+def test_upload_permissions(items, store):
+    file_id = next(x for x in items if 'file' in items[x])
+    items[file_id]['permissions'] = [
+        {'roles': ['owner'], 'grantedTo': {'user': {'email': 'owner@example.com'}}},
+        {'roles': ['write'], 'grantedTo': {'user': {'email': 'user@example.com'}}},
+        {'roles': ['read'], 'grantedTo': {'user': {'displayName': 'No Email'}}},
+        {'roles': ['read'], 'link': {'scope': 'anonymous'}},
+    ]
+
+    assert _pipeline(items, store, apply_permissions=True).run() == 0
+    assert store['shared'] == [(PathIndex(items).path(file_id), 'user@example.org', ('write',))]
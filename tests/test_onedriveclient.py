@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+# This file is part of ODM and distributed under the terms of the
+# MIT license. See COPYING.
+
+import json
+import logging
+import os
+
+import pytest
+import requests
+
+from odm.onedriveclient import OneDriveClient
+from odm.quickxorhash import QuickXORHash
+from odm.util import PartFile
+
+DATA = os.urandom(300000)
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers, body, fail_at=None):
+        self.status_code = status_code
+        self.headers = requests.structures.CaseInsensitiveDict(headers)
+        self.body = body
+        self.fail_at = fail_at
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for pos in range(0, len(self.body), chunk_size):
+            if self.fail_at is not None and pos >= self.fail_at:
+                raise requests.exceptions.ConnectionError('connection dropped')
+            yield self.body[pos:pos + chunk_size]
+
+
+class FakeSession:
+    ''' Serves DATA with the given ETag, honouring Range and If-Range the
+    way a download URL does. '''
+
+    def __init__(self, etag='"v1"'):
+        self.etag = etag
+        self.fail_at = None
+        self.requests = []
+
+    def get(self, url, stream=False, headers=None, timeout=None):
+        headers = headers or {}
+        self.requests.append(headers)
+        response_headers = {'Content-Type': 'application/octet-stream', 'ETag': self.etag}
+        if 'Range' in headers and headers.get('If-Range') == self.etag:
+            start = int(headers['Range'][len('bytes='):].rstrip('-'))
+            return FakeResponse(206, response_headers, DATA[start:], self.fail_at)
+        return FakeResponse(200, response_headers, DATA, self.fail_at)
+
+
+@pytest.fixture
+def client():
+    # Just enough of a client to download with
+    client = OneDriveClient.__new__(OneDriveClient)
+    client.config = {}
+    client.logger = logging.getLogger(__name__)
+    client.msgraph = FakeSession()
+    client.hash_cache = None
+    client.segment_threshold = len(DATA) * 2
+    client.segments = 4
+    client._destdirs = set()
+    return client
+
+
+def _digest(data):
+    h = QuickXORHash()
+    h.update(data)
+    return h.finalize()
+
+
+def test_part_file(tmp_path):
+    part = PartFile(str(tmp_path / 'file'))
+    # No sidecar without a partial download
+    part.save({'etag': 'x'})
+    assert part.load() == {}
+
+    with open(part.path, 'wb') as f:
+        f.write(b'data')
+    assert part.load() == {'etag': 'x'}
+    assert part.size() == 4
+
+    with open(part.sidecar, 'w') as f:
+        f.write('{"etag": ')
+    assert part.load() == {}
+
+    part.commit()
+    assert (tmp_path / 'file').read_bytes() == b'data'
+    assert not os.path.exists(part.path)
+    assert not os.path.exists(part.sidecar)
+
+
+def test_download(tmp_path, client):
+    dest = str(tmp_path / 'sub' / 'file')
+    assert client._download('https://download/', dest, True, len(DATA)) == _digest(DATA)
+    with open(dest, 'rb') as f:
+        assert f.read() == DATA
+    assert os.listdir(str(tmp_path / 'sub')) == ['file']
+
+
+def test_download_resume(tmp_path, client):
+    dest = str(tmp_path / 'file')
+    client.msgraph.fail_at = 100000
+    assert client._download('https://download/', dest, True, len(DATA)) is None
+
+    part = PartFile(dest)
+    assert not os.path.exists(dest)
+    with open(part.sidecar, 'r') as f:
+        state = json.load(f)
+    assert state['etag'] == '"v1"'
+    assert state['written'] == part.size() > 0
+
+    client.msgraph.fail_at = None
+    assert client._download('https://download/', dest, True, len(DATA)) == _digest(DATA)
+    assert client.msgraph.requests[-1] == {'Range': 'bytes={}-'.format(state['written']), 'If-Range': '"v1"'}
+    with open(dest, 'rb') as f:
+        assert f.read() == DATA
+    assert not os.path.exists(part.path)
+    assert not os.path.exists(part.sidecar)
+
+
+def test_download_changed(tmp_path, client):
+    dest = str(tmp_path / 'file')
+    with open(dest + '.part', 'wb') as f:
+        f.write(b'stale' * 1000)
+    PartFile(dest).save({'etag': '"v0"', 'written': 5000})
+
+    # The server sends the whole file, since it has changed
+    assert client._download('https://download/', dest, True, len(DATA)) == _digest(DATA)
+    assert client.msgraph.requests[-1]['If-Range'] == '"v0"'
+    with open(dest, 'rb') as f:
+        assert f.read() == DATA
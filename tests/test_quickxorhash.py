@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+# This file is part of ODM and distributed under the terms of the
+# MIT license. See COPYING.
+
+import os
+import random
+
+import pytest
+
+from odm import quickxorhash
+from odm.quickxorhash import QuickXORHash
+
+
+def _digest(data, backend):
+    h = QuickXORHash(backend)
+    h.update(data)
+    return h.finalize()
+
+
+@pytest.mark.parametrize('backend', quickxorhash.available_backends())
+def test_backends_agree(backend):
+    data = os.urandom(5000)
+    digest = _digest(data, backend)
+    assert isinstance(digest, str)
+    assert digest == _digest(data, 'python')
+
+
+@pytest.mark.parametrize('backend', quickxorhash.available_backends())
+def test_uneven_updates(backend):
+    # Updates that start and end at arbitrary bit positions in the 160 bit
+    # state
+    data = os.urandom(20000)
+    rng = random.Random(0)
+
+    h = QuickXORHash(backend)
+    pos = 0
+    while pos < len(data):
+        step = rng.randint(0, 700)
+        h.update(data[pos:pos + step])
+        pos += step
+
+    assert h.finalize() == _digest(data, 'python')
+
+
+def test_empty():
+    assert _digest(b'', 'python') == 'AAAAAAAAAAAAAAAAAAAAAAAAAAA='
+    for backend in quickxorhash.available_backends():
+        assert _digest(b'', backend) == _digest(b'', 'python')
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        QuickXORHash('fortran')
+
+
+@pytest.mark.parametrize('backend', quickxorhash.available_backends())
+def test_buffer_types(backend):
+    data = os.urandom(3000)
+    expected = _digest(data, 'python')
+    assert _digest(bytearray(data), backend) == expected
+    assert _digest(memoryview(data), backend) == expected
+    # A non-byte view is hashed as its underlying bytes
+    assert _digest(memoryview(data).cast('H'), backend) == expected
+
+
+@pytest.mark.parametrize('use_mmap', [False, True])
+@pytest.mark.parametrize('size', [0, 1, quickxorhash.CHUNK_SIZE, 2 * quickxorhash.CHUNK_SIZE + 3])
+def test_hash_file(tmp_path, use_mmap, size):
+    data = os.urandom(size)
+    path = tmp_path / 'data'
+    path.write_bytes(data)
+    assert QuickXORHash().hash_file(str(path), use_mmap=use_mmap) == _digest(data, 'python')
+
+
+def test_hash_file_region(tmp_path):
+    data = os.urandom(quickxorhash.CHUNK_SIZE + 1000)
+    path = tmp_path / 'data'
+    path.write_bytes(data)
+    assert QuickXORHash().hash_file(str(path), offset=77, length=quickxorhash.CHUNK_SIZE) == _digest(data[77:77 + quickxorhash.CHUNK_SIZE], 'python')
+
+
+# libqxh can't hand back partial states
+COMBINABLE = [x for x in quickxorhash.available_backends() if x != 'libqxh']
+
+
+@pytest.mark.parametrize('backend', COMBINABLE)
+@pytest.mark.parametrize('splits', [
+    [],
+    [1],
+    [7, 160, 161],
+    [1000, 4096, 9999],
+])
+def test_combine(backend, splits):
+    data = os.urandom(12345)
+    bounds = [0] + splits + [len(data)]
+
+    h = QuickXORHash(backend)
+    for (start, end) in zip(bounds, bounds[1:]):
+        region = QuickXORHash(backend)
+        region.update(data[start:end])
+        h.combine(region.state(), end - start, start)
+
+    assert h.finalize() == _digest(data, backend)
+
+
+@pytest.fixture
+def parallel_file(tmp_path, monkeypatch):
+    path = tmp_path / 'data'
+    path.write_bytes(os.urandom(3 * quickxorhash.CHUNK_SIZE + 17))
+    monkeypatch.setattr(quickxorhash, 'PARALLEL_THRESHOLD', 0)
+    return str(path)
+
+
+def test_hash_file_parallel_threads(parallel_file):
+    expected = QuickXORHash().hash_file(parallel_file)
+    assert quickxorhash.hash_file_parallel(parallel_file, 4, processes=False) == expected
+
+
+def test_hash_file_parallel_processes(parallel_file):
+    expected = QuickXORHash().hash_file(parallel_file)
+    assert quickxorhash.hash_file_parallel(parallel_file, 2) == expected
+    # The pool is kept for the next file
+    pool = quickxorhash._process_pool(2)
+    assert quickxorhash.hash_file_parallel(parallel_file, 2) == expected
+    assert quickxorhash._process_pool(2) is pool
+
+
+def test_hash_file_parallel_daemon(parallel_file, monkeypatch):
+    # Pool workers can't have children, so they hash the file themselves
+    class Daemon:
+        daemon = True
+
+    def no_pool(workers):
+        raise AssertionError('started a process pool from a daemon')
+
+    monkeypatch.setattr(quickxorhash.multiprocessing, 'current_process', Daemon)
+    monkeypatch.setattr(quickxorhash, '_process_pool', no_pool)
+    assert quickxorhash.hash_file_parallel(parallel_file, 4) == QuickXORHash().hash_file(parallel_file)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+# This file is part of ODM and distributed under the terms of the
+# MIT license. See COPYING.
+
+import pytest
+
+from odm import throttle
+from odm.throttle import SharedThrottle
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1024.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(throttle, 'time', clock)
+    return clock
+
+
+def _pair(tmp_path):
+    # Separate instances open the file separately, just like separate
+    # processes would. The rate keeps the arithmetic exact.
+    return [SharedThrottle('test', rate=8, burst=4, path=str(tmp_path)) for _ in range(2)]
+
+
+def test_burst_then_rate(tmp_path, clock):
+    (a, b) = _pair(tmp_path)
+    for i in range(4):
+        assert (a if i % 2 else b).acquire() == 0
+    # The bucket is shared, so both have to wait now
+    assert a.acquire() == 0.125
+    assert b.acquire() == 0.125
+
+    clock.now += 60
+    # Refills stop at the burst size
+    for _ in range(4):
+        assert a.acquire() == 0
+    assert b.acquire() > 0
+
+
+def test_pause(tmp_path, clock):
+    (a, b) = _pair(tmp_path)
+    a.pause(30)
+    assert b.acquire() == 30
+    # A shorter pause doesn't cut a longer one short
+    a.pause(60)
+    b.pause(5)
+    assert a.acquire() == 60
+
+
+def test_observe(tmp_path, clock):
+    (a, b) = _pair(tmp_path)
+    for _ in range(4):
+        a.acquire()
+
+    # Plenty of budget left, nothing changes
+    a.observe({'RateLimit-Limit': '100', 'RateLimit-Remaining': '100', 'RateLimit-Reset': '10'})
+    assert b.acquire() == 0.125
+
+    # 8 requests over the next 16 seconds
+    a.observe({'RateLimit-Limit': '100', 'RateLimit-Remaining': '8', 'RateLimit-Reset': '16'})
+    assert b.acquire() == 2
+    clock.now += 16
+    assert b.acquire() == 0
+
+    a.observe({'RateLimit-Limit': '100', 'RateLimit-Remaining': '0', 'RateLimit-Reset': '15'})
+    assert b.acquire() == 15
+
+    # Missing or garbled headers are ignored
+    a.observe({})
+    a.observe({'RateLimit-Limit': 'x', 'RateLimit-Remaining': '1', 'RateLimit-Reset': '1'})
+
+
+def test_from_config(tmp_path):
+    assert SharedThrottle.from_config('test', {}) is None
+    t = SharedThrottle.from_config('test', {'throttle': {'rate': 4, 'path': str(tmp_path)}})
+    assert (t.rate, t.burst) == (4, 8)
+    assert t.path.startswith(str(tmp_path))
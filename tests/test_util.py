@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+# This file is part of ODM and distributed under the terms of the
+# MIT license. See COPYING.
+
+import functools
+import os
+import random
+
+import pytest
+
+from odm.quickxorhash import QuickXORHash
+from odm.util import HashingWriter, chunky_path, download_ranges, parallel_map, segment_ranges, split_work
+
+
+def _digest(data):
+    h = QuickXORHash()
+    h.update(data)
+    return h.finalize()
+
+
+def test_hashing_writer(tmp_path):
+    path = str(tmp_path / 'out')
+    chunks = [os.urandom(x) for x in (1, 1000, 0, 65536, 17)]
+    h = QuickXORHash()
+
+    with HashingWriter(path, h) as f:
+        buf = bytearray(65536)
+        for chunk in chunks:
+            # The writer mustn't hang on to a buffer the caller reuses
+            buf[:len(chunk)] = chunk
+            assert f.write(memoryview(buf)[:len(chunk)]) == len(chunk)
+            buf[:len(chunk)] = b'\0' * len(chunk)
+
+    data = b''.join(chunks)
+    with open(path, 'rb') as f:
+        assert f.read() == data
+    assert h.finalize() == _digest(data)
+
+
+def test_hashing_writer_offset(tmp_path):
+    path = tmp_path / 'out'
+    path.write_bytes(b'keep' + b'x' * 100)
+
+    with HashingWriter(str(path), offset=4) as f:
+        f.write(b'new')
+
+    assert path.read_bytes() == b'keepnew'
+
+
+def test_hashing_writer_error(tmp_path):
+    class Broken:
+        def update(self, data):
+            raise RuntimeError('hash failed')
+
+    f = HashingWriter(str(tmp_path / 'out'), Broken())
+    f.write(b'data')
+    # close() waits for the consumers, so the error must surface there
+    with pytest.raises(RuntimeError):
+        f.close()
+    with pytest.raises(RuntimeError):
+        f.write(b'more')
+
+
+@pytest.mark.parametrize('size', [0, 1, 7, 100, 4097])
+@pytest.mark.parametrize('segments', [1, 3, 4, 8])
+def test_segment_ranges(size, segments):
+    ranges = segment_ranges(size, segments)
+    assert len(ranges) <= segments
+    assert sum(length for (offset, length) in ranges) == size
+    for ((offset, length), (next_offset, _)) in zip(ranges, ranges[1:]):
+        assert offset + length == next_offset
+
+
+def _fetcher(data, fail_at=None):
+    def fetch(start, end, writer):
+        # Small, uneven writes like a real response body
+        for pos in range(start, end + 1, 1000):
+            if fail_at is not None and pos <= fail_at <= end and pos + 1000 > fail_at:
+                writer.write(data[pos:fail_at])
+                raise IOError('connection dropped')
+            writer.write(data[pos:min(end + 1, pos + 1000)])
+    return fetch
+
+
+def test_download_ranges(tmp_path):
+    data = os.urandom(100003)
+    dest = str(tmp_path / 'out')
+
+    segments = download_ranges(_fetcher(data), dest, len(data), 4, functools.partial(QuickXORHash, 'python'))
+
+    with open(dest, 'rb') as f:
+        assert f.read() == data
+    assert [(offset, length) for (offset, length, h) in segments] == segment_ranges(len(data), 4)
+    h = QuickXORHash('python')
+    for (offset, length, segment_hash) in segments:
+        h.combine(segment_hash.state(), length, offset)
+    assert h.finalize() == _digest(data)
+
+
+def test_download_ranges_resume(tmp_path):
+    data = os.urandom(100003)
+    dest = str(tmp_path / 'out')
+    progress = []
+
+    with pytest.raises(IOError):
+        download_ranges(_fetcher(data, fail_at=60000), dest, len(data), 4, progress=progress)
+    # The third segment stopped part way through
+    assert progress[2] == 60000 - segment_ranges(len(data), 4)[2][0]
+
+    resumed = []
+
+    def fetch(start, end, writer):
+        resumed.append(start)
+        _fetcher(data)(start, end, writer)
+
+    download_ranges(fetch, dest, len(data), 4, progress=progress)
+    with open(dest, 'rb') as f:
+        assert f.read() == data
+    assert 60000 in resumed
+    assert progress == [length for (offset, length) in segment_ranges(len(data), 4)]
+
+
+def test_download_ranges_short(tmp_path):
+    def fetch(start, end, writer):
+        writer.write(b'x' * (end - start))
+
+    with pytest.raises(IOError):
+        download_ranges(fetch, str(tmp_path / 'out'), 1000, 2)
+
+
+@pytest.mark.parametrize('name', ['short', 'ж' * 128, 'a' + 'ж' * 127, '🙂' * 64, 'a' * 255, 'a' * 256 + '漢' * 200])
+def test_chunky_path(name):
+    chunks = chunky_path(name)
+    assert ''.join(chunks) == name
+    assert all(0 < len(x.encode('utf-8')) <= 255 for x in chunks)
+
+
+def test_parallel_map():
+    squares = parallel_map(pow, [(x, 2) for x in range(20)], 2)
+    # A second map started while the first is still going mustn't change
+    # what the first one runs.
+    assert next(squares) == 0
+    labels = parallel_map(functools.partial('{}-{}'.format, 'x'), [(x,) for x in range(20)], 2)
+    assert list(labels) == ['x-{}'.format(x) for x in range(20)]
+    assert list(squares) == [x * x for x in range(1, 20)]
+
+
+def _units(seed, count):
+    rng = random.Random(seed)
+    return [(rng.randrange(50), 'unit{}'.format(i), int(rng.paretovariate(1.2) * 1e6)) for i in range(count)]
+
+
+@pytest.mark.parametrize('seed', range(20))
+@pytest.mark.parametrize('item_limit,size_limit', [
+    (100, None),
+    (None, 50 * 10 ** 6),
+    (100, 50 * 10 ** 6),
+    (1000, 10 ** 9),
+])
+def test_split_work_limits(seed, item_limit, size_limit):
+    units = _units(seed, random.Random(seed).randint(1, 2000))
+    sizes = {key: size for (locality, key, size) in units}
+
+    chunks = split_work(units, item_limit, size_limit)
+
+    keys = [key for chunk in chunks for key in chunk]
+    assert sorted(keys) == sorted(sizes)
+    for chunk in chunks:
+        assert chunk
+        if item_limit:
+            assert len(chunk) <= item_limit
+        # A single unit over the size limit gets a chunk to itself
+        if size_limit and len(chunk) > 1:
+            assert sum(sizes[key] for key in chunk) <= size_limit
+
+
+def test_split_work_locality():
+    units = [(i % 5, i, 1) for i in range(100)]
+    chunks = split_work(units, 20)
+    assert len(chunks) == 5
+    for chunk in chunks:
+        assert len({key % 5 for key in chunk}) == 1
+
+
+def test_split_work_empty():
+    assert split_work([], 10) == []
+    assert split_work([(0, 'a', 0)], 10) == [['a']]
+
+
+def test_split_work_balanced():
+    # 10 equal units in chunks of up to 4 come out as 4, 3, 3 rather than
+    # 4, 4, 2
+    chunks = split_work([(i, i, 1) for i in range(10)], 4)
+    assert sorted(len(x) for x in chunks) == [3, 3, 4]